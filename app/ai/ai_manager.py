@@ -1,10 +1,13 @@
 # app/ai/ai_manager.py
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional, Iterable, Generator
+import re
+from typing import Any, AsyncGenerator, Dict, List, Optional, Iterable, Generator
 
 import httpx
 
+from app.ai.http_pool import http_pool
+from app.ai.sse import DONE, aiter_sse_data, decode_json_events, iter_sse_data
 from app.core.config import settings
 
 # 导入日志记录器
@@ -33,9 +36,104 @@ class ProviderConfig:
         self.default_model = default_model or settings.AI_MODEL or "gpt-4o-mini"
 
 
+# 流式响应结束标记
+_STREAM_DONE = object()
+
+
+class _ChatStreamDecoder:
+    """
+    把 chat/completions 流式响应的 SSE 事件解析为 thinking / content / usage 事件，同步和异步流共用。
+    遇到 [DONE] 时 done 置为 True，并在此之前产出收集到的 usage。
+    """
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.usage_info: Optional[Dict[str, Any]] = None
+        self.done = False
+
+    def feed(self, data: bytes) -> List[Dict[str, Any]]:
+        """data 为 SSEDecoder 产出的一个事件的 data 字段"""
+        if data.strip() == DONE:
+            self.done = True
+            # 在结束前 yield 最后收集到的 usage 信息
+            if self.usage_info:
+                return [{"type": "usage", "usage": self.usage_info}]
+            return []
+        events: List[Dict[str, Any]] = []
+        for obj in decode_json_events(data):
+            events.extend(self._chunk_events(obj))
+        return events
+
+    def _chunk_events(self, obj: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # usage 信息（持续更新，在流结束时 yield）
+        usage = obj.get("usage")
+        if usage and usage.get("prompt_tokens"):
+            self.usage_info = {
+                "model": self.model,
+                "input_tokens": usage.get("prompt_tokens", 0),
+                "output_tokens": usage.get("completion_tokens", 0),
+                "total_tokens": usage.get("total_tokens", 0),
+            }
+
+        choices = obj.get("choices") or []
+        if not choices:
+            return []
+        delta = choices[0].get("delta") or {}
+        events: List[Dict[str, Any]] = []
+        
+        # 检查是否有思考内容（深度思考模式）
+        # 支持多种格式：reasoning_content, thinking, 或 <thought> 标签
+        reasoning = delta.get("reasoning_content") or delta.get("thinking") or ""
+        content = delta.get("content") or ""
+        
+        # 如果 content 为空但 reasoning 有内容，需要判断这是真正的思考还是最终回复
+        # DeepSeek 模型有时会把最终回复也放在 reasoning_content 中
+        if reasoning and not content:
+            # 先作为思考内容输出
+            events.append({"type": "thinking", "content": reasoning})
+        elif reasoning and content:
+            # 两者都有，分别输出
+            events.append({"type": "thinking", "content": reasoning})
+        
+        # Gemini 的思考内容可能包裹在 <thought> 标签中
+        if content:
+            # 检查是否包含 <thought> 标签
+            if "<thought>" in content or "</thought>" in content:
+                # 提取思考内容
+                thought_match = re.search(r'<thought>(.*?)</thought>', content, re.DOTALL)
+                if thought_match:
+                    thinking_text = thought_match.group(1)
+                    events.append({"type": "thinking", "content": thinking_text})
+                    # 移除思考内容，保留正文
+                    content = re.sub(r'<thought>.*?</thought>', '', content, flags=re.DOTALL)
+                elif "<thought>" in content and "</thought>" not in content:
+                    # 思考开始但未结束，整个内容都是思考
+                    thinking_text = content.replace("<thought>", "")
+                    events.append({"type": "thinking", "content": thinking_text})
+                    content = ""
+                elif "</thought>" in content and "<thought>" not in content:
+                    # 思考结束
+                    thinking_text = content.replace("</thought>", "")
+                    events.append({"type": "thinking", "content": thinking_text})
+                    content = ""
+        
+        if content:
+            events.append({"type": "content", "content": content})
+        return events
+
+
 class AIManager:
-    def __init__(self) -> None:
-        # 全局默认 Provider（可被 runtime provider 覆盖）
+    """
+    绑定单个 Provider 的 AI 客户端。
+    每个请求 / 会话应使用自己的实例（见 app.ai.provider_registry），不要在共享实例上切换 Provider：
+    多个线程同时处理请求时，set_provider 会让一个会话的请求带着另一个 Provider 的 Key 和地址发出。
+    """
+
+    def __init__(self, provider: Optional[ProviderConfig] = None) -> None:
+        if provider is not None:
+            self._provider = provider
+            return
+        # 全局默认 Provider（.env）
         try:
             self._provider = ProviderConfig()
         except Exception as e:
@@ -46,6 +144,20 @@ class AIManager:
                 default_model="gpt-4o-mini"
             )
 
+    @classmethod
+    def for_provider(
+        cls,
+        api_base: Optional[str] = None,
+        api_key: Optional[str] = None,
+        default_model: Optional[str] = None,
+    ) -> "AIManager":
+        """创建绑定指定 Provider 的新客户端"""
+        return cls(ProviderConfig(api_base=api_base, api_key=api_key, default_model=default_model))
+
+    @property
+    def provider(self) -> ProviderConfig:
+        return self._provider
+
     def set_provider(
         self,
         api_base: Optional[str] = None,
@@ -53,7 +165,8 @@ class AIManager:
         default_model: Optional[str] = None,
     ) -> None:
         """
-        从会话 / DB Provider 动态设置当前调用所用的 Provider。
+        修改本实例的 Provider。
+        仅用于全局默认客户端（/provider/config）；处理请求时请用 for_provider 创建独立实例。
         """
         self._provider = ProviderConfig(
             api_base=api_base,
@@ -93,43 +206,65 @@ class AIManager:
         path: str,
         json_data: Dict[str, Any],
         stream: bool = False,
-        timeout: int = 60,
+        timeout: float = 60,
     ) -> httpx.Response:
         url = f"{self._provider.api_base}/{path.lstrip('/')}"
-        client_args: Dict[str, Any] = {"timeout": timeout}
-        if stream:
-            client_args["timeout"] = None  # 流式需要长连接
-
-        client = httpx.Client(**client_args)
-        
+        # 复用该 api_base 的长连接；流式不限制读取时间
+        resp = http_pool.send(
+            self._provider.api_base,
+            "POST",
+            url,
+            headers=self._headers(),
+            json=json_data,
+            timeout=None if stream else timeout,
+            stream=stream,
+        )
         try:
-            # 使用 build_request + send 来支持 stream=True
-            request = client.build_request("POST", url, headers=self._headers(), json=json_data)
-            resp = client.send(request, stream=stream)
             resp.raise_for_status()
-            return resp
-        except httpx.HTTPStatusError as e:
-            client.close()
+        except httpx.HTTPStatusError:
+            if stream:
+                # 流式响应先读完错误内容，便于调用方查看 e.response.text
+                resp.read()
+            resp.close()
             raise
-        except Exception:
-            client.close()
+        return resp
+
+    async def _apost(
+        self,
+        path: str,
+        json_data: Dict[str, Any],
+        stream: bool = False,
+        timeout: float = 60,
+    ) -> httpx.Response:
+        """_post 的异步版本，使用当前事件循环上的 httpx.AsyncClient 连接池"""
+        url = f"{self._provider.api_base}/{path.lstrip('/')}"
+        resp = await http_pool.asend(
+            self._provider.api_base,
+            "POST",
+            url,
+            headers=self._headers(),
+            json=json_data,
+            timeout=None if stream else timeout,
+            stream=stream,
+        )
+        try:
+            resp.raise_for_status()
+        except httpx.HTTPStatusError:
+            if stream:
+                await resp.aread()
+            await resp.aclose()
             raise
+        return resp
 
     # ---------- Chat / Tools ----------
 
-    def chat(
+    def _chat_payload(
         self,
         messages: List[Dict[str, str]],
-        model: Optional[str] = None,
-        stream: bool = False,
-        enable_thinking: bool = False,  # 新增：是否启用深度思考
-    ) -> Any:
-        """
-        普通聊天调用。
-        - 当 stream=False 时，返回包含内容和token统计的字典。
-        - 当 stream=True 时，返回生成器，yield 文本增量。
-        - enable_thinking=True 时，启用深度思考模式（需要模型支持）
-        """
+        model: Optional[str],
+        stream: bool,
+        enable_thinking: bool,
+    ) -> Dict[str, Any]:
         payload: Dict[str, Any] = {
             "model": model or self._provider.default_model,
             "messages": messages,
@@ -180,34 +315,53 @@ class AIManager:
             
         except Exception:
             pass
+        return payload
+
+    @staticmethod
+    def _chat_result(payload: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+        content = data["choices"][0]["message"]["content"]
+        usage = data.get("usage", {})
+        
+        result = {
+            "content": content,
+            "model": payload["model"],
+            "input_tokens": usage.get("prompt_tokens", 0),
+            "output_tokens": usage.get("completion_tokens", 0),
+            "total_tokens": usage.get("total_tokens", 0)
+        }
+        
+        # 记录token使用情况
+        try:
+            logger.log_token_usage(
+                model=result["model"],
+                input_tokens=result["input_tokens"],
+                output_tokens=result["output_tokens"],
+                total_tokens=result["total_tokens"]
+            )
+        except Exception:
+            pass
+        
+        return result
+
+    def chat(
+        self,
+        messages: List[Dict[str, str]],
+        model: Optional[str] = None,
+        stream: bool = False,
+        enable_thinking: bool = False,  # 新增：是否启用深度思考
+    ) -> Any:
+        """
+        普通聊天调用。
+        - 当 stream=False 时，返回包含内容和token统计的字典。
+        - 当 stream=True 时，返回生成器，yield 文本增量。
+        - enable_thinking=True 时，启用深度思考模式（需要模型支持）
+        """
+        payload = self._chat_payload(messages, model, stream, enable_thinking)
         
         if not stream:
             resp = self._post("chat/completions", payload, stream=False)
             try:
-                data = resp.json()
-                content = data["choices"][0]["message"]["content"]
-                usage = data.get("usage", {})
-                
-                result = {
-                    "content": content,
-                    "model": payload["model"],
-                    "input_tokens": usage.get("prompt_tokens", 0),
-                    "output_tokens": usage.get("completion_tokens", 0),
-                    "total_tokens": usage.get("total_tokens", 0)
-                }
-                
-                # 记录token使用情况
-                try:
-                    logger.log_token_usage(
-                        model=result["model"],
-                        input_tokens=result["input_tokens"],
-                        output_tokens=result["output_tokens"],
-                        total_tokens=result["total_tokens"]
-                    )
-                except Exception:
-                    pass
-                
-                return result
+                return self._chat_result(payload, resp.json())
             finally:
                 resp.close()
 
@@ -215,97 +369,60 @@ class AIManager:
         resp = self._post("chat/completions", payload, stream=True)
 
         def _iter() -> Generator[Dict[str, Any], None, None]:
-            usage_info = None
+            decoder = _ChatStreamDecoder(payload["model"])
             try:
-                for line in resp.iter_lines():
-                    if not line:
-                        continue
-                    
-                    if line.startswith("data:"):
-                        line = line[5:].strip()
-                    if line == "[DONE]":
-                        # 在结束前 yield 最后收集到的 usage 信息
-                        if usage_info:
-                            yield {"type": "usage", "usage": usage_info}
+                for data in iter_sse_data(resp.iter_bytes()):
+                    yield from decoder.feed(data)
+                    if decoder.done:
                         break
-                    try:
-                        import json as _json
-                        obj = _json.loads(line)
-                    except Exception:
-                        continue
-
-                    # usage 信息（持续更新，在流结束时 yield）
-                    usage = obj.get("usage")
-                    if usage and usage.get("prompt_tokens"):
-                        usage_info = {
-                            "model": payload["model"],
-                            "input_tokens": usage.get("prompt_tokens", 0),
-                            "output_tokens": usage.get("completion_tokens", 0),
-                            "total_tokens": usage.get("total_tokens", 0),
-                        }
-
-                    choices = obj.get("choices") or []
-                    if not choices:
-                        continue
-                    delta = choices[0].get("delta") or {}
-                    
-                    # 检查是否有思考内容（深度思考模式）
-                    # 支持多种格式：reasoning_content, thinking, 或 <thought> 标签
-                    reasoning = delta.get("reasoning_content") or delta.get("thinking") or ""
-                    content = delta.get("content") or ""
-                    
-                    # 如果 content 为空但 reasoning 有内容，需要判断这是真正的思考还是最终回复
-                    # DeepSeek 模型有时会把最终回复也放在 reasoning_content 中
-                    if reasoning and not content:
-                        # 先作为思考内容输出
-                        yield {"type": "thinking", "content": reasoning}
-                    elif reasoning and content:
-                        # 两者都有，分别输出
-                        yield {"type": "thinking", "content": reasoning}
-                    
-                    # Gemini 的思考内容可能包裹在 <thought> 标签中
-                    if content:
-                        # 检查是否包含 <thought> 标签
-                        if "<thought>" in content or "</thought>" in content:
-                            # 提取思考内容
-                            import re
-                            thought_match = re.search(r'<thought>(.*?)</thought>', content, re.DOTALL)
-                            if thought_match:
-                                thinking_text = thought_match.group(1)
-                                yield {"type": "thinking", "content": thinking_text}
-                                # 移除思考内容，保留正文
-                                content = re.sub(r'<thought>.*?</thought>', '', content, flags=re.DOTALL)
-                            elif "<thought>" in content and "</thought>" not in content:
-                                # 思考开始但未结束，整个内容都是思考
-                                thinking_text = content.replace("<thought>", "")
-                                yield {"type": "thinking", "content": thinking_text}
-                                content = ""
-                            elif "</thought>" in content and "<thought>" not in content:
-                                # 思考结束
-                                thinking_text = content.replace("</thought>", "")
-                                yield {"type": "thinking", "content": thinking_text}
-                                content = ""
-                    
-                    if content:
-                        yield {"type": "content", "content": content}
             finally:
                 resp.close()
 
         return _iter()
 
-
-    def run_with_tools(
+    async def achat(
         self,
-        messages: List[Dict[str, Any]],
-        tools: Optional[List[Dict[str, Any]]] = None,
+        messages: List[Dict[str, str]],
         model: Optional[str] = None,
         stream: bool = False,
+        enable_thinking: bool = False,
     ) -> Any:
         """
-        支持 tools 的对话调用。
-        - tools 为 None 时相当于普通 chat。
-        - stream 语义同 chat()。
+        chat() 的异步版本，请求走 httpx.AsyncClient，等待模型输出时不占用线程。
+        - 当 stream=False 时，返回与 chat() 相同的字典。
+        - 当 stream=True 时，返回异步生成器（async for），事件格式与 chat() 相同。
         """
+        payload = self._chat_payload(messages, model, stream, enable_thinking)
+
+        if not stream:
+            resp = await self._apost("chat/completions", payload, stream=False)
+            try:
+                return self._chat_result(payload, resp.json())
+            finally:
+                await resp.aclose()
+
+        resp = await self._apost("chat/completions", payload, stream=True)
+
+        async def _aiter() -> AsyncGenerator[Dict[str, Any], None]:
+            decoder = _ChatStreamDecoder(payload["model"])
+            try:
+                async for data in aiter_sse_data(resp.aiter_bytes()):
+                    for event in decoder.feed(data):
+                        yield event
+                    if decoder.done:
+                        break
+            finally:
+                await resp.aclose()
+
+        return _aiter()
+
+    def _tools_payload(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]],
+        model: Optional[str],
+        stream: bool,
+    ) -> Dict[str, Any]:
         payload: Dict[str, Any] = {
             "model": model or self._provider.default_model,
             "messages": messages,
@@ -315,22 +432,47 @@ class AIManager:
             payload["tools"] = tools
         if stream:
             payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    @staticmethod
+    def _tools_result(payload: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+        # 格式化返回数据，确保包含token信息
+        if "usage" in data:
+            usage = data["usage"]
+            data["token_info"] = {
+                "model": payload["model"],
+                "input_tokens": usage.get("prompt_tokens", 0),
+                "output_tokens": usage.get("completion_tokens", 0),
+                "total_tokens": usage.get("total_tokens", 0)
+            }
+        return data
+
+    @staticmethod
+    def _tools_stream_data(data: bytes) -> Any:
+        """解析工具模式流式响应的一个 SSE 事件：返回 chunk 对象列表或 _STREAM_DONE"""
+        if data.strip() == DONE:
+            return _STREAM_DONE
+        return decode_json_events(data)
+
+    def run_with_tools(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        model: Optional[str] = None,
+        stream: bool = False,
+    ) -> Any:
+        """
+        支持 tools 的对话调用。
+        - tools 为 None 时相当于普通 chat。
+        - stream 语义同 chat()。
+        """
+        payload = self._tools_payload(messages, tools, model, stream)
 
         if not stream:
             # 工具调用模式需要更长的超时时间（120秒）
             resp = self._post("chat/completions", payload, stream=False, timeout=120)
             try:
-                data = resp.json()
-                # 格式化返回数据，确保包含token信息
-                if "usage" in data:
-                    usage = data["usage"]
-                    data["token_info"] = {
-                        "model": payload["model"],
-                        "input_tokens": usage.get("prompt_tokens", 0),
-                        "output_tokens": usage.get("completion_tokens", 0),
-                        "total_tokens": usage.get("total_tokens", 0)
-                    }
-                return data
+                return self._tools_result(payload, resp.json())
             finally:
                 resp.close()
 
@@ -338,34 +480,60 @@ class AIManager:
 
         def _iter() -> Generator[Dict[str, Any], None, None]:
             try:
-                for line in resp.iter_lines():
-                    if not line:
-                        continue
-                    # 修复：iter_lines() 返回 str
-                    if line.startswith("data:"):
-                        line = line[5:].strip()
-                    if line == "[DONE]":
+                for data in iter_sse_data(resp.iter_bytes()):
+                    objs = self._tools_stream_data(data)
+                    if objs is _STREAM_DONE:
                         break
-                    try:
-                        obj = httpx.Response(200, content=line).json()
-                    except Exception:
-                        continue
-                    yield obj
+                    yield from objs
             finally:
                 resp.close()
 
         return _iter()
 
+    async def arun_with_tools(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        model: Optional[str] = None,
+        stream: bool = False,
+    ) -> Any:
+        """run_with_tools() 的异步版本；stream=True 时返回异步生成器"""
+        payload = self._tools_payload(messages, tools, model, stream)
+
+        if not stream:
+            resp = await self._apost("chat/completions", payload, stream=False, timeout=120)
+            try:
+                return self._tools_result(payload, resp.json())
+            finally:
+                await resp.aclose()
+
+        resp = await self._apost("chat/completions", payload, stream=True)
+
+        async def _aiter() -> AsyncGenerator[Dict[str, Any], None]:
+            try:
+                async for data in aiter_sse_data(resp.aiter_bytes()):
+                    objs = self._tools_stream_data(data)
+                    if objs is _STREAM_DONE:
+                        break
+                    for obj in objs:
+                        yield obj
+            finally:
+                await resp.aclose()
+
+        return _aiter()
+
+
     # ---------- Embedding（向量生成） ----------
 
     def create_embedding(
         self,
         input_texts: Iterable[str],
         model: Optional[str] = None,
+        timeout: Optional[float] = None,
     ) -> List[List[float]]:
         """
         为知识库构建向量，调用 OpenAI 兼容的 /embeddings 接口。
-        返回：每个输入文本对应的向量列表。
+        返回：每个输入文本对应的向量列表（按响应中的 index 排序）。
         """
         texts = list(input_texts)
         if not texts:
@@ -379,14 +547,17 @@ class AIManager:
         }
         url_path = "embeddings"
 
-        url = f"{self._provider.api_base}/{url_path}"
-        with httpx.Client(timeout=60) as client:
-            resp = client.post(url, headers=self._headers(), json=payload)
-            resp.raise_for_status()
+        resp = self._post(url_path, payload, timeout=timeout or settings.EMBEDDING_TIMEOUT)
+        try:
             data = resp.json()
+        finally:
+            resp.close()
 
+        items = data.get("data", [])
+        if all(isinstance(item.get("index"), int) for item in items):
+            items = sorted(items, key=lambda item: item["index"])
         embeddings: List[List[float]] = []
-        for item in data.get("data", []):
+        for item in items:
             emb = item.get("embedding")
             if isinstance(emb, list):
                 embeddings.append(emb)
@@ -439,11 +610,12 @@ class AIManager:
                 n=n
             )
             
-            url = f"{self._provider.api_base}/images/generations"
-            with httpx.Client(timeout=120) as client:  # 生图可能需要更长时间
-                resp = client.post(url, headers=self._headers(), json=payload)
-                resp.raise_for_status()
+            # 生图可能需要更长时间
+            resp = self._post("images/generations", payload, timeout=120)
+            try:
                 data = resp.json()
+            finally:
+                resp.close()
             
             images = data.get("data", [])
             
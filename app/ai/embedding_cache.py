@@ -0,0 +1,228 @@
+# app/ai/embedding_cache.py
+"""
+查询向量缓存
+知识库检索时模型经常在多轮工具调用、不同对话中重复同样的查询，
+按 (api_base, embedding 模型, 归一化后的查询文本) 缓存向量，命中时不再请求 /embeddings。
+
+- 内存：有界 LRU + TTL；
+- 持久化（可选）：写入 embedding_cache 表，重启后仍可命中；
+- 统计：hits / misses 等计数，见 GET /knowledge/embedding-cache/stats。
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+from app.db.embedding_codec import decode_embedding, encode_embedding
+
+_WHITESPACE = re.compile(r"\s+")
+
+# 每写入多少条持久化记录清理一次过期数据
+_PRUNE_EVERY = 256
+
+
+def normalize_query(text: str) -> str:
+    """NFKC 归一化（全角转半角等）、折叠空白、忽略大小写"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return _WHITESPACE.sub(" ", text).strip().casefold()
+
+
+def cache_key(api_base: str, model: str, text: str) -> str:
+    raw = "\x00".join([(api_base or "").rstrip("/"), model or "", normalize_query(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        ttl_seconds: int = 7 * 24 * 3600,
+        persist: bool = False,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self._lock = threading.Lock()
+        # key -> (过期时间戳, float32 向量)；比 Python float 列表省约 8 倍内存
+        self._entries: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._writes_since_prune = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- 内存层 ----------
+
+    def _get_memory(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, vector = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return vector.tolist()
+
+    def _put_memory(self, key: str, vector, created_at: Optional[float] = None) -> None:
+        expires_at = (created_at or time.time()) + self.ttl_seconds
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._entries[key] = (expires_at, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # ---------- 持久层 ----------
+
+    def _load_persistent(self, keys: Sequence[str]) -> Dict[str, Tuple[float, np.ndarray]]:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(models.EmbeddingCacheEntry)
+                .filter(models.EmbeddingCacheEntry.key.in_(list(keys)))
+                .filter(models.EmbeddingCacheEntry.created_at >= cutoff)
+                .all()
+            )
+            found: Dict[str, Tuple[float, np.ndarray]] = {}
+            for row in rows:
+                vec = decode_embedding(row.embedding)
+                if vec is not None:
+                    created = (row.created_at - datetime(1970, 1, 1)).total_seconds()
+                    found[row.key] = (created, vec)
+            return found
+        finally:
+            db.close()
+
+    def _save_persistent(self, items: Dict[str, List[float]], model: str) -> None:
+        db = SessionLocal()
+        try:
+            for key, vector in items.items():
+                db.merge(
+                    models.EmbeddingCacheEntry(
+                        key=key,
+                        model=model or "",
+                        embedding=encode_embedding(vector),
+                        created_at=datetime.utcnow(),
+                    )
+                )
+            self._writes_since_prune += len(items)
+            if self._writes_since_prune >= _PRUNE_EVERY:
+                self._writes_since_prune = 0
+                cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+                db.query(models.EmbeddingCacheEntry).filter(
+                    models.EmbeddingCacheEntry.created_at < cutoff
+                ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    # ---------- 对外接口 ----------
+
+    def get_or_compute(
+        self,
+        *,
+        api_base: str,
+        model: str,
+        texts: Sequence[str],
+        compute: Callable[[List[str]], Optional[List[List[float]]]],
+    ) -> Optional[List[List[float]]]:
+        """
+        返回与 texts 一一对应的向量；未命中的文本合并为一次 compute 调用。
+        compute 失败（返回 None 或数量不符）时返回 None，且不写入缓存。
+        """
+        keys = [cache_key(api_base, model, t) for t in texts]
+        results: Dict[str, List[float]] = {}
+
+        for key in keys:
+            vector = self._get_memory(key)
+            if vector is not None:
+                results[key] = vector
+
+        missing = [k for k in dict.fromkeys(keys) if k not in results]
+        if missing and self.persist:
+            try:
+                stored = self._load_persistent(missing)
+            except Exception:
+                stored = {}  # 缓存表不可用时退化为纯内存缓存
+            for key, (created, vector) in stored.items():
+                results[key] = vector.tolist()
+                self._put_memory(key, vector, created_at=created)
+            with self._lock:
+                self.persistent_hits += len(stored)
+
+        # 同一批次里重复的文本只计算一次
+        pending: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in results and key not in pending:
+                pending[key] = text
+
+        with self._lock:
+            self.hits += len(keys) - len(pending)
+            self.misses += len(pending)
+
+        if pending:
+            computed = compute(list(pending.values()))
+            if not computed or len(computed) != len(pending):
+                return None
+            fresh = dict(zip(pending.keys(), computed))
+            for key, vector in fresh.items():
+                self._put_memory(key, vector)
+                results[key] = vector
+            if self.persist:
+                try:
+                    self._save_persistent(fresh, model)
+                except Exception:
+                    pass  # 持久化失败不影响本次检索
+
+        return [results[k] for k in keys]
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": settings.EMBEDDING_CACHE_ENABLED,
+                "persist": self.persist,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.persistent_hits = self.misses = self.evictions = 0
+        if self.persist:
+            db = SessionLocal()
+            try:
+                db.query(models.EmbeddingCacheEntry).delete(synchronize_session=False)
+                db.commit()
+            finally:
+                db.close()
+
+
+# 全局缓存实例
+embedding_cache = EmbeddingCache(
+    max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.EMBEDDING_CACHE_TTL_SECONDS,
+    persist=settings.EMBEDDING_CACHE_PERSIST,
+)
@@ -0,0 +1,164 @@
+# app/ai/embedding_pipeline.py
+"""
+知识库上传的批量 embedding 流水线
+1. 按估算 token 数和条数把输入切成若干批次，避免超出 Provider 的单次输入上限；
+2. 用线程池并发发送多个批次，EMBEDDING_CONCURRENCY 控制同时在途的请求数；
+3. 失败批次按指数退避重试（429 / 5xx / 网络错误，优先遵循 Retry-After）；
+4. 结果按原始顺序拼回，与输入一一对应。
+"""
+from __future__ import annotations
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Sequence
+
+import httpx
+
+from app.core.config import settings
+from app.utils.logger import logger
+from app.utils.token_estimator import estimate_tokens
+
+EmbedBatchFn = Callable[[List[str]], List[List[float]]]
+
+# 可重试的 HTTP 状态码
+_RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# 单次退避的上限（秒）
+_MAX_BACKOFF = 30.0
+
+
+class EmbeddingPipelineError(Exception):
+    """某个批次在重试后仍然失败"""
+
+
+def make_batches(
+    texts: Sequence[str],
+    max_tokens: int,
+    max_items: int,
+) -> List[List[int]]:
+    """
+    按顺序切分批次，返回每批的下标列表。
+    单条文本超过 max_tokens 时单独成批（交由 Provider 截断或报错）。
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for idx, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(idx)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in _RETRYABLE_STATUS
+    return isinstance(exc, (httpx.TransportError, httpx.TimeoutException))
+
+
+def _retry_delay(exc: Exception, attempt: int, base: float) -> float:
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), _MAX_BACKOFF)
+            except ValueError:
+                pass
+    # 指数退避 + 抖动，避免并发批次同时重试
+    return min(base * (2 ** attempt), _MAX_BACKOFF) * (0.5 + random.random() / 2)
+
+
+def _run_batch(
+    embed_batch: EmbedBatchFn,
+    texts: List[str],
+    batch_no: int,
+    max_retries: int,
+    backoff: float,
+) -> List[List[float]]:
+    attempt = 0
+    while True:
+        try:
+            vectors = embed_batch(texts)
+            if len(vectors) != len(texts):
+                raise EmbeddingPipelineError(
+                    f"批次 {batch_no} 返回 {len(vectors)} 个向量，预期 {len(texts)} 个"
+                )
+            return vectors
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable(e):
+                raise EmbeddingPipelineError(f"批次 {batch_no} 向量生成失败: {e}") from e
+            delay = _retry_delay(e, attempt, backoff)
+            logger.log_performance("embedding 批次重试", delay, {
+                "batch": batch_no,
+                "attempt": attempt + 1,
+                "error": str(e)[:200],
+            })
+            time.sleep(delay)
+            attempt += 1
+
+
+def embed_texts(
+    texts: Sequence[str],
+    embed_batch: EmbedBatchFn,
+    *,
+    max_batch_tokens: Optional[int] = None,
+    max_batch_items: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    max_retries: Optional[int] = None,
+    backoff: Optional[float] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> List[List[float]]:
+    """
+    为 texts 生成向量，返回顺序与输入一致。
+    embed_batch: 对一批文本调用 /embeddings 的函数（如 AIManager.create_embedding）。
+    on_progress: 每个批次完成后以 (已完成条数, 总条数) 调用。
+    任一批次最终失败时抛出 EmbeddingPipelineError，并取消尚未开始的批次。
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+
+    batches = make_batches(
+        texts,
+        max_batch_tokens or settings.EMBEDDING_BATCH_MAX_TOKENS,
+        max_batch_items or settings.EMBEDDING_BATCH_MAX_ITEMS,
+    )
+    max_retries = settings.EMBEDDING_MAX_RETRIES if max_retries is None else max_retries
+    backoff = settings.EMBEDDING_RETRY_BACKOFF if backoff is None else backoff
+    workers = max(1, min(concurrency or settings.EMBEDDING_CONCURRENCY, len(batches)))
+
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    done = 0
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding") as executor:
+        futures = {
+            executor.submit(
+                _run_batch, embed_batch, [texts[i] for i in indices], batch_no, max_retries, backoff
+            ): indices
+            for batch_no, indices in enumerate(batches, start=1)
+        }
+        try:
+            for future in as_completed(futures):
+                indices = futures[future]
+                for i, vector in zip(indices, future.result()):
+                    results[i] = vector
+                done += len(indices)
+                if on_progress is not None:
+                    on_progress(done, len(texts))
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    logger.log_performance("批量 embedding", time.time() - started, {
+        "texts": len(texts),
+        "batches": len(batches),
+        "concurrency": workers,
+    })
+    return results  # type: ignore[return-value]
@@ -0,0 +1,224 @@
+# app/ai/http_pool.py
+"""
+按 api_base 复用的 HTTP 连接池
+AIManager 的所有请求（对话、工具调用、向量、生图）共用同一个 api_base 的长连接客户端，
+不再每次调用都新建 httpx.Client，省去每轮对话的 TCP + TLS 握手。
+
+- 每个 api_base 一个 httpx.Client（线程安全，可被多个请求线程同时使用）；
+- 异步调用（AIManager.achat 等）使用 httpx.AsyncClient，按事件循环 + api_base 各一个，
+  等待模型输出时不占用线程，大量并发的 SSE 流可以共用一个事件循环；
+- 连接数上限、空闲连接数上限和保活时间见 AI_HTTP_* 配置；
+- 安装了 h2 时启用 HTTP/2（服务端不支持时自动回落 HTTP/1.1）；
+- stats() 返回各连接池的连接占用情况，用于观察连接池是否打满。
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple, Union
+
+import httpx
+
+from app.core.config import settings
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class _PoolMetrics:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.pool_timeouts = 0
+        self.peak_in_use = 0
+
+
+class HTTPClientPool:
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        pool_timeout: float,
+        http2: bool = True,
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.pool_timeout = pool_timeout
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._lock = threading.Lock()
+        self._clients: Dict[str, httpx.Client] = {}
+        # AsyncClient 的连接绑定在创建它的事件循环上，按循环分别保存；循环被回收时自动丢弃
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        # 键为 ("sync" | "async", api_base)
+        self._metrics: Dict[Tuple[str, str], _PoolMetrics] = {}
+
+    def client(self, api_base: str) -> httpx.Client:
+        with self._lock:
+            client = self._clients.get(api_base)
+            if client is None or client.is_closed:
+                client = httpx.Client(limits=self.limits, http2=self.http2)
+                self._clients[api_base] = client
+                self._metrics.setdefault(("sync", api_base), _PoolMetrics())
+            return client
+
+    def async_client(self, api_base: str) -> httpx.AsyncClient:
+        """当前事件循环上该 api_base 的 AsyncClient（须在事件循环内调用）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(api_base)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+                clients[api_base] = client
+                self._metrics.setdefault(("async", api_base), _PoolMetrics())
+            return client
+
+    def timeout(self, timeout: Optional[float]) -> httpx.Timeout:
+        """单次请求的超时；timeout 为 None（流式）时只限制等待空闲连接的时间"""
+        return httpx.Timeout(timeout, pool=self.pool_timeout)
+
+    def send(
+        self,
+        api_base: str,
+        method: str,
+        url: str,
+        *,
+        headers: Dict[str, str],
+        json: Any,
+        timeout: Optional[float],
+        stream: bool = False,
+    ) -> httpx.Response:
+        """发送请求；stream=True 时调用方负责 resp.close()，关闭后连接回到池中"""
+        client = self.client(api_base)
+        request = client.build_request(method, url, headers=headers, json=json, timeout=self.timeout(timeout))
+        try:
+            resp = client.send(request, stream=stream)
+        except httpx.PoolTimeout:
+            self._record_timeout(("sync", api_base))
+            raise
+        self._record_request(("sync", api_base), client)
+        return resp
+
+    async def asend(
+        self,
+        api_base: str,
+        method: str,
+        url: str,
+        *,
+        headers: Dict[str, str],
+        json: Any,
+        timeout: Optional[float],
+        stream: bool = False,
+    ) -> httpx.Response:
+        """send 的异步版本；stream=True 时调用方负责 await resp.aclose()"""
+        client = self.async_client(api_base)
+        request = client.build_request(method, url, headers=headers, json=json, timeout=self.timeout(timeout))
+        try:
+            resp = await client.send(request, stream=stream)
+        except httpx.PoolTimeout:
+            self._record_timeout(("async", api_base))
+            raise
+        self._record_request(("async", api_base), client)
+        return resp
+
+    def _record_timeout(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._metrics[key].pool_timeouts += 1
+
+    def _record_request(self, key: Tuple[str, str], client: Union[httpx.Client, httpx.AsyncClient]) -> None:
+        in_use = self._in_use(client)
+        with self._lock:
+            metrics = self._metrics[key]
+            metrics.requests += 1
+            if in_use is not None and in_use > metrics.peak_in_use:
+                metrics.peak_in_use = in_use
+
+    @staticmethod
+    def _connections(client: Union[httpx.Client, httpx.AsyncClient]):
+        # httpx 没有公开连接池状态，从底层 httpcore.ConnectionPool 读取
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        return getattr(pool, "connections", None)
+
+    def _in_use(self, client: Union[httpx.Client, httpx.AsyncClient]) -> Optional[int]:
+        connections = self._connections(client)
+        if connections is None:
+            return None
+        return sum(1 for conn in connections if not conn.is_idle())
+
+    def _pool_stats(self, clients, metrics: _PoolMetrics) -> Dict[str, Any]:
+        connections = [conn for client in clients for conn in (self._connections(client) or [])]
+        in_use = sum(1 for conn in connections if not conn.is_idle())
+        # 每个客户端有各自的连接上限，饱和度取所有客户端合计
+        capacity = self.limits.max_connections * max(len(clients), 1)
+        return {
+            "connections": len(connections),
+            "in_use": in_use,
+            "idle": len(connections) - in_use,
+            "saturation": round(in_use / capacity, 4),
+            "peak_in_use": metrics.peak_in_use,
+            "requests": metrics.requests,
+            "pool_timeouts": metrics.pool_timeouts,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sync_clients = dict(self._clients)
+            async_clients: Dict[str, list] = {}
+            for clients in list(self._async_clients.values()):
+                for api_base, client in clients.items():
+                    async_clients.setdefault(api_base, []).append(client)
+            metrics = dict(self._metrics)
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "pools": {
+                api_base: self._pool_stats([client], metrics[("sync", api_base)])
+                for api_base, client in sync_clients.items()
+            },
+            "async_pools": {
+                api_base: self._pool_stats(clients, metrics[("async", api_base)])
+                for api_base, clients in async_clients.items()
+            },
+        }
+
+    def close_all(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    async def aclose_all(self) -> None:
+        """关闭当前事件循环上的 AsyncClient（在 shutdown 事件中调用）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = list(self._async_clients.pop(loop, {}).values())
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception:
+                pass
+
+
+# 全局连接池实例
+http_pool = HTTPClientPool(
+    max_connections=settings.AI_HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.AI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.AI_HTTP_KEEPALIVE_EXPIRY,
+    pool_timeout=settings.AI_HTTP_POOL_TIMEOUT,
+    http2=settings.AI_HTTP2,
+)
@@ -0,0 +1,441 @@
+# app/ai/ingestion.py
+"""
+知识库导入任务
+上传接口只保存文件并创建 IngestionJob，随即返回 job_id；
+后台线程池按阶段处理：抽取文本（可选识别图片）→ 切分段落 → 批量向量化 → 写入数据库。
+抽取、切分以生成器流式进行，每攒够一个窗口的段落就向量化并写入，内存占用与文件大小无关。
+
+- 任务状态持久化在 ingestion_jobs 表，进度可通过 /knowledge/jobs/{id} 查询或 SSE 订阅；
+- 进程重启后自动恢复未完成的任务；多 worker 进程通过原子领取避免重复执行；
+- INGESTION_MAX_WORKERS 限制同时处理的任务数，避免挤占对话请求。
+"""
+from __future__ import annotations
+
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, Iterator, List, Optional, Set
+
+from app.ai.embedding_pipeline import embed_texts
+from app.ai.http_pool import http_pool
+from app.ai.provider_registry import provider_registry
+from app.core.config import settings
+from app.db import crud
+from app.db.blob_store import blob_store
+from app.db.database import SessionLocal
+from app.utils.extraction_cache import extraction_cache
+from app.utils.logger import chat_logger
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+
+# 段落切分参数
+CHUNK_SIZE = 512
+
+# 文档 content 字段保存的预览长度
+_PREVIEW_CHARS = 2000
+
+# 每个写入窗口包含的 embedding 批次数（窗口大小 = 批次条数 × 并发数 × 该值）
+_WINDOW_BATCHES = 4
+
+# 运行中任务刷新 updated_at 的间隔（秒），超过 INGESTION_STALE_SECONDS 未刷新视为中断
+_HEARTBEAT_INTERVAL = 30
+
+# 定期重新排队中断任务的间隔（秒）：重启前刚刷新过心跳的任务，要等过期后由这里恢复
+_SWEEP_INTERVAL = 60
+
+
+def build_vision_callback(db, model_name: str) -> Callable[[bytes, str], str]:
+    """根据视觉模型名查找 Provider，返回图片识别回调"""
+    if model_name.startswith("vision:"):
+        model_name = model_name[7:]
+
+    provider = provider_registry.find_by_model(db, model_name) or provider_registry.first(db)
+    if provider:
+        api_base = provider.api_base
+        api_key = provider.api_key
+    else:
+        api_base = settings.AI_API_BASE
+        api_key = settings.AI_API_KEY
+
+    def vision_callback(image_bytes: bytes, mime_type: str) -> str:
+        import base64
+
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        image_url = f"data:{mime_type};base64,{image_base64}"
+
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        payload = {
+            "model": model_name,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "请详细描述这张图片的内容，包括图片中的所有文字、图表、数据、图形等信息。如果有文字，请完整提取出来。"
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": image_url}
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": 2048
+        }
+
+        base = api_base.rstrip('/')
+        response = http_pool.send(base, "POST", f"{base}/chat/completions", headers=headers, json=payload, timeout=60.0)
+        response.raise_for_status()
+        result = response.json()
+
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0].get("message", {}).get("content", "")
+        return ""
+
+    return vision_callback
+
+
+def split_paragraphs(content: str, chunk_size: int = CHUNK_SIZE) -> List[str]:
+    """智能切分段落：按行合并到 chunk_size，超长的行按句子切分"""
+    return list(iter_paragraphs([content], chunk_size))
+
+
+def _iter_lines(pieces: Iterable[str]) -> Iterator[str]:
+    """逐块拆分成行；每个块（页、工作表、段落）都视为以完整的行结束"""
+    for piece in pieces:
+        yield from piece.splitlines()
+
+
+def iter_paragraphs(pieces: Iterable[str], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """split_paragraphs 的流式版本：输入文本块序列，逐个产出段落"""
+    current_chunk = ""
+
+    for line in _iter_lines(pieces):
+        line = line.strip()
+        if not line:
+            continue
+
+        # 如果当前块加上新行不超过 chunk_size，则合并
+        if len(current_chunk) + len(line) + 1 <= chunk_size:
+            if current_chunk:
+                current_chunk += "\n" + line
+            else:
+                current_chunk = line
+        else:
+            # 保存当前块
+            if current_chunk:
+                yield current_chunk
+
+            # 如果单行超过 chunk_size，按句子切分
+            if len(line) > chunk_size:
+                sentences = re.split(r'(?<=[。！？!?.;])\s*', line)
+                temp_chunk = ""
+                for sent in sentences:
+                    sent = sent.strip()
+                    if not sent:
+                        continue
+                    if len(temp_chunk) + len(sent) + 1 <= chunk_size:
+                        if temp_chunk:
+                            temp_chunk += sent
+                        else:
+                            temp_chunk = sent
+                    else:
+                        if temp_chunk:
+                            yield temp_chunk
+                        temp_chunk = sent
+                current_chunk = temp_chunk
+            else:
+                current_chunk = line
+
+    # 保存最后一个块
+    if current_chunk:
+        yield current_chunk
+
+
+def _windows(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    window: List[str] = []
+    for item in items:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+class IngestionError(Exception):
+    """导入失败，message 直接展示给用户"""
+
+
+class IngestionCancelled(IngestionError):
+    """知识库或正在写入的文档在导入期间被删除"""
+
+    def __init__(self, message: str, blob_released: bool = False) -> None:
+        super().__init__(message)
+        # 文档随知识库 / 单独删除时，删除接口已经释放了任务持有的文件引用
+        self.blob_released = blob_released
+
+
+class IngestionWorker:
+    """后台导入线程池（进程级单例，首次提交任务时创建）"""
+
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max(1, max_workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        # 已提交到本进程线程池、尚未开始的任务，定期恢复时不重复提交
+        self._queued: Set[int] = set()
+        self._sweeper_stop: Optional[threading.Event] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="ingestion"
+                )
+            return self._executor
+
+    def submit(self, job_id: int) -> None:
+        executor = self._get_executor()
+        with self._lock:
+            self._queued.add(job_id)
+        executor.submit(self._run, job_id)
+
+    def resume_pending(self) -> int:
+        """
+        启动时调用：重新排队中断的任务并提交所有 pending 任务，之后每 _SWEEP_INTERVAL 秒重复一次。
+        重启前刚刷新过心跳的 running 任务在启动时还不算中断，心跳过期后由定期恢复接手。
+        """
+        count = self._sweep()
+        with self._lock:
+            if self._sweeper_stop is None:
+                self._sweeper_stop = threading.Event()
+                threading.Thread(
+                    target=self._sweep_loop, args=(self._sweeper_stop,),
+                    name="ingestion-sweeper", daemon=True,
+                ).start()
+        return count
+
+    def _sweep(self) -> int:
+        db = SessionLocal()
+        try:
+            stale_before = datetime.utcnow() - timedelta(seconds=settings.INGESTION_STALE_SECONDS)
+            crud.requeue_stale_ingestion_jobs(db, stale_before)
+            pending = crud.list_ingestion_jobs(db, status="pending", limit=10000)
+            with self._lock:
+                job_ids = [job.id for job in reversed(pending) if job.id not in self._queued]
+        finally:
+            db.close()
+        for job_id in job_ids:
+            self.submit(job_id)
+        if job_ids:
+            chat_logger.info(f"[导入任务] 恢复 {len(job_ids)} 个未完成任务")
+        return len(job_ids)
+
+    def _sweep_loop(self, stop: threading.Event) -> None:
+        while not stop.wait(_SWEEP_INTERVAL):
+            try:
+                self._sweep()
+            except Exception as e:
+                chat_logger.error(f"[导入任务] 恢复失败: {e}")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._sweeper_stop is not None:
+                self._sweeper_stop.set()
+                self._sweeper_stop = None
+            if self._executor is not None:
+                # 未开始的任务保持 pending，下次启动时恢复
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            self._queued.clear()
+
+    # ---------- 任务执行 ----------
+
+    def _run(self, job_id: int) -> None:
+        with self._lock:
+            self._queued.discard(job_id)
+        db = SessionLocal()
+        try:
+            if not crud.claim_ingestion_job(db, job_id):
+                return  # 已被其他 worker 领取或已完成
+            job = crud.get_ingestion_job(db, job_id)
+            stop_heartbeat = self._start_heartbeat(job_id)
+            try:
+                self._process(db, job)
+            except Exception as e:
+                message = str(e) if isinstance(e, IngestionError) else f"导入失败: {e}"
+                chat_logger.error(f"[导入任务 {job_id}] {message}")
+                db.rollback()
+                crud.update_ingestion_job(
+                    db, job_id,
+                    status="failed",
+                    error=message,
+                    finished_at=datetime.utcnow(),
+                )
+                # 导入失败，释放任务持有的文件引用
+                if not (isinstance(e, IngestionCancelled) and e.blob_released):
+                    blob_store.release(db, job.file_path, remove_unmanaged=True)
+            finally:
+                stop_heartbeat.set()
+        finally:
+            db.close()
+
+    def _start_heartbeat(self, job_id: int) -> threading.Event:
+        stop = threading.Event()
+
+        def beat() -> None:
+            while not stop.wait(_HEARTBEAT_INTERVAL):
+                hb_db = SessionLocal()
+                try:
+                    crud.update_ingestion_job(hb_db, job_id)
+                except Exception:
+                    pass
+                finally:
+                    hb_db.close()
+
+        threading.Thread(target=beat, name=f"ingestion-heartbeat-{job_id}", daemon=True).start()
+        return stop
+
+    def _process(self, db, job) -> None:
+        from app.utils.document_parser import iter_text_from_file, set_image_recognition_callback
+
+        # 提交后 job 会过期重新加载：知识库被删除时 kb_id 已被置空，这里记下领取时的值
+        kb_id = job.kb_id
+        if job.document_id is not None:
+            # 上次执行中断时留下的部分文档（文件引用仍归任务所有，删除文档不释放）
+            crud.delete_knowledge_document(db, job.document_id)
+        crud.update_ingestion_job(db, job.id, stage="extracting", progress=5)
+        ext = os.path.splitext(job.file_name)[1].lower()
+        # 解析结果按文件内容缓存；使用视觉模型时结果依赖模型，单独成一类。
+        # 流式抽取的分段格式与对话附件的 extract_text_from_file（kind "text"）不同，不能共用条目
+        cache_kind = "text-stream"
+        if job.vision_model and (job.extract_images or ext in IMAGE_EXTENSIONS):
+            set_image_recognition_callback(build_vision_callback(db, job.vision_model))
+            cache_kind = f"text-stream+vision:{job.vision_model}"
+
+        preview: List[str] = []
+        preview_len = 0
+
+        def pieces() -> Iterator[str]:
+            # 1. 流式抽取文本（可选识别图片），顺带保留开头一段作为文档预览
+            nonlocal preview_len
+            try:
+                for piece in extraction_cache.iter_or_extract(
+                    job.file_path, cache_kind,
+                    lambda: iter_text_from_file(job.file_path, extract_images=bool(job.extract_images)),
+                ):
+                    if preview_len < _PREVIEW_CHARS:
+                        preview.append(piece[:_PREVIEW_CHARS - preview_len])
+                        preview_len += len(preview[-1])
+                    yield piece
+            except ImportError as e:
+                raise IngestionError(f"缺少依赖库: {e}")
+            except ValueError as e:
+                raise IngestionError(str(e))
+            except Exception as e:
+                raise IngestionError(f"文件解析失败: {e}")
+
+        # 使用配置了该向量模型的 Provider 的独立客户端
+        embedding_manager = provider_registry.embedding_client(db, job.embedding_model)
+
+        progress_lock = threading.Lock()
+        window_size = settings.EMBEDDING_BATCH_MAX_ITEMS * settings.EMBEDDING_CONCURRENCY * _WINDOW_BATCHES
+        doc_id: Optional[int] = None
+        stored = 0   # 已写入的段落数
+        seen = 0     # 已切分出的段落数（总数在读完文件前未知）
+
+        def check_cancelled() -> None:
+            if kb_id is not None and crud.get_knowledge_base(db, kb_id) is None:
+                gone = doc_id is not None and crud.get_knowledge_document(db, doc_id) is None
+                raise IngestionCancelled("知识库已被删除，导入已取消。", blob_released=gone)
+            if doc_id is not None and crud.get_knowledge_document(db, doc_id) is None:
+                raise IngestionCancelled("文档已被删除，导入已取消。", blob_released=True)
+
+        def on_progress(done: int, total: int) -> None:
+            with progress_lock:
+                progress_db = SessionLocal()
+                try:
+                    crud.update_ingestion_job(
+                        progress_db, job.id,
+                        chunks_done=stored + done,
+                        progress=25 + int(65 * (stored + done) / max(seen, 1)),
+                    )
+                finally:
+                    progress_db.close()
+
+        try:
+            # 2. 切分段落，每攒够一个窗口就向量化并写入
+            for window in _windows(iter_paragraphs(pieces()), window_size):
+                check_cancelled()
+                seen += len(window)
+                crud.update_ingestion_job(db, job.id, stage="embedding", chunks_total=seen)
+
+                # 3. 生成向量：按 token 分批、并发请求、失败重试
+                try:
+                    embeddings = embed_texts(
+                        window,
+                        lambda batch: embedding_manager.create_embedding(batch, model=job.embedding_model),
+                        on_progress=on_progress,
+                    )
+                except Exception as e:
+                    raise IngestionError(f"向量生成失败: {e}，文件未加入知识库。")
+                if not embeddings or len(embeddings) != len(window):
+                    raise IngestionError("向量生成失败或数量不匹配，文件未加入知识库。")
+
+                # 4. 写入 DB；任一窗口失败时整篇文档回滚删除
+                crud.update_ingestion_job(db, job.id, stage="storing")
+                check_cancelled()
+                if doc_id is None:
+                    doc_id = crud.create_knowledge_document(
+                        db,
+                        kb_id=kb_id,
+                        file_name=job.file_name,
+                        file_path=job.file_path,
+                        content="\n".join(preview)[:_PREVIEW_CHARS],
+                        embedding_model=job.embedding_model,
+                    ).id
+                    # 立即记录到任务上：进程中断后恢复执行时据此删除这份部分文档
+                    crud.update_ingestion_job(db, job.id, document_id=doc_id)
+                chunks_data = [
+                    (stored + offset, para, emb)
+                    for offset, (para, emb) in enumerate(zip(window, embeddings))
+                ]
+                crud.create_knowledge_chunks(db, document_id=doc_id, chunks=chunks_data)
+                stored += len(window)
+            check_cancelled()
+        except Exception:
+            if doc_id is not None:
+                try:
+                    crud.delete_knowledge_document(db, doc_id)
+                except Exception:
+                    db.rollback()
+            raise
+        finally:
+            # 清理回调
+            set_image_recognition_callback(None)
+
+        if doc_id is None:
+            raise IngestionError("文件中未检测到有效文本内容。")
+
+        crud.update_ingestion_job(
+            db, job.id,
+            status="succeeded",
+            stage="done",
+            progress=100,
+            document_id=doc_id,
+            chunks_total=stored,
+            chunks_done=stored,
+            finished_at=datetime.utcnow(),
+        )
+        chat_logger.info(f"[导入任务 {job.id}] {job.file_name} 完成，{stored} 个片段")
+
+
+# 全局导入线程池
+ingestion_worker = IngestionWorker(settings.INGESTION_MAX_WORKERS)
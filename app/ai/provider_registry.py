@@ -0,0 +1,134 @@
+# app/ai/provider_registry.py
+"""
+Provider 注册表
+缓存数据库中 Provider 配置的只读快照，并按 Provider 创建独立的 AIManager 客户端。
+
+处理请求时不再修改全局 AIManager 的 Provider，而是为每个会话 / 视觉识别 / 向量检索各自创建客户端并显式传递，
+线程池中并发处理的多个对话不会再互相串用 API Key 和地址。
+- 快照在 PROVIDER_CACHE_TTL_SECONDS 内复用，本进程通过 /providers 接口修改时调用 invalidate() 立即失效；
+- 快照是不可变的普通对象，可以在线程之间共享，也不依赖创建它的数据库会话。
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.ai.ai_manager import AIManager
+from app.core.config import settings
+from app.db import crud
+
+
+class ProviderSnapshot(NamedTuple):
+    id: int
+    name: str
+    api_base: str
+    api_key: str
+    default_model: str
+    models: Tuple[str, ...]            # 旧的逗号分隔模型列表
+    models_config: Dict[str, Any]      # 模型名 -> 功能标记（vision 等）
+    is_default: bool
+
+    def has_model(self, model: str) -> bool:
+        return model in self.models_config or model in self.models
+
+    def capabilities(self, model: str) -> Dict[str, Any]:
+        caps = self.models_config.get(model)
+        return caps if isinstance(caps, dict) else {}
+
+
+def _snapshot(provider) -> ProviderSnapshot:
+    try:
+        config = json.loads(provider.models_config) if provider.models_config else {}
+    except (TypeError, ValueError):
+        config = {}
+    models = tuple(m.strip() for m in (provider.models or "").split(",") if m.strip())
+    return ProviderSnapshot(
+        id=provider.id,
+        name=provider.name,
+        api_base=provider.api_base,
+        api_key=provider.api_key or "",
+        default_model=provider.default_model,
+        models=models,
+        models_config=config if isinstance(config, dict) else {},
+        is_default=bool(provider.is_default),
+    )
+
+
+class ProviderRegistry:
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._providers: Optional[List[ProviderSnapshot]] = None
+        self._loaded_at = 0.0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._providers = None
+
+    def list(self, db: Session) -> List[ProviderSnapshot]:
+        """全部 Provider（按 id 升序），过期时从数据库重新加载"""
+        with self._lock:
+            if self._providers is not None and time.monotonic() - self._loaded_at < self.ttl_seconds:
+                return self._providers
+        providers = [_snapshot(p) for p in crud.list_providers(db)]
+        with self._lock:
+            self._providers = providers
+            self._loaded_at = time.monotonic()
+        return providers
+
+    def get(self, db: Session, provider_id: Optional[int]) -> Optional[ProviderSnapshot]:
+        if provider_id is None:
+            return None
+        for provider in self.list(db):
+            if provider.id == provider_id:
+                return provider
+        return None
+
+    def first(self, db: Session) -> Optional[ProviderSnapshot]:
+        providers = self.list(db)
+        return providers[0] if providers else None
+
+    def find_by_model(self, db: Session, model: Optional[str]) -> Optional[ProviderSnapshot]:
+        """查找配置了该模型的 Provider（models_config 优先，其次旧的 models 列表）"""
+        if not model:
+            return None
+        providers = self.list(db)
+        for provider in providers:
+            if model in provider.models_config:
+                return provider
+        for provider in providers:
+            if model in provider.models:
+                return provider
+        return None
+
+    def embedding_models(self, db: Session) -> List[str]:
+        """Provider 的 models_config 中配置的向量模型（模型名包含 embed）"""
+        names: List[str] = []
+        for provider in self.list(db):
+            for model in provider.models_config:
+                if "embed" in model.lower() and model not in names:
+                    names.append(model)
+        return names
+
+    def embedding_client(self, db: Session, model: Optional[str]) -> AIManager:
+        """向量模型所属 Provider 的客户端；模型只在 .env 中配置时退回第一个 Provider（与视觉模型一致）"""
+        return self.client(self.find_by_model(db, model) or self.first(db))
+
+    @staticmethod
+    def client(provider: Optional[ProviderSnapshot], default_model: Optional[str] = None) -> AIManager:
+        """为 Provider 创建独立的客户端；provider 为 None 时使用 .env 的全局默认"""
+        if provider is None:
+            return AIManager.for_provider(default_model=default_model)
+        return AIManager.for_provider(
+            api_base=provider.api_base,
+            api_key=provider.api_key,
+            default_model=default_model or provider.default_model,
+        )
+
+
+# 全局注册表实例
+provider_registry = ProviderRegistry(ttl_seconds=settings.PROVIDER_CACHE_TTL_SECONDS)
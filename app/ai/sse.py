@@ -0,0 +1,127 @@
+# app/ai/sse.py
+"""
+Provider 流式响应（Server-Sent Events）的增量解析
+直接处理网络读到的原始字节块，按 SSE 规范拆分事件，只取出 data 字段交给调用方：
+
+- 行结束符支持 \n、\r\n、\r，块边界可以落在任意位置（包括 \r\n 中间和 UTF-8 多字节字符中间）；
+- 一个事件的多行 data 以 \n 连接，空行结束一个事件；以 ':' 开头的注释行（心跳）忽略；
+- event / id / retry 字段对 chat/completions 没有意义，直接忽略；
+- 兼容不带 "data:" 前缀、每行一个 JSON 的非标准流。
+
+JSON 解析优先使用 orjson（未安装时使用标准库 json）。
+"""
+from __future__ import annotations
+
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional
+
+try:
+    import orjson
+    loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    loads = json.loads
+    JSON_BACKEND = "json"
+
+DONE = b"[DONE]"
+
+
+class SSEDecoder:
+    """增量 SSE 解析器：feed() 接收字节块，返回其中已完整的事件的 data（bytes）"""
+
+    def __init__(self) -> None:
+        self._buffer = b""
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        if not chunk:
+            return []
+        buffer = self._buffer + chunk
+        if b"\r" in buffer:
+            # 末尾的 \r 可能是 \r\n 的前半，留到下一块再处理
+            tail = b""
+            if buffer.endswith(b"\r"):
+                buffer, tail = buffer[:-1], b"\r"
+            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n") + tail
+        lines = buffer.split(b"\n")
+        # 最后一段没有行结束符，是不完整的行
+        self._buffer = lines.pop()
+        events: List[bytes] = []
+        for line in lines:
+            self._line(line, events)
+        return events
+
+    def flush(self) -> List[bytes]:
+        """流结束：处理最后一行，并把没有以空行结束的事件也交出去"""
+        events: List[bytes] = []
+        if self._buffer:
+            line, self._buffer = self._buffer.rstrip(b"\r"), b""
+            self._line(line, events)
+        self._dispatch(events)
+        return events
+
+    def _dispatch(self, events: List[bytes]) -> None:
+        if self._data:
+            events.append(self._data[0] if len(self._data) == 1 else b"\n".join(self._data))
+            self._data = []
+
+    def _line(self, line: bytes, events: List[bytes]) -> None:
+        if not line:
+            self._dispatch(events)
+            return
+        if line.startswith(b"data:"):
+            value = line[5:]
+            self._data.append(value[1:] if value.startswith(b" ") else value)
+        elif line.startswith(b":"):
+            return
+        elif line.startswith((b"{", b"[")):
+            # 非标准：不带 data: 前缀的 JSON 行，各自作为一个事件
+            self._dispatch(events)
+            events.append(line)
+        elif line == b"data":
+            self._data.append(b"")
+        # 其他字段（event / id / retry）忽略
+
+
+def iter_sse_data(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_sse_data(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for data in decoder.feed(chunk):
+            yield data
+    for data in decoder.flush():
+        yield data
+
+
+def decode_json_events(data: bytes) -> List[dict]:
+    """
+    把一个事件的 data 解析为 JSON 对象列表，无法解析时返回空列表。
+    有的代理在 data 行之间不输出空行，多行 data 会被拼成一个事件，此时逐行解析。
+    """
+    try:
+        obj = loads(data)
+    except ValueError:
+        if b"\n" not in data:
+            return []
+        objs = []
+        for line in data.split(b"\n"):
+            obj = _loads_or_none(line.strip())
+            if isinstance(obj, dict):
+                objs.append(obj)
+        return objs
+    return [obj] if isinstance(obj, dict) else []
+
+
+def _loads_or_none(data: bytes) -> Optional[object]:
+    if not data or data == DONE:
+        return None
+    try:
+        return loads(data)
+    except ValueError:
+        return None
@@ -0,0 +1,375 @@
+# app/ai/tool_call_stream.py
+"""
+流式对话中 XML 工具调用（<function_calls> / <| DSML | function_calls> 等）的增量检测
+深度思考 + 工具模式下，模型可能在正文或思考内容中直接输出 XML 形式的工具调用，
+这部分内容不能推给前端，需要收集起来解析执行。
+
+旧实现每收到一个片段都要把缓冲区整体 join 一遍，再用正则扫描整个缓冲区，
+回复越长越慢（O(n²)）。这里改为状态机：每个片段只扫描一次。
+
+- 开始 / 结束标签用一个小 NFA 匹配，语义与 FUNCTION_CALLS_OPEN_RE / FUNCTION_CALLS_CLOSE_RE 相同。
+  标签中只有开头是 '<'，因此任意时刻最多只有一个候选匹配（从最后一个 '<' 开始），
+  候选失效后直接用 str.find 跳到下一个 '<'；
+- "最后一个 '<' 之后的内容是否可能是标签开头"只取前几个字符判断，随片段增量更新；
+- 输出（正文 / 思考 / 思考结束事件）与旧实现逐字节一致，回归语料见 benchmarks/bench_tool_call_stream.py。
+"""
+from __future__ import annotations
+
+import re
+from typing import Callable, Dict, FrozenSet, List, Tuple, Union
+
+FUNCTION_CALLS_OPEN_RE = re.compile(r'<[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', re.IGNORECASE)
+FUNCTION_CALLS_CLOSE_RE = re.compile(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', re.IGNORECASE)
+
+# 输出事件：("text", 正文) / ("thinking", 思考片段) / ("thinking_end", 完整思考内容)
+FilterEvent = Tuple[str, str]
+
+# 正文中"可能是工具调用开始"的标签（去掉空格和换行、转小写后比较）
+_CONTENT_TAGS = ("<function_calls>", "<|dsml|function_calls>")
+# 思考内容中的判断更宽松：'<'、'<d'，或以 '<|'、'<f'、'<ds' 开头都继续缓冲
+_THINKING_TAG_HEADS = ("<|", "<f", "<ds")
+# 只需要 '<' 之后的前若干个字符（比最长的标签多一个即可判断）
+_HEAD_LIMIT = max(len(tag) for tag in _CONTENT_TAGS) + 1
+
+
+_CONTENT_TAG_PREFIXES = frozenset(tag[:i] for tag in _CONTENT_TAGS for i in range(1, len(tag)))
+
+
+def _is_content_tag_prefix(head: str) -> bool:
+    return head in _CONTENT_TAG_PREFIXES
+
+
+def _is_thinking_tag_prefix(head: str) -> bool:
+    return head in ("<", "<d") or head.startswith(_THINKING_TAG_HEADS)
+
+
+# ---------- 标签 NFA ----------
+
+# re.IGNORECASE 下与 ASCII 字母互相匹配的非 ASCII 字符
+_CASE_SPECIALS = "İıſK"
+
+
+def _literal(text: str) -> List[Tuple[str, FrozenSet[str]]]:
+    tokens = []
+    for c in text:
+        candidates = {c, c.lower(), c.upper(), *_CASE_SPECIALS}
+        chars = frozenset(ch for ch in candidates if re.fullmatch(re.escape(c), ch, re.IGNORECASE))
+        tokens.append(("char", chars))
+    return tokens
+
+
+def _is_space(ch: str) -> bool:
+    return ch.isspace()
+
+
+def _is_space_or_pipe(ch: str) -> bool:
+    return ch == "|" or ch.isspace()
+
+
+def _function_calls_tag(lead: str):
+    """
+    按 <lead>[\\s|]*(?:DSML\\s*\\|)?\\s*(?:antml:)?function_calls\\s*> 生成 token 序列，
+    返回 (tokens, 可选分组的 (起点, 终点) 列表)
+    """
+    tokens: List[Tuple[str, Union[FrozenSet[str], Callable[[str], bool]]]] = _literal(lead)
+    tokens.append(("star", _is_space_or_pipe))
+    dsml_start = len(tokens)
+    tokens += _literal("dsml") + [("star", _is_space)] + _literal("|")
+    dsml_end = len(tokens)
+    tokens.append(("star", _is_space))
+    antml_start = len(tokens)
+    tokens += _literal("antml:")
+    antml_end = len(tokens)
+    tokens += _literal("function_calls") + [("star", _is_space)] + _literal(">")
+    return tokens, [(dsml_start, dsml_end), (antml_start, antml_end)]
+
+
+class _TagPattern:
+    """标签的 NFA：状态为 token 下标，下标等于 token 数时表示匹配完成"""
+
+    def __init__(self, lead: str) -> None:
+        self.tokens, groups = _function_calls_tag(lead)
+        self.accept = len(self.tokens)
+        skips = dict(groups)
+        closure: List[FrozenSet[int]] = [frozenset()] * (self.accept + 1)
+        for i in range(self.accept, -1, -1):
+            states = {i}
+            if i < self.accept and self.tokens[i][0] == "star":
+                states |= closure[i + 1]
+            if i in skips:
+                states |= closure[skips[i]]
+            closure[i] = frozenset(states)
+        self.closure = closure
+        # 吃掉开头的 '<' 之后的状态
+        self.initial = closure[1]
+        self.relevant = frozenset(ch for kind, arg in self.tokens if kind == "char" for ch in arg)
+        self._cache: Dict[Tuple[FrozenSet[int], str], FrozenSet[int]] = {}
+
+    def step(self, states: FrozenSet[int], ch: str) -> FrozenSet[int]:
+        if ch not in self.relevant and not ch.isspace():
+            return frozenset()
+        key = (states, ch)
+        nxt = self._cache.get(key)
+        if nxt is None:
+            result = set()
+            for i in states:
+                if i == self.accept:
+                    continue
+                kind, arg = self.tokens[i]
+                if kind == "char":
+                    if ch in arg:
+                        result |= self.closure[i + 1]
+                elif arg(ch):
+                    result |= self.closure[i]
+            nxt = self._cache[key] = frozenset(result)
+        return nxt
+
+
+_OPEN_TAG = _TagPattern("<")
+_CLOSE_TAG = _TagPattern("</")
+
+
+class _TagMatcher:
+    """在追加的文本流中查找第一个完整标签，返回其起始位置（流中的绝对位置）"""
+
+    def __init__(self, pattern: _TagPattern) -> None:
+        self.pattern = pattern
+        self.reset()
+
+    def reset(self) -> None:
+        self._states: FrozenSet[int] = frozenset()
+        self._start = -1
+
+    def feed(self, text: str, offset: int) -> int:
+        pattern = self.pattern
+        states = self._states
+        i, n = 0, len(text)
+        while i < n:
+            if not states:
+                i = text.find("<", i)
+                if i < 0:
+                    break
+                self._start = offset + i
+                states = pattern.initial
+                i += 1
+                continue
+            ch = text[i]
+            if ch == "<":
+                # 旧候选失效，由下一轮从这个 '<' 开始新的候选
+                states = frozenset()
+                continue
+            states = pattern.step(states, ch)
+            i += 1
+            if pattern.accept in states:
+                self._states = frozenset()
+                return self._start
+        self._states = states
+        return -1
+
+
+class _TagBuffer:
+    """
+    待输出内容的缓冲区：记录最后一个 '<' 的位置和其后的前几个字符（转小写、去掉空格和换行），
+    并增量查找工具调用开始标签。
+    """
+
+    def __init__(self) -> None:
+        self._parts: List[str] = []
+        self._base = 0  # 缓冲区第一个字符在整个流中的位置
+        self._end = 0
+        self._open = _TagMatcher(_OPEN_TAG)
+        self._last_lt = -1
+        self.head = ""
+
+    def __bool__(self) -> bool:
+        return self._end > self._base
+
+    @property
+    def has_lt(self) -> bool:
+        return self._last_lt >= 0
+
+    @property
+    def last_lt(self) -> int:
+        """最后一个 '<' 在缓冲区中的位置"""
+        return self._last_lt - self._base
+
+    def append(self, text: str) -> int:
+        """追加片段；出现完整的开始标签时返回其在缓冲区中的位置，否则返回 -1"""
+        offset = self._end
+        self._parts.append(text)
+        self._end += len(text)
+
+        pos = text.rfind("<")
+        if pos >= 0:
+            self._last_lt = offset + pos
+            self.head = _normalize(text[pos:])[:_HEAD_LIMIT]
+        elif self._last_lt >= 0 and len(self.head) < _HEAD_LIMIT:
+            self.head = (self.head + _normalize(text))[:_HEAD_LIMIT]
+
+        start = self._open.feed(text, offset)
+        return start - self._base if start >= 0 else -1
+
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def keep_from(self, pos: int) -> None:
+        """丢弃 pos 之前的内容（已输出）"""
+        rest = self.text()[pos:]
+        self._parts = [rest] if rest else []
+        self._base += pos
+
+    def clear(self) -> None:
+        self._parts = []
+        self._base = self._end
+        self._open.reset()
+        self._last_lt = -1
+        self.head = ""
+
+
+def _normalize(text: str) -> str:
+    return text.lower().replace(" ", "").replace("\n", "")
+
+
+class XMLToolCallFilter:
+    """
+    一轮流式生成的 XML 工具调用过滤器。
+    feed_thinking() / feed_content() 处理每个思考 / 正文片段，finish() 在流结束后处理剩余内容，
+    都返回需要推给前端的事件列表。收集到完整工具调用时 has_xml_tool_call 为 True，
+    XML 内容见 xml_tool_buffer。
+    """
+
+    def __init__(self, enable_thinking: bool) -> None:
+        self.enable_thinking = enable_thinking
+        self.is_thinking_done = False
+        self.thinking_content: List[str] = []
+        self.in_xml_tool_call = False
+        self.has_xml_tool_call = False
+        self._xml_parts: List[str] = []
+        self._xml_end = 0
+        self._xml_close = _TagMatcher(_CLOSE_TAG)
+        self._pending = _TagBuffer()
+        self._thinking = _TagBuffer()
+
+    @property
+    def xml_tool_buffer(self) -> str:
+        if len(self._xml_parts) > 1:
+            self._xml_parts = ["".join(self._xml_parts)]
+        return self._xml_parts[0] if self._xml_parts else ""
+
+    def _start_xml(self, text: str) -> None:
+        self._xml_parts = []
+        self._xml_end = 0
+        self._xml_close.reset()
+        self._append_xml(text)
+
+    def _append_xml(self, text: str) -> None:
+        self._xml_parts.append(text)
+        offset = self._xml_end
+        self._xml_end += len(text)
+        if self._xml_close.feed(text, offset) >= 0:
+            self.in_xml_tool_call = False
+            self.has_xml_tool_call = True
+
+    def _end_thinking(self, events: List[FilterEvent]) -> None:
+        """开始输出正文时发送思考结束事件（只发送一次）"""
+        if self.enable_thinking and not self.is_thinking_done:
+            self.is_thinking_done = True
+            events.append(("thinking_end", "".join(self.thinking_content)))
+
+    def feed_thinking(self, thinking: str) -> List[FilterEvent]:
+        events: List[FilterEvent] = []
+        self.thinking_content.append(thinking)
+        buffer = self._thinking
+        if not buffer._parts and not self.in_xml_tool_call and "<" not in thinking:
+            # 常见情况：缓冲区为空且片段中没有 '<'，不可能出现标签
+            events.append(("thinking", thinking))
+            return events
+        fc_start = buffer.append(thinking)
+        if fc_start >= 0:
+            # 思考内容中出现工具调用：只把标签之前的内容作为思考结束
+            text = buffer.text()
+            before = text[:fc_start]
+            if before.strip():
+                events.append(("thinking_end", before))
+            self.is_thinking_done = True
+            self.in_xml_tool_call = True
+            buffer.clear()
+            self._start_xml(text[fc_start:])
+            return events
+
+        if self.in_xml_tool_call:
+            self._append_xml(thinking)
+            return events
+
+        if buffer.has_lt:
+            if _is_thinking_tag_prefix(buffer.head):
+                # 可能是 XML 开始，暂不发送
+                return events
+            # 只发送到最后一个 < 之前的内容，< 之后的继续缓冲
+            last_lt = buffer.last_lt
+            if last_lt > 0:
+                safe = buffer.text()[:last_lt]
+                if safe.strip():
+                    events.append(("thinking", safe))
+                buffer.keep_from(last_lt)
+        else:
+            events.append(("thinking", buffer.text()))
+            buffer.clear()
+        return events
+
+    def feed_content(self, delta: str) -> List[FilterEvent]:
+        events: List[FilterEvent] = []
+        if self.in_xml_tool_call:
+            self._append_xml(delta)
+            return events
+
+        buffer = self._pending
+        if not buffer._parts and "<" not in delta:
+            if self.enable_thinking and not self.is_thinking_done:
+                self._end_thinking(events)
+            events.append(("text", delta))
+            return events
+        fc_start = buffer.append(delta)
+        if fc_start >= 0:
+            self.in_xml_tool_call = True
+            text = buffer.text()
+            before = text[:fc_start]
+            if before.strip():
+                self._end_thinking(events)
+                events.append(("text", before))
+            buffer.clear()
+            self._start_xml(text[fc_start:])
+            return events
+
+        if buffer.has_lt and _is_content_tag_prefix(buffer.head):
+            # 可能是 XML 开始，继续等待更多内容
+            return events
+
+        self._end_thinking(events)
+        output = buffer.text()
+        if output:
+            events.append(("text", output))
+        buffer.clear()
+        return events
+
+    def finish(self) -> List[FilterEvent]:
+        """
+        流结束后处理剩余内容。思考缓冲区在流式阶段已逐段检测过开始标签，
+        这里不会再出现完整的开始标签，只需处理不完整的 XML 和待输出的正文。
+        """
+        events: List[FilterEvent] = []
+        if self.in_xml_tool_call:
+            # 结束标签在流式阶段已逐段检测，仍未结束说明 XML 不完整，作为普通内容输出
+            self._end_thinking(events)
+            events.append(("text", self.xml_tool_buffer))
+            self.in_xml_tool_call = False
+
+        if self._pending:
+            self._end_thinking(events)
+            output = self._pending.text()
+            if output:
+                events.append(("text", output))
+            self._pending.clear()
+        return events
@@ -7,6 +7,7 @@ from sqlalchemy.orm import Session
 
 from app.db import crud
 from app.db.database import SessionLocal
+from app.db.fulltext import looks_like_identifier, reciprocal_rank_fusion
 from app.core.config import settings
 
 # 已有：本地工具定义 -------------------------------------------------
@@ -96,19 +97,22 @@ def run_search_knowledge_tool(
     kb_id: Optional[int] = None,
     top_k: int = 5,
     embedding_fn=None,
+    embedding_model: Optional[str] = None,
     use_graph: bool = True,  # 新增：是否使用知识图谱增强
 ) -> str:
     """
     知识库检索工具的实际执行逻辑：
 
-    1. 使用 embedding_fn(query) 生成 query 向量；
-    2. 用 crud.search_knowledge_chunks 在 DB 中做向量相似度检索；
-    3. （可选）从知识图谱中获取相关实体和关系；
-    4. 把检索到的内容拼成一段说明文字返回给大模型。
+    1. （可选）从知识图谱中获取相关实体和关系；
+    2. 用 FTS5 全文索引做关键词检索（BM25）；
+    3. 使用 embedding_fn(query) 生成 query 向量，用 crud.search_knowledge_chunks 做向量检索；
+       查询是型号 / 错误码等标识符且全文检索已命中时跳过这一步；
+    4. 两路结果用 RRF 融合，拼成一段说明文字返回给大模型。
 
     embedding_fn: 一个函数，签名类似：
         embedding_fn([text: str]) -> List[List[float]]
     由调用方传入（通常是 AIManager.create_embedding）。
+    embedding_model: 生成 query 向量所用的模型，只在同一模型构建的向量中检索。
     """
     
     parts: List[str] = []
@@ -125,8 +129,20 @@ def run_search_knowledge_tool(
             except Exception:
                 pass  # 知识图谱检索失败时静默处理
         
-        # 2. 向量检索
-        if embedding_fn is not None:
+        # 2. 全文检索（FTS5 / BM25）
+        candidates = top_k * 2
+        lexical_ids: List[int] = []
+        try:
+            lexical_ids = crud.search_knowledge_chunk_ids_fulltext(
+                db, query, kb_id=kb_id, limit=candidates
+            )
+        except Exception:
+            pass  # 全文检索失败时静默处理
+
+        # 3. 向量检索；型号、错误码等标识符已被全文检索命中时，省去一次 embedding 调用
+        vector_ids: List[int] = []
+        skip_vector = bool(lexical_ids) and looks_like_identifier(query)
+        if embedding_fn is not None and not skip_vector:
             try:
                 embeddings = embedding_fn([query])
                 
@@ -137,24 +153,29 @@ def run_search_knowledge_tool(
                         db,
                         query_embedding=query_embedding,
                         kb_id=kb_id,
-                        top_k=top_k,
+                        embedding_model=embedding_model,
+                        top_k=candidates,
                     )
-                    
-                    if chunks:
-                        parts.append("\n【向量检索结果】")
-                        for idx, chunk in enumerate(chunks, start=1):
-                            doc = chunk.document
-                            kb_name = doc.kb.name if doc and doc.kb else settings.KNOWLEDGE_DEFAULT_KB_NAME
-                            parts.append(
-                                textwrap.dedent(
-                                    f"""
-                                    [片段 {idx} | 知识库: {kb_name} | 文档: {doc.file_name if doc else '未知'}]
-                                    {chunk.content}
-                                    """
-                                ).strip()
-                            )
+                    vector_ids = [chunk.id for chunk in chunks]
             except Exception:
                 pass  # 向量检索失败时静默处理
+
+        # 4. RRF 融合两路排序
+        fused = reciprocal_rank_fusion([lexical_ids, vector_ids])[:top_k]
+        chunks = crud.get_knowledge_chunks_by_ids(db, [chunk_id for chunk_id, _ in fused])
+        if chunks:
+            parts.append("\n【知识库检索结果】")
+            for idx, chunk in enumerate(chunks, start=1):
+                doc = chunk.document
+                kb_name = doc.kb.name if doc and doc.kb else settings.KNOWLEDGE_DEFAULT_KB_NAME
+                parts.append(
+                    textwrap.dedent(
+                        f"""
+                        [片段 {idx} | 知识库: {kb_name} | 文档: {doc.file_name if doc else '未知'}]
+                        {chunk.content}
+                        """
+                    ).strip()
+                )
     finally:
         db.close()
 
@@ -0,0 +1,126 @@
+# app/db/blob_store.py
+"""
+上传文件的内容寻址存储
+对话文件和知识库文件都按内容 SHA-256 保存到 uploads/blobs/<前两位>/<sha256><扩展名>：
+- 写入时边接收边计算哈希（见 open_writer / app.utils.upload_stream），先写临时文件，确认内容后再放到最终路径；
+- 相同内容（且扩展名相同）只保存一份，uploaded_files / knowledge_documents / ingestion_jobs
+  直接引用该路径，file_blobs 表记录引用计数；
+- 最后一个引用释放时删除文件；同名不同内容的文件不再互相覆盖。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, NamedTuple, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import crud
+from app.utils.logger import db_logger
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    path: str
+    size: int
+
+
+class BlobWriter:
+    """逐块写入上传内容并同步计算哈希；commit 后文件进入存储并持有一个引用"""
+
+    def __init__(self, store: "BlobStore", filename: str) -> None:
+        self.store = store
+        self.ext = os.path.splitext(filename)[1].lower()
+        self._sha = hashlib.sha256()
+        self.size = 0
+        os.makedirs(store.tmp_dir, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.tmp_dir, suffix=".part")
+        self._file: Optional[BinaryIO] = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> None:
+        self._sha.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self, db: Session) -> StoredBlob:
+        self._file.close()
+        self._file = None
+        sha256 = self._sha.hexdigest()
+        path = self.store.blob_path(sha256, self.ext)
+        try:
+            self.store._acquire(db, sha256, path, self.size, self._tmp_path)
+        finally:
+            self._discard_tmp()
+        return StoredBlob(sha256, path, self.size)
+
+    def abort(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._discard_tmp()
+
+    def _discard_tmp(self) -> None:
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class BlobStore:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.root, sha256[:2], f"{sha256}{ext}")
+
+    def is_managed(self, path: str) -> bool:
+        root = os.path.abspath(self.root)
+        return os.path.commonpath([root, os.path.abspath(path)]) == root
+
+    def open_writer(self, filename: str) -> BlobWriter:
+        return BlobWriter(self, filename)
+
+    def _acquire(self, db: Session, sha256: str, path: str, size: int, tmp_path: str) -> None:
+        for attempt in range(2):
+            try:
+                crud.acquire_file_blob(db, sha256=sha256, path=path, size=size)
+                # 在同一写事务内放置文件：并发的 release 要么已经删完，要么要等本事务提交
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp_path, path)
+                db.commit()
+                return
+            except IntegrityError:
+                # 另一个请求同时创建了同一条记录，重试时走计数 +1
+                db.rollback()
+                if attempt:
+                    raise
+            except BaseException:
+                db.rollback()
+                raise
+
+    def release(self, db: Session, path: Optional[str], *, remove_unmanaged: bool = False) -> None:
+        """
+        释放一个引用，最后一个引用释放时删除文件。
+        remove_unmanaged: 旧版本直接保存在 uploads/ 下的文件没有引用计数，为 True 时直接删除
+        """
+        if not path:
+            return
+        try:
+            remaining = crud.release_file_blob(db, path)
+            if remaining == 0 or (remaining is None and remove_unmanaged and not self.is_managed(path)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            db_logger.error(f"[文件存储] 释放 {path} 失败: {e}")
+
+
+# 全局存储实例
+blob_store = BlobStore(os.path.join(settings.UPLOAD_DIR, "blobs"))
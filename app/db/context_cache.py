@@ -0,0 +1,109 @@
+# app/db/context_cache.py
+"""
+对话上下文缓存
+每个对话缓存末尾最多 CONTEXT_HISTORY_MAX_MESSAGES 条消息的 (id, role, content)，
+不加载 message_events / thinking_content / vision_content 等大字段：
+
+- 首次读取：按 (conversation_id, id) 索引倒序 LIMIT 取末尾若干条；
+- 写入消息后只把该对话标记为需要刷新，下次读取时只查询 id 大于已缓存最大 id 的新消息并追加；
+- 删除对话时整条丢弃。
+
+缓存在进程内，按最近使用淘汰，最多保留 CONTEXT_CACHE_CONVERSATIONS 个对话。
+PostgreSQL 等多个节点共用的数据库上，其他节点写入的消息不会通知本进程，因此每次读取都做增量查询。
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import models
+
+
+class ContextMessage(NamedTuple):
+    """上下文只需要的消息字段（与 models.Message 同名，可直接交给 ContextManager）"""
+    id: int
+    role: str
+    content: str
+
+
+class _Entry:
+    __slots__ = ("messages", "last_id", "stale")
+
+    def __init__(self) -> None:
+        self.messages: List[ContextMessage] = []
+        self.last_id = 0
+        self.stale = True
+
+
+class ConversationContextCache:
+    def __init__(self, max_conversations: int, max_messages: int, always_refresh: bool = False) -> None:
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self.always_refresh = always_refresh
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+
+    def _load_tail(self, db: Session, conversation_id: int, after_id: int) -> List[ContextMessage]:
+        """id 大于 after_id 的消息中最新的 max_messages 条，按时间顺序返回"""
+        query = (
+            db.query(models.Message.id, models.Message.role, models.Message.content)
+            .filter(models.Message.conversation_id == conversation_id)
+        )
+        if after_id:
+            query = query.filter(models.Message.id > after_id)
+        rows = query.order_by(models.Message.id.desc()).limit(self.max_messages).all()
+        return [ContextMessage(row.id, row.role, row.content) for row in reversed(rows)]
+
+    def get_messages(self, db: Session, conversation_id: int) -> List[ContextMessage]:
+        """对话末尾的消息（按时间顺序，最多 max_messages 条）"""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                entry = self._entries[conversation_id] = _Entry()
+                while len(self._entries) > self.max_conversations:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(conversation_id)
+            if not entry.stale and not self.always_refresh:
+                return list(entry.messages)
+            # 先清除标记再查询：查询期间写入的消息会重新打上标记，下次读取时补上
+            entry.stale = False
+            after_id = entry.last_id
+
+        new_messages = self._load_tail(db, conversation_id, after_id)
+
+        with self._lock:
+            if self._entries.get(conversation_id) is not entry:
+                # 查询期间对话被删除或淘汰，不再写回
+                return new_messages
+            if new_messages and new_messages[-1].id > entry.last_id:
+                fresh = [m for m in new_messages if m.id > entry.last_id]
+                entry.messages = (entry.messages + fresh)[-self.max_messages:]
+                entry.last_id = entry.messages[-1].id
+            return list(entry.messages)
+
+    def mark_stale(self, conversation_id: int) -> None:
+        """对话写入了新消息：下次读取时增量加载"""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                entry.stale = True
+
+    def invalidate(self, conversation_id: int) -> None:
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+context_cache = ConversationContextCache(
+    settings.CONTEXT_CACHE_CONVERSATIONS,
+    settings.CONTEXT_HISTORY_MAX_MESSAGES,
+    always_refresh=not settings.DATABASE_URL.startswith("sqlite"),
+)
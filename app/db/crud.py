@@ -3,11 +3,17 @@ from __future__ import annotations
 
 import json
 from datetime import datetime
-from typing import List, Optional, Iterable, Tuple
+from typing import Dict, List, Optional, Iterable, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, insert, or_, select, text
+from sqlalchemy.orm import Session, load_only, selectinload
 
+from app.core.config import settings
 from app.db import models
+from app.db.context_cache import ContextMessage, context_cache
+from app.db.embedding_codec import encode_embedding
+from app.db.fulltext import CHUNKS_FTS, ENTITIES_FTS, build_match_query
+from app.db.vector_index import vector_index
 
 
 # ========= 项目 CRUD =========
@@ -90,7 +96,7 @@ def delete_project(db: Session, project_id: int) -> None:
 
 def get_conversations_by_project(db: Session, project_id: Optional[int]) -> List[models.Conversation]:
     """获取指定项目的对话，project_id=None 时获取未分类的对话"""
-    query = db.query(models.Conversation)
+    query = db.query(models.Conversation).options(selectinload(models.Conversation.project))
     if project_id is None:
         query = query.filter(models.Conversation.project_id.is_(None))
     else:
@@ -119,12 +125,48 @@ def get_conversation(db: Session, conversation_id: int) -> Optional[models.Conve
     return db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
 
 
-def get_conversations(db: Session, project_id: Optional[int] = None) -> List[models.Conversation]:
-    """获取对话列表，可按项目筛选"""
-    query = db.query(models.Conversation)
+def get_conversations(
+    db: Session,
+    project_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[bool, int]] = None,
+) -> List[models.Conversation]:
+    """
+    获取对话列表，可按项目筛选；置顶的在前，各自按 id 倒序，项目信息一次性预加载
+    
+    Args:
+        limit: 每页条数，None 表示不分页
+        after: 上一页最后一个对话的 (is_pinned, id)，返回排在它之后的对话（keyset 分页）
+    """
+    query = db.query(models.Conversation).options(selectinload(models.Conversation.project))
     if project_id is not None:
         query = query.filter(models.Conversation.project_id == project_id)
-    return query.order_by(models.Conversation.is_pinned.desc(), models.Conversation.id.desc()).all()
+    if after is not None:
+        pinned, last_id = after
+        later_in_group = and_(models.Conversation.is_pinned == pinned, models.Conversation.id < last_id)
+        if pinned:
+            query = query.filter(or_(later_in_group, models.Conversation.is_pinned == False))
+        else:
+            query = query.filter(later_in_group)
+    query = query.order_by(models.Conversation.is_pinned.desc(), models.Conversation.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def get_message_counts(db: Session, conversation_ids: List[int]) -> Dict[int, int]:
+    """一次 GROUP BY 统计多个对话的消息数"""
+    if not conversation_ids:
+        return {}
+    rows = (
+        db.query(models.Message.conversation_id, func.count(models.Message.id))
+        .filter(models.Message.conversation_id.in_(conversation_ids))
+        .group_by(models.Message.conversation_id)
+        .all()
+    )
+    counts = {conversation_id: 0 for conversation_id in conversation_ids}
+    counts.update(rows)
+    return counts
 
 
 def get_latest_conversation(db: Session) -> Optional[models.Conversation]:
@@ -163,6 +205,7 @@ def delete_conversation(db: Session, conversation_id: int) -> None:
     if conversation:
         db.delete(conversation)
         db.commit()
+    context_cache.invalidate(conversation_id)
 
 
 def update_conversation_title(db: Session, conversation_id: int, title: str) -> Optional[models.Conversation]:
@@ -237,6 +280,7 @@ def create_message(
     db.add(message)
     db.commit()
     db.refresh(message)
+    context_cache.mark_stale(conversation_id)
     return message
 
 
@@ -249,23 +293,67 @@ def get_messages(db: Session, conversation_id: int) -> List[models.Message]:
     )
 
 
-def get_context_messages(db: Session, conversation_id: int) -> List[models.Message]:
-    """获取用于上下文的消息 - 只返回完整的问答对（不包括最后一条未回复的用户消息）"""
-    messages = get_messages(db, conversation_id)
-    
-    if not messages:
-        return []
+def get_messages_page(
+    db: Session,
+    conversation_id: int,
+    before_id: Optional[int] = None,
+    limit: int = 50,
+) -> Tuple[List[Tuple[models.Message, bool]], bool]:
+    """
+    按 id 游标分页获取消息（每页取 before_id 之前最新的 limit 条，按时间顺序返回）
+    不加载消息详情字段（Message.DETAIL_FIELDS），只在 SQL 中判断是否有详情
+
+    Returns:
+        ([(message, has_details), ...], 是否还有更早的消息)
+    """
+    has_details = or_(
+        *(getattr(models.Message, field).isnot(None) for field in models.Message.DETAIL_FIELDS)
+    ).label("has_details")
+    query = (
+        db.query(models.Message, has_details)
+        .options(load_only(
+            models.Message.id,
+            models.Message.conversation_id,
+            models.Message.role,
+            models.Message.content,
+            models.Message.created_at,
+            models.Message.model,
+            models.Message.input_tokens,
+            models.Message.output_tokens,
+            models.Message.total_tokens,
+        ))
+        .filter(models.Message.conversation_id == conversation_id)
+    )
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    rows = query.order_by(models.Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    page = [(message, bool(details)) for message, details in rows[:limit]]
+    page.reverse()
+    return page, has_more
+
+
+def get_message(db: Session, conversation_id: int, message_id: int) -> Optional[models.Message]:
+    return (
+        db.query(models.Message)
+        .filter(models.Message.id == message_id, models.Message.conversation_id == conversation_id)
+        .first()
+    )
+
+
+def get_context_messages(db: Session, conversation_id: int) -> List[ContextMessage]:
+    """
+    获取用于上下文的消息 - 只返回完整的问答对（不包括最后一条未回复的用户消息）
+    只取对话末尾 CONTEXT_HISTORY_MAX_MESSAGES 条消息的 id / role / content，见 context_cache
+    """
+    messages = context_cache.get_messages(db, conversation_id)
     
-    # 找出完整的问答对
+    # 找出完整的问答对：用户消息紧跟着助手回复
     context = []
-    i = 0
-    while i < len(messages) - 1:  # 不包括最后一条
-        if messages[i].role == "user" and i + 1 < len(messages) and messages[i + 1].role == "assistant":
+    for i in range(len(messages) - 1):
+        if messages[i].role == "user" and messages[i + 1].role == "assistant":
             context.append(messages[i])
             context.append(messages[i + 1])
-            i += 2
-        else:
-            i += 1
     
     return context
 
@@ -326,6 +414,35 @@ def delete_uploaded_file(db: Session, file_id: int) -> None:
         db.commit()
 
 
+# ========= 上传文件存储（引用计数） =========
+# 以下两个函数只 flush 不提交：调用方在落盘 / 删除文件后再 commit，
+# 使引用计数与文件操作处于同一个写事务中，并发的上传和删除不会互相踩到。
+
+def acquire_file_blob(db: Session, *, sha256: str, path: str, size: int) -> models.FileBlob:
+    """引用计数 +1，不存在时创建记录"""
+    blob = db.query(models.FileBlob).filter(models.FileBlob.path == path).first()
+    if blob:
+        blob.ref_count += 1
+    else:
+        blob = models.FileBlob(sha256=sha256, path=path, size=size, ref_count=1)
+        db.add(blob)
+    db.flush()
+    return blob
+
+
+def release_file_blob(db: Session, path: str) -> Optional[int]:
+    """引用计数 -1，返回剩余引用数（归零时删除记录）；path 不在存储中时返回 None"""
+    blob = db.query(models.FileBlob).filter(models.FileBlob.path == path).first()
+    if not blob:
+        return None
+    blob.ref_count -= 1
+    remaining = blob.ref_count
+    if remaining <= 0:
+        db.delete(blob)
+    db.flush()
+    return max(remaining, 0)
+
+
 # ========= 新增：会话扩展（Provider 绑定 & 功能开关） =========
 
 def update_conversation_features(
@@ -473,12 +590,27 @@ def list_knowledge_bases(db: Session) -> List[models.KnowledgeBase]:
     return db.query(models.KnowledgeBase).order_by(models.KnowledgeBase.id.asc()).all()
 
 
+def _detach_ingestion_jobs(db: Session, *, kb_id: Optional[int] = None, document_ids=None) -> None:
+    """删除知识库 / 文档前把导入任务的引用置空，避免外键约束报错（PostgreSQL）或留下悬空 id"""
+    if document_ids is not None:
+        db.query(models.IngestionJob).filter(
+            models.IngestionJob.document_id.in_(document_ids)
+        ).update({models.IngestionJob.document_id: None}, synchronize_session=False)
+    if kb_id is not None:
+        db.query(models.IngestionJob).filter(
+            models.IngestionJob.kb_id == kb_id
+        ).update({models.IngestionJob.kb_id: None}, synchronize_session=False)
+
+
 def delete_knowledge_base(db: Session, kb_id: int) -> None:
     kb = get_knowledge_base(db, kb_id)
     if not kb:
         return
+    doc_ids = select(models.KnowledgeDocument.id).where(models.KnowledgeDocument.kb_id == kb_id)
+    _detach_ingestion_jobs(db, kb_id=kb_id, document_ids=doc_ids)
     db.delete(kb)
     db.commit()
+    vector_index.drop_kb(kb_id)
 
 
 def create_knowledge_document(
@@ -525,8 +657,17 @@ def delete_knowledge_document(db: Session, doc_id: int) -> None:
     doc = get_knowledge_document(db, doc_id)
     if not doc:
         return
+    chunk_ids = [
+        row[0]
+        for row in db.query(models.KnowledgeChunk.id)
+        .filter(models.KnowledgeChunk.document_id == doc_id)
+        .all()
+    ]
+    kb_id, embedding_model = doc.kb_id, doc.embedding_model
+    _detach_ingestion_jobs(db, document_ids=[doc_id])
     db.delete(doc)
     db.commit()
+    vector_index.remove_chunks(chunk_ids, kb_id=kb_id, embedding_model=embedding_model)
 
 
 def create_knowledge_chunks(
@@ -534,25 +675,56 @@ def create_knowledge_chunks(
     *,
     document_id: int,
     chunks: Iterable[Tuple[int, str, List[float]]],
-) -> List[models.KnowledgeChunk]:
+    batch_size: int = 1000,
+) -> List[int]:
     """
-    批量创建知识库 chunk。
+    批量创建知识库 chunk，返回与输入顺序一致的 chunk id。
     chunks: (chunk_index, content, embedding) 列表
+
+    按 batch_size 分批 executemany（INSERT ... RETURNING id），全部在同一个事务内提交，
+    不再逐行 add + refresh。
     """
-    created: List[models.KnowledgeChunk] = []
+    rows: List[dict] = []
+    vectors: List[List[float]] = []
     for idx, content, embedding in chunks:
-        kc = models.KnowledgeChunk(
-            document_id=document_id,
-            chunk_index=idx,
-            content=content,
-            embedding=json.dumps(embedding, ensure_ascii=False),
-        )
-        db.add(kc)
-        created.append(kc)
-    db.commit()
-    for kc in created:
-        db.refresh(kc)
-    return created
+        rows.append({
+            "document_id": document_id,
+            "chunk_index": idx,
+            "content": content,
+            "embedding": encode_embedding(embedding, settings.EMBEDDING_STORAGE_DTYPE),
+        })
+        vectors.append(embedding)
+    if not rows:
+        return []
+
+    table = models.KnowledgeChunk.__table__
+    dialect = db.get_bind().dialect
+    ids: List[int] = []
+    try:
+        if dialect.insert_executemany_returning_sort_by_parameter_order:
+            stmt = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+            for start in range(0, len(rows), batch_size):
+                ids.extend(db.execute(stmt, rows[start:start + batch_size]).scalars().all())
+        else:
+            # 不支持 RETURNING 的数据库：先批量插入，再按 chunk_index 取回 id
+            for start in range(0, len(rows), batch_size):
+                db.execute(insert(table), rows[start:start + batch_size])
+            id_by_index = dict(
+                db.query(models.KnowledgeChunk.chunk_index, models.KnowledgeChunk.id)
+                .filter(models.KnowledgeChunk.document_id == document_id)
+                .all()
+            )
+            ids = [id_by_index[row["chunk_index"]] for row in rows]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    # 同步内存向量索引
+    doc = get_knowledge_document(db, document_id)
+    if doc is not None:
+        vector_index.add(doc.kb_id, doc.embedding_model, ids, vectors)
+    return ids
 
 
 def list_chunks_by_document(
@@ -587,46 +759,173 @@ def list_all_chunks(
     return q.all()
 
 
-def _cosine_similarity(vec_a: List[float], vec_b: List[float]) -> float:
-    import math
-
-    if not vec_a or not vec_b or len(vec_a) != len(vec_b):
-        return 0.0
-
-    dot = sum(a * b for a, b in zip(vec_a, vec_b))
-    na = math.sqrt(sum(a * a for a in vec_a))
-    nb = math.sqrt(sum(b * b for b in vec_b))
-    if na == 0 or nb == 0:
-        return 0.0
-    return dot / (na * nb)
-
-
 def search_knowledge_chunks(
     db: Session,
     *,
     query_embedding: List[float],
     kb_id: Optional[int] = None,
+    embedding_model: Optional[str] = None,
     top_k: int = 5,
 ) -> List[models.KnowledgeChunk]:
     """
-    简易向量检索：在 Python 内做余弦相似度排序。
-    后续如果接入专门的向量库，可以只改这里的实现。
+    向量检索：由 vector_index 做余弦相似度 top-k（进程内矩阵，PostgreSQL 上为 pgvector），
+    再按排序结果取回 chunk 记录。
     """
-    all_chunks = list_all_chunks(db, kb_id=kb_id)
-    scored: List[Tuple[float, models.KnowledgeChunk]] = []
-
-    for chunk in all_chunks:
-        try:
-            emb = json.loads(chunk.embedding)
-            if not isinstance(emb, list):
-                continue
-            score = _cosine_similarity(query_embedding, emb)
-            scored.append((score, chunk))
-        except Exception:
-            continue
+    hits = vector_index.search(
+        db,
+        query_embedding=query_embedding,
+        kb_id=kb_id,
+        embedding_model=embedding_model,
+        top_k=top_k,
+    )
+    if not hits:
+        return []
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [c for _, c in scored[:top_k]]
+    return get_knowledge_chunks_by_ids(db, [chunk_id for chunk_id, _ in hits])
+
+
+def get_knowledge_chunks_by_ids(db: Session, ids: List[int]) -> List[models.KnowledgeChunk]:
+    """按给定顺序取回 chunk 记录（已删除的跳过）"""
+    if not ids:
+        return []
+    rows = (
+        db.query(models.KnowledgeChunk)
+        .filter(models.KnowledgeChunk.id.in_(ids))
+        .all()
+    )
+    by_id = {c.id: c for c in rows}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+# FTS 表是否存在（只缓存肯定结果，迁移后无需重启即可生效）
+_fts_tables_ready: set = set()
+
+
+def _fts_ready(db: Session, table: str) -> bool:
+    if table in _fts_tables_ready:
+        return True
+    if db.bind is None or db.bind.dialect.name != "sqlite":
+        return False
+    found = db.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"),
+        {"name": table},
+    ).first()
+    if found:
+        _fts_tables_ready.add(table)
+    return bool(found)
+
+
+def search_knowledge_chunk_ids_fulltext(
+    db: Session,
+    query: str,
+    *,
+    kb_id: Optional[int] = None,
+    limit: int = 20,
+) -> List[int]:
+    """
+    全文检索 chunk，按 BM25 排序返回 chunk_id。
+    没有 FTS5 索引（PostgreSQL、SQLite 不支持 trigram）或查询词都短于 3 个字符时返回空列表：
+    结果会与向量检索做 RRF 融合，不带排序的 LIKE 全表扫描既慢又会拉低融合后的排序。
+    """
+    match = build_match_query(query)
+    if match is None or not _fts_ready(db, CHUNKS_FTS):
+        return []
+    sql = (
+        f"SELECT f.rowid FROM {CHUNKS_FTS} f "
+        "JOIN knowledge_chunks c ON c.id = f.rowid "
+        "JOIN knowledge_documents d ON d.id = c.document_id "
+        f"WHERE {CHUNKS_FTS} MATCH :match"
+    )
+    params = {"match": match, "limit": limit}
+    if kb_id is not None:
+        sql += " AND d.kb_id = :kb_id"
+        params["kb_id"] = kb_id
+    sql += f" ORDER BY bm25({CHUNKS_FTS}) LIMIT :limit"
+    return [row[0] for row in db.execute(text(sql), params)]
+
+
+# ========= 知识库导入任务 CRUD =========
+
+def create_ingestion_job(
+    db: Session,
+    *,
+    kb_id: Optional[int],
+    file_name: str,
+    file_path: str,
+    embedding_model: str,
+    extract_images: bool = False,
+    vision_model: Optional[str] = None,
+) -> models.IngestionJob:
+    job = models.IngestionJob(
+        kb_id=kb_id,
+        file_name=file_name,
+        file_path=file_path,
+        embedding_model=embedding_model,
+        extract_images=extract_images,
+        vision_model=vision_model,
+        status="pending",
+        stage="queued",
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_ingestion_job(db: Session, job_id: int) -> Optional[models.IngestionJob]:
+    return db.query(models.IngestionJob).filter(models.IngestionJob.id == job_id).first()
+
+
+def list_ingestion_jobs(
+    db: Session,
+    kb_id: Optional[int] = None,
+    status: Optional[str] = None,
+    limit: int = 50,
+) -> List[models.IngestionJob]:
+    q = db.query(models.IngestionJob)
+    if kb_id is not None:
+        q = q.filter(models.IngestionJob.kb_id == kb_id)
+    if status is not None:
+        q = q.filter(models.IngestionJob.status == status)
+    return q.order_by(models.IngestionJob.id.desc()).limit(limit).all()
+
+
+def update_ingestion_job(db: Session, job_id: int, **fields) -> None:
+    """按字段更新任务状态 / 进度（updated_at 同时刷新，SSE 据此推送变化）"""
+    fields["updated_at"] = datetime.utcnow()
+    db.query(models.IngestionJob).filter(models.IngestionJob.id == job_id).update(
+        fields, synchronize_session=False
+    )
+    db.commit()
+
+
+def claim_ingestion_job(db: Session, job_id: int) -> bool:
+    """原子地把 pending 任务置为 running；多个 worker 进程同时恢复任务时只有一个能领取成功"""
+    now = datetime.utcnow()
+    claimed = (
+        db.query(models.IngestionJob)
+        .filter(models.IngestionJob.id == job_id, models.IngestionJob.status == "pending")
+        .update(
+            {"status": "running", "started_at": now, "updated_at": now, "error": None},
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return claimed == 1
+
+
+def requeue_stale_ingestion_jobs(db: Session, stale_before: datetime) -> int:
+    """把长时间没有进度更新的 running 任务（进程退出时中断）重新置为 pending"""
+    count = (
+        db.query(models.IngestionJob)
+        .filter(
+            models.IngestionJob.status == "running",
+            models.IngestionJob.updated_at < stale_before,
+        )
+        .update({"status": "pending", "stage": "queued"}, synchronize_session=False)
+    )
+    db.commit()
+    return count
 
 
 # ========= 新增：MCP服务器管理 CRUD =========
@@ -822,7 +1121,26 @@ def search_entities(
     kb_id: Optional[int] = None,
     limit: int = 10,
 ) -> List[models.KnowledgeEntity]:
-    """搜索实体（模糊匹配名称和描述）"""
+    """搜索实体（名称和描述）：优先走 FTS5 全文索引，短查询退回 LIKE 模糊匹配"""
+    match = build_match_query(query)
+    if match is not None and _fts_ready(db, ENTITIES_FTS):
+        sql = (
+            f"SELECT f.rowid FROM {ENTITIES_FTS} f "
+            "JOIN knowledge_entities e ON e.id = f.rowid "
+            f"WHERE {ENTITIES_FTS} MATCH :match"
+        )
+        params = {"match": match, "limit": limit}
+        if kb_id is not None:
+            sql += " AND e.kb_id = :kb_id"
+            params["kb_id"] = kb_id
+        sql += f" ORDER BY bm25({ENTITIES_FTS}) LIMIT :limit"
+        ids = [row[0] for row in db.execute(text(sql), params)]
+        if not ids:
+            return []
+        rows = db.query(models.KnowledgeEntity).filter(models.KnowledgeEntity.id.in_(ids)).all()
+        by_id = {e.id: e for e in rows}
+        return [by_id[i] for i in ids if i in by_id]
+
     q = db.query(models.KnowledgeEntity).filter(
         (models.KnowledgeEntity.name.ilike(f"%{query}%")) |
         (models.KnowledgeEntity.description.ilike(f"%{query}%"))
@@ -1,77 +1,178 @@
 # app/db/database.py
-import os
 import sqlite3
-from sqlalchemy import create_engine
+from typing import List, Tuple
+
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 from app.core.config import settings
 
-# SQLite 需要 check_same_thread=False
-connect_args = {}
-if settings.DATABASE_URL.startswith("sqlite"):
-    connect_args = {"check_same_thread": False}
+IS_SQLITE = settings.DATABASE_URL.startswith("sqlite")
+
+
+def _engine_options() -> dict:
+    if IS_SQLITE:
+        # SQLite 需要 check_same_thread=False
+        return {"connect_args": {"check_same_thread": False}}
+    # PostgreSQL 等服务端数据库：每个进程一个连接池。多节点部署时，
+    # 节点数 × worker 数 × (DB_POOL_SIZE + DB_MAX_OVERFLOW) 不能超过数据库的 max_connections
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        # 负载均衡 / 数据库重启后池中的连接可能已断开，取出时先探测
+        "pool_pre_ping": True,
+    }
+
+
+engine = create_engine(settings.DATABASE_URL, **_engine_options())
+
+
+def sqlite_pragmas() -> List[Tuple[str, object]]:
+    """按配置生成每个 SQLite 连接要执行的 PRAGMA（见 config 中的 SQLITE_* 配置）"""
+    if not settings.SQLITE_PRAGMAS_ENABLED:
+        return []
+    pragmas = [
+        # busy_timeout 放在最前：切换 journal_mode 时如果有其他连接持有锁，也会等待而不是直接报错
+        ("busy_timeout", settings.SQLITE_BUSY_TIMEOUT_MS),
+        ("journal_mode", settings.SQLITE_JOURNAL_MODE),
+        ("synchronous", settings.SQLITE_SYNCHRONOUS),
+        ("mmap_size", settings.SQLITE_MMAP_SIZE),
+        ("cache_size", settings.SQLITE_CACHE_SIZE),
+        ("temp_store", settings.SQLITE_TEMP_STORE),
+    ]
+    return [(name, value) for name, value in pragmas if value != ""]
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None) -> None:
+    """engine 的 connect 事件：新建的 SQLite 连接执行 sqlite_pragmas()"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in sqlite_pragmas():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    connect_args=connect_args,
-)
+if IS_SQLITE:
+    event.listen(engine, "connect", apply_sqlite_pragmas)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
 
+# 旧版本数据库缺少的列：(表, 列, 列定义)
+_ADDED_COLUMNS = [
+    ("providers", "models_config", "TEXT"),
+    ("messages", "tool_calls", "TEXT"),
+    ("messages", "thinking_content", "TEXT"),
+    ("messages", "vision_content", "TEXT"),
+    ("messages", "message_events", "TEXT"),
+    ("uploaded_files", "processed", "INTEGER DEFAULT 0"),
+]
+
+# 后来增加的索引：(索引名, 表, 列)，新建的数据库由模型中的 Index 定义创建
+_ADDED_INDEXES = [
+    # 对话列表按 (is_pinned, id) 做 keyset 分页
+    ("ix_conversations_is_pinned_id", "conversations", "is_pinned, id"),
+    ("ix_conversations_project_id_is_pinned_id", "conversations", "project_id, is_pinned, id"),
+    # 上下文缓存按 (conversation_id, id) 倒序 LIMIT 读取
+    ("ix_messages_conversation_id_id", "messages", "conversation_id, id"),
+]
+
+
 def migrate_database():
-    """数据库迁移 - 添加新列（自动执行）"""
-    db_path = settings.DATABASE_URL.replace("sqlite:///", "")
-    
-    if not os.path.exists(db_path):
-        return  # 数据库不存在，跳过迁移
-    
+    """数据库迁移 - 添加新列、补建索引（自动执行，SQLite / PostgreSQL 通用）"""
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # 检查并添加 models_config 列到 providers 表
-        cursor.execute("PRAGMA table_info(providers)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'models_config' not in columns:
-            cursor.execute("ALTER TABLE providers ADD COLUMN models_config TEXT")
-            conn.commit()
-        
-        # 检查并添加 tool_calls、thinking_content 和 vision_content 列到 messages 表
-        cursor.execute("PRAGMA table_info(messages)")
-        msg_columns = [col[1] for col in cursor.fetchall()]
+        inspector = inspect(engine)
+        tables = set(inspector.get_table_names())
+        if not tables:
+            return  # 新数据库，由 create_all 建表，无需迁移
         
-        if 'tool_calls' not in msg_columns:
-            cursor.execute("ALTER TABLE messages ADD COLUMN tool_calls TEXT")
-            conn.commit()
+        # 多个节点同时启动时可能并发迁移，PostgreSQL 使用 IF NOT EXISTS 避免重复加列报错
+        add_column = "ADD COLUMN" if IS_SQLITE else "ADD COLUMN IF NOT EXISTS"
+        with engine.begin() as conn:
+            columns = {}
+            for table, column, ddl in _ADDED_COLUMNS:
+                if table not in tables:
+                    continue
+                if table not in columns:
+                    columns[table] = {col["name"] for col in inspector.get_columns(table)}
+                if column not in columns[table]:
+                    conn.execute(text(f"ALTER TABLE {table} {add_column} {column} {ddl}"))
+            
+            # keyset 分页要求置顶标记不为 NULL
+            if "conversations" in tables:
+                conn.execute(
+                    text("UPDATE conversations SET is_pinned = :unpinned WHERE is_pinned IS NULL"),
+                    {"unpinned": False},
+                )
+            
+            for name, table, index_columns in _ADDED_INDEXES:
+                if table in tables:
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({index_columns})"))
         
-        if 'thinking_content' not in msg_columns:
-            cursor.execute("ALTER TABLE messages ADD COLUMN thinking_content TEXT")
-            conn.commit()
-        
-        if 'vision_content' not in msg_columns:
-            cursor.execute("ALTER TABLE messages ADD COLUMN vision_content TEXT")
-            conn.commit()
-        
-        if 'message_events' not in msg_columns:
-            cursor.execute("ALTER TABLE messages ADD COLUMN message_events TEXT")
-            conn.commit()
-        
-        # 检查并添加 processed 列到 uploaded_files 表
-        cursor.execute("PRAGMA table_info(uploaded_files)")
-        file_columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'processed' not in file_columns:
-            cursor.execute("ALTER TABLE uploaded_files ADD COLUMN processed INTEGER DEFAULT 0")
-            conn.commit()
-        
-        conn.close()
+        if IS_SQLITE:
+            _migrate_sqlite()
     except Exception:
         pass  # 静默处理迁移错误
 
 
+def _migrate_sqlite() -> None:
+    """SQLite 专有的迁移：向量转为二进制格式、创建 / 补建全文索引（FTS5）"""
+    db_path = settings.DATABASE_URL.replace("sqlite:///", "")
+    conn = sqlite3.connect(db_path)
+    try:
+        # 将 JSON 文本格式的向量转换为二进制格式
+        _migrate_chunk_embeddings(conn)
+        
+        # 创建 / 补建全文索引（FTS5）
+        from app.db.fulltext import ensure_fulltext_index
+        ensure_fulltext_index(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _migrate_chunk_embeddings(conn: sqlite3.Connection, batch_size: int = 500) -> int:
+    """分批把 knowledge_chunks.embedding 从 JSON 文本转换为打包的二进制格式"""
+    from app.db.embedding_codec import decode_embedding, encode_embedding
+
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='knowledge_chunks'"
+    )
+    if not cursor.fetchone():
+        return 0
+
+    converted = 0
+    last_id = 0
+    while True:
+        cursor.execute(
+            "SELECT id, embedding FROM knowledge_chunks "
+            "WHERE id > ? AND typeof(embedding) = 'text' ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        updates = []
+        for chunk_id, raw in rows:
+            vec = decode_embedding(raw)
+            if vec is not None:
+                updates.append((encode_embedding(vec, settings.EMBEDDING_STORAGE_DTYPE), chunk_id))
+        cursor.executemany("UPDATE knowledge_chunks SET embedding = ? WHERE id = ?", updates)
+        conn.commit()
+        converted += len(updates)
+        last_id = rows[-1][0]
+
+    if converted:
+        # 回收 JSON 文本释放出的空间
+        conn.execute("VACUUM")
+    return converted
+
+
 # 模块加载时自动执行迁移
 migrate_database()
@@ -0,0 +1,87 @@
+# app/db/embedding_codec.py
+"""
+向量二进制存储格式（KnowledgeChunk.embedding）
+
+格式 v1（小端）：
+    magic   4 字节  b"LVEC"
+    version 1 字节  1
+    dtype   1 字节  1=float32, 2=float16
+    保留    2 字节
+    dim     4 字节  向量维度
+    data    dim * itemsize 字节
+
+读取时用 numpy.frombuffer 直接引用原始 bytes，不做拷贝；
+旧数据（JSON 文本）仍可解析，迁移见 database.migrate_database。
+"""
+from __future__ import annotations
+
+import json
+import struct
+from typing import Optional, Sequence, Union
+
+import numpy as np
+
+MAGIC = b"LVEC"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHI")
+HEADER_SIZE = HEADER.size  # 12 字节，保证数据区 4 字节对齐
+
+_DTYPE_CODES = {
+    "float32": 1,
+    "float16": 2,
+}
+_CODE_DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f2"),
+}
+
+
+def encode_embedding(
+    embedding: Union[Sequence[float], np.ndarray],
+    dtype: str = "float32",
+) -> bytes:
+    """把向量打包为带头部的二进制 BLOB"""
+    code = _DTYPE_CODES.get(dtype)
+    if code is None:
+        raise ValueError(f"不支持的向量存储类型: {dtype}")
+    arr = np.asarray(embedding, dtype=_CODE_DTYPES[code])
+    if arr.ndim != 1:
+        raise ValueError("向量必须是一维数组")
+    return HEADER.pack(MAGIC, VERSION, code, 0, arr.shape[0]) + arr.tobytes()
+
+
+def is_packed(raw) -> bool:
+    return isinstance(raw, (bytes, bytearray, memoryview)) and bytes(raw[:4]) == MAGIC
+
+
+def decode_embedding(raw) -> Optional[np.ndarray]:
+    """
+    解析存储的向量，返回一维 numpy 数组（二进制格式为只读零拷贝视图）。
+    兼容旧的 JSON 文本格式；无法解析时返回 None。
+    """
+    if raw is None:
+        return None
+    if is_packed(raw):
+        if len(raw) < HEADER_SIZE:
+            return None
+        _, version, code, _, dim = HEADER.unpack_from(raw, 0)
+        dtype = _CODE_DTYPES.get(code)
+        if version != VERSION or dtype is None:
+            return None
+        if len(raw) < HEADER_SIZE + dim * dtype.itemsize:
+            return None
+        return np.frombuffer(raw, dtype=dtype, count=dim, offset=HEADER_SIZE)
+
+    # 旧格式：JSON 文本
+    try:
+        if isinstance(raw, (bytes, bytearray, memoryview)):
+            raw = bytes(raw).decode("utf-8")
+        values = json.loads(raw)
+    except Exception:
+        return None
+    if not isinstance(values, list) or not values:
+        return None
+    try:
+        return np.asarray(values, dtype=np.float32)
+    except (TypeError, ValueError):
+        return None
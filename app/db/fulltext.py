@@ -0,0 +1,127 @@
+# app/db/fulltext.py
+"""
+SQLite FTS5 全文索引（知识库 chunk / 知识图谱实体）
+- 使用 trigram 分词器：按 3 字滑窗切分，中文无需分词也能做子串匹配，
+  型号、错误码等标识符同样可以精确命中；
+- 外部内容表（content=...），由触发器与原表保持同步，不重复存储正文；
+- 当前 SQLite 不支持 FTS5 / trigram（< 3.34）时不建表：知识库检索只走向量检索，实体搜索退回 LIKE 查询。
+"""
+from __future__ import annotations
+
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+CHUNKS_FTS = "knowledge_chunks_fts"
+ENTITIES_FTS = "knowledge_entities_fts"
+
+# trigram 分词器下，少于 3 个字符的词无法用 MATCH 命中
+MIN_TERM_LENGTH = 3
+
+# RRF 常数（Cormack et al. 推荐值）
+RRF_K = 60
+
+_FTS_TABLES: Dict[str, Tuple[str, Sequence[str]]] = {
+    CHUNKS_FTS: ("knowledge_chunks", ("content",)),
+    ENTITIES_FTS: ("knowledge_entities", ("name", "description")),
+}
+
+_TERM_SPLIT = re.compile(r"[\s,，。；;：:！!？?、()（）\[\]【】{}<>《》\"'“”‘’]+")
+_IDENTIFIER = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_\-./:#]*$")
+
+
+def _ddl(fts: str, source: str, columns: Sequence[str]) -> List[str]:
+    cols = ", ".join(columns)
+    new_cols = ", ".join(f"new.{c}" for c in columns)
+    old_cols = ", ".join(f"old.{c}" for c in columns)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"{cols}, content='{source}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {source} BEGIN "
+        f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {source} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {source} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); "
+        f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols}); END",
+    ]
+
+
+def fts5_trigram_supported(cursor) -> bool:
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x, tokenize='trigram')")
+        cursor.execute("DROP TABLE temp._fts5_probe")
+        return True
+    except Exception:
+        return False
+
+
+def ensure_fulltext_index(cursor) -> List[str]:
+    """
+    创建 FTS 表和同步触发器（幂等）；新建的表会从原表 rebuild 一次。
+    cursor 为 DB-API 游标（sqlite3 或 SQLAlchemy 连接底层的游标），事务由调用方提交。
+    返回本次新建的 FTS 表名。
+    """
+    if not fts5_trigram_supported(cursor):
+        return []
+    created: List[str] = []
+    for fts, (source, columns) in _FTS_TABLES.items():
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name IN (?, ?)",
+            (fts, source),
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        if source not in existing:
+            continue
+        for stmt in _ddl(fts, source, columns):
+            cursor.execute(stmt)
+        if fts not in existing:
+            cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            created.append(fts)
+    return created
+
+
+def split_terms(query: str) -> List[str]:
+    """按空白和标点切分查询词，去重并保持顺序"""
+    seen = set()
+    terms: List[str] = []
+    for term in _TERM_SPLIT.split(query or ""):
+        term = term.strip()
+        if term and term.lower() not in seen:
+            seen.add(term.lower())
+            terms.append(term)
+    return terms
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    把用户查询转为 FTS5 MATCH 表达式：每个词作为短语（子串）匹配，词之间 OR。
+    没有可用于 trigram 的词（都短于 3 个字符）时返回 None。
+    """
+    phrases = [
+        '"' + term.replace('"', '""') + '"'
+        for term in split_terms(query)
+        if len(term) >= MIN_TERM_LENGTH
+    ]
+    if not phrases:
+        return None
+    return " OR ".join(phrases)
+
+
+def looks_like_identifier(query: str) -> bool:
+    """型号、错误码、函数名等：单个词、不含中文、且包含数字或分隔符"""
+    query = (query or "").strip()
+    if not query or not _IDENTIFIER.match(query):
+        return False
+    return any(ch.isdigit() for ch in query) or any(ch in "_-./:#" for ch in query)
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: Iterable[Sequence[int]],
+    k: int = RRF_K,
+) -> List[Tuple[int, float]]:
+    """RRF 融合多路排序结果：score = Σ 1 / (k + rank)，rank 从 1 开始"""
+    scores: Dict[int, float] = {}
+    for ranked in ranked_lists:
+        for rank, item_id in enumerate(ranked, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
@@ -0,0 +1,417 @@
+# app/db/ivf_index.py
+"""
+IVF 近似向量检索（纯 NumPy）
+- 用球面 k-means 训练 nlist 个聚类中心，每个向量归入最近的中心（倒排表）；
+- 检索时只扫描与 query 最相近的 nprobe 个倒排表，复杂度约为 O(N·d·nprobe/nlist)；
+- 聚类中心与各向量的归属持久化到 vector_index/ 目录，重启后无需重新训练；
+- 新增向量直接归入最近的中心（增量插入），数据量增长到训练时的 4 倍后自动重训；
+- 训练、重训和写文件在后台线程进行，检索期间不做 k-means：训练完成前
+  继续使用旧的聚类中心，并精确扫描尚未归入倒排表的新增数据。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import queue
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.db.vector_index import (
+    FlatPartition,
+    PartitionKey,
+    VectorIndex,
+    default_index_dir,
+    normalize_rows,
+)
+from app.utils.logger import db_logger
+
+# 训练 k-means 时最多使用的样本数
+_TRAIN_SAMPLE_SIZE = 50000
+_KMEANS_ITERATIONS = 10
+# 分块计算，限制 (块大小 × nlist) 的临时矩阵内存
+_ASSIGN_BLOCK = 8192
+# 数据量超过训练时的倍数后重训
+_RETRAIN_GROWTH = 4
+
+
+def assign_to_centroids(rows: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """返回每行最相近（内积最大）的聚类中心下标"""
+    out = np.empty(len(rows), dtype=np.int32)
+    for start in range(0, len(rows), _ASSIGN_BLOCK):
+        block = rows[start:start + _ASSIGN_BLOCK]
+        out[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def train_kmeans(data: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """球面 k-means：data 需已 L2 归一化，返回归一化的聚类中心 (nlist, d)"""
+    rng = np.random.default_rng(seed)
+    if len(data) > _TRAIN_SAMPLE_SIZE:
+        data = data[rng.choice(len(data), _TRAIN_SAMPLE_SIZE, replace=False)]
+    nlist = max(1, min(nlist, len(data)))
+    centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+
+    for _ in range(_KMEANS_ITERATIONS):
+        assign = assign_to_centroids(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # 空簇重新随机取点
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def split_by_list(
+    ids: np.ndarray,
+    rows: np.ndarray,
+    assign: np.ndarray,
+    nlist: int,
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """按归属的聚类中心拆分为 nlist 个 (ids, rows) 倒排表"""
+    order = np.argsort(assign, kind="stable")
+    bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+    list_ids: List[np.ndarray] = []
+    list_rows: List[np.ndarray] = []
+    for list_no in range(nlist):
+        sel = order[bounds[list_no]:bounds[list_no + 1]]
+        list_ids.append(ids[sel])
+        list_rows.append(rows[sel])
+    return list_ids, list_rows
+
+
+def _auto_nlist(n: int) -> int:
+    if settings.IVF_NLIST > 0:
+        return settings.IVF_NLIST
+    return max(1, int(np.sqrt(n)))
+
+
+class IVFPartition:
+    """单个 (知识库, 模型) 分区的 IVF 实现；未训练前退化为精确检索"""
+
+    def __init__(
+        self,
+        dim: int,
+        path: str,
+        schedule: Optional[Callable[["IVFPartition"], None]] = None,
+    ) -> None:
+        self.dim = dim
+        self.path = path
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.list_ids: List[np.ndarray] = []
+        self.list_rows: List[np.ndarray] = []
+        # 未训练时的全部数据 / 训练后待归入倒排表的新增数据
+        self._flat = FlatPartition(dim)
+        # 磁盘上持久化的 chunk_id -> 倒排表 映射（首次合并时使用）
+        self._persisted_ids: Optional[np.ndarray] = None
+        self._persisted_assign: Optional[np.ndarray] = None
+        self._dirty = False
+        # 后台训练 / 持久化：schedule(self) 把分区交给后台线程
+        self._schedule = schedule
+        self._training = False
+        self._removed_while_training: List[np.ndarray] = []
+        self._io_lock = threading.Lock()
+        self._closed = False
+        self._restore()
+
+    def __len__(self) -> int:
+        return len(self._flat) + sum(len(ids) for ids in self.list_ids)
+
+    # ---------- 持久化 ----------
+
+    def _restore(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                centroids = data["centroids"]
+                if centroids.ndim != 2 or centroids.shape[1] != self.dim:
+                    return
+                self.centroids = centroids.astype(np.float32, copy=False)
+                self.trained_size = int(data["trained_size"])
+                order = np.argsort(data["ids"])
+                self._persisted_ids = data["ids"][order]
+                self._persisted_assign = data["assign"][order]
+        except Exception:
+            self.centroids = None
+            return
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        self.list_rows = [np.empty((0, self.dim), dtype=np.float32) for _ in range(len(self.centroids))]
+
+    def _snapshot_for_save(self) -> Optional[Tuple[np.ndarray, int, List[np.ndarray]]]:
+        """在索引锁内取出要持久化的数据（数组只会整体替换，不会原地修改）"""
+        if self.centroids is None or not self._dirty:
+            return None
+        self._dirty = False
+        return self.centroids, self.trained_size, list(self.list_ids)
+
+    def _write(self, snapshot: Tuple[np.ndarray, int, List[np.ndarray]]) -> None:
+        centroids, trained_size, list_ids = snapshot
+        ids = np.concatenate(list_ids) if list_ids else np.empty(0, dtype=np.int64)
+        assign = np.concatenate(
+            [np.full(len(l), i, dtype=np.int32) for i, l in enumerate(list_ids)]
+        ) if list_ids else np.empty(0, dtype=np.int32)
+        with self._io_lock:
+            if self._closed:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp.npz"
+            np.savez(
+                tmp_path,
+                centroids=centroids,
+                trained_size=np.int64(trained_size),
+                ids=ids,
+                assign=assign,
+            )
+            os.replace(tmp_path, self.path)
+
+    def delete_file(self) -> None:
+        with self._io_lock:
+            self._closed = True
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    # ---------- 维护 ----------
+
+    def append(self, ids: np.ndarray, rows: np.ndarray) -> None:
+        self._flat.append(ids, rows)
+
+    def contains(self, chunk_ids: np.ndarray) -> np.ndarray:
+        known = self._flat.contains(chunk_ids)
+        for ids in self.list_ids:
+            if len(ids):
+                known |= np.isin(chunk_ids, ids)
+        return known
+
+    def _distribute(self, ids: np.ndarray, rows: np.ndarray, assign: np.ndarray) -> None:
+        list_ids, list_rows = split_by_list(ids, rows, assign, len(self.centroids))
+        for list_no, (new_ids, new_rows) in enumerate(zip(list_ids, list_rows)):
+            if not len(new_ids):
+                continue
+            self.list_ids[list_no] = np.concatenate([self.list_ids[list_no], new_ids])
+            self.list_rows[list_no] = np.vstack([self.list_rows[list_no], new_rows])
+        self._dirty = True
+
+    def _assign_new(self, ids: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        assign = np.full(len(ids), -1, dtype=np.int32)
+        if self._persisted_ids is not None and len(self._persisted_ids):
+            pos = np.searchsorted(self._persisted_ids, ids)
+            pos = np.clip(pos, 0, len(self._persisted_ids) - 1)
+            known = self._persisted_ids[pos] == ids
+            assign[known] = self._persisted_assign[pos[known]]
+        missing = assign < 0
+        if missing.any():
+            assign[missing] = assign_to_centroids(rows[missing], self.centroids)
+        return assign
+
+    def needs_training(self) -> bool:
+        if self._training:
+            return False
+        if self.centroids is None:
+            return len(self._flat) >= max(settings.IVF_MIN_TRAIN_SIZE, 1)
+        total = sum(len(ids) for ids in self.list_ids)
+        return bool(self.trained_size) and total > self.trained_size * _RETRAIN_GROWTH
+
+    def consolidate(self) -> None:
+        """把新增数据归入现有倒排表；训练 / 重训和写文件交给后台线程"""
+        flat = self._flat
+        flat.consolidate()
+        # 训练进行中时新增数据留在缓冲区，训练完成后按新的聚类中心归入
+        if self.centroids is not None and len(flat) and not self._training:
+            restored = self._persisted_ids is not None
+            self._distribute(flat.ids, flat.matrix, self._assign_new(flat.ids, flat.matrix))
+            self._flat = FlatPartition(self.dim)
+            if restored:
+                # 持久化映射只在首次加载时使用
+                self._persisted_ids = None
+                self._persisted_assign = None
+                self._dirty = False
+
+        if self._schedule is not None and (self._dirty or self.needs_training()):
+            self._schedule(self)
+
+    def maintain(self, lock: threading.RLock) -> None:
+        """
+        后台线程调用：训练 / 重训聚类中心并持久化。
+        只在取快照和替换结果时持有索引锁，k-means 与写文件期间检索照常进行。
+        """
+        with lock:
+            snapshot = self._begin_training() if self.needs_training() else None
+        if snapshot is not None:
+            try:
+                ids = np.concatenate(snapshot[0])
+                rows = np.vstack(snapshot[1])
+                centroids = train_kmeans(rows, _auto_nlist(len(rows)))
+                list_ids, list_rows = split_by_list(
+                    ids, rows, assign_to_centroids(rows, centroids), len(centroids)
+                )
+            except Exception:
+                with lock:
+                    self._training = False
+                    self._removed_while_training = []
+                raise
+            with lock:
+                self._finish_training(ids, centroids, list_ids, list_rows)
+
+        with lock:
+            save = self._snapshot_for_save()
+        if save is not None:
+            self._write(save)
+
+    def _begin_training(self) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        self._training = True
+        self._removed_while_training = []
+        if self.centroids is None:
+            self._flat.consolidate()
+            return [self._flat.ids], [self._flat.matrix]
+        return list(self.list_ids), list(self.list_rows)
+
+    def _finish_training(
+        self,
+        snapshot_ids: np.ndarray,
+        centroids: np.ndarray,
+        list_ids: List[np.ndarray],
+        list_rows: List[np.ndarray],
+    ) -> None:
+        removed = (
+            np.concatenate(self._removed_while_training)
+            if self._removed_while_training else np.empty(0, dtype=np.int64)
+        )
+        if len(removed):
+            # 训练期间删除的 chunk
+            for list_no, ids in enumerate(list_ids):
+                keep = ~np.isin(ids, removed)
+                if not keep.all():
+                    list_ids[list_no] = ids[keep]
+                    list_rows[list_no] = list_rows[list_no][keep]
+
+        if self.centroids is None:
+            # 未训练时快照取自缓冲区本身：已进入新倒排表的行从缓冲区去掉，
+            # 只保留训练期间新增（包括删除后以同一 id 重新写入）的行
+            flat = self._flat
+            flat.consolidate()
+            keep = ~np.isin(flat.ids, snapshot_ids) | np.isin(flat.ids, removed)
+            self._flat = FlatPartition(self.dim)
+            if keep.any():
+                self._flat.append(flat.ids[keep], flat.matrix[keep])
+
+        self.centroids = centroids
+        self.trained_size = len(snapshot_ids)
+        self.list_ids = list_ids
+        self.list_rows = list_rows
+        self._persisted_ids = None
+        self._persisted_assign = None
+        self._training = False
+        self._removed_while_training = []
+        self._dirty = True
+
+    def remove(self, chunk_ids: np.ndarray) -> int:
+        removed = self._flat.remove(chunk_ids)
+        for list_no, ids in enumerate(self.list_ids):
+            keep = ~np.isin(ids, chunk_ids)
+            if not keep.all():
+                removed += int(len(keep) - keep.sum())
+                self.list_ids[list_no] = ids[keep]
+                self.list_rows[list_no] = self.list_rows[list_no][keep]
+        if self._training:
+            self._removed_while_training.append(np.asarray(chunk_ids, dtype=np.int64))
+        if removed and self.centroids is not None:
+            self._dirty = True
+            if self._schedule is not None:
+                self._schedule(self)
+        return removed
+
+    # ---------- 检索 ----------
+
+    def top_k(self, query: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        self.consolidate()
+        if self.centroids is None:
+            return self._flat.top_k(query, k)
+
+        nprobe = max(1, min(nprobe or settings.IVF_NPROBE, len(self.centroids)))
+        centroid_scores = self.centroids @ query
+        if nprobe < len(self.centroids):
+            probe = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        else:
+            probe = np.arange(len(self.centroids))
+        probe = [p for p in probe if len(self.list_ids[p])]
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        ids_parts = [self.list_ids[p] for p in probe]
+        score_parts = [self.list_rows[p] @ query for p in probe]
+        if len(self._flat):
+            # 重训期间尚未归入倒排表的新增数据：精确扫描
+            flat_ids, flat_scores = self._flat.top_k(query, k)
+            ids_parts.append(flat_ids)
+            score_parts.append(flat_scores)
+        if not ids_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        ids = np.concatenate(ids_parts)
+        scores = np.concatenate(score_parts)
+        if k < len(ids):
+            idx = np.argpartition(scores, -k)[-k:]
+        else:
+            idx = np.arange(len(ids))
+        idx = idx[np.argsort(scores[idx])[::-1]]
+        return ids[idx], scores[idx]
+
+
+class IVFIndex(VectorIndex):
+    """以 IVF 分区替代精确分区的向量索引，对外接口与 VectorIndex 相同"""
+
+    def __init__(self, index_dir: Optional[str] = None) -> None:
+        super().__init__()
+        self.index_dir = index_dir or default_index_dir()
+        self._maintain_queue: "queue.Queue[IVFPartition]" = queue.Queue()
+        self._maintain_pending: set = set()
+        self._maintainer: Optional[threading.Thread] = None
+
+    def _partition_path(self, key: PartitionKey) -> str:
+        kb_id, model_name = key
+        model_hash = hashlib.sha1((model_name or "").encode("utf-8")).hexdigest()[:12]
+        kb_part = "none" if kb_id is None else str(kb_id)
+        return os.path.join(self.index_dir, f"ivf_kb{kb_part}_{model_hash}.npz")
+
+    def _new_partition(self, key: PartitionKey, dim: int) -> IVFPartition:
+        return IVFPartition(dim, self._partition_path(key), schedule=self._schedule_maintenance)
+
+    def drop_kb(self, kb_id: Optional[int]) -> None:
+        with self._lock:
+            for key in [k for k in self._partitions if k[0] == kb_id]:
+                self._partitions.pop(key).delete_file()
+
+    # ---------- 后台训练 ----------
+
+    def _schedule_maintenance(self, part: IVFPartition) -> None:
+        """在索引锁内调用：只入队，不做计算"""
+        if id(part) in self._maintain_pending:
+            return
+        self._maintain_pending.add(id(part))
+        self._maintain_queue.put(part)
+        if self._maintainer is None or not self._maintainer.is_alive():
+            self._maintainer = threading.Thread(
+                target=self._maintain_worker, name="ivf-index-trainer", daemon=True
+            )
+            self._maintainer.start()
+
+    def _maintain_worker(self) -> None:
+        while True:
+            part = self._maintain_queue.get()
+            try:
+                with self._lock:
+                    current = any(p is part for p in self._partitions.values())
+                    self._maintain_pending.discard(id(part))
+                if current:
+                    part.maintain(self._lock)
+            except Exception as e:
+                db_logger.error(f"[IVF] 训练或保存失败 {part.path}: {e}")
@@ -1,5 +1,6 @@
 # app/db/models.py
 from datetime import datetime
+from typing import Optional
 
 from sqlalchemy import (
     Column,
@@ -8,11 +9,15 @@ from sqlalchemy import (
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
+    LargeBinary,
     Text,
+    event,
 )
 from sqlalchemy.orm import relationship
 
 from app.db.database import Base
+from app.db.fulltext import ensure_fulltext_index
 
 
 # 新增：项目表（用于对话分类）
@@ -85,8 +90,14 @@ class Conversation(Base):
     # project 关系
     project = relationship("Project", back_populates="conversations")
 
-    def to_dict(self):
-        return {
+    # 对话列表按 (置顶, id) 倒序分页，可按项目筛选
+    __table_args__ = (
+        Index("ix_conversations_is_pinned_id", "is_pinned", "id"),
+        Index("ix_conversations_project_id_is_pinned_id", "project_id", "is_pinned", "id"),
+    )
+
+    def to_dict(self, message_count: Optional[int] = None):
+        data = {
             "id": self.id,
             "title": self.title,
             "model": self.model,
@@ -101,6 +112,9 @@ class Conversation(Base):
             "enable_mcp": self.enable_mcp,
             "enable_web_search": self.enable_web_search,
         }
+        if message_count is not None:
+            data["message_count"] = message_count
+        return data
 
 
 class Message(Base):
@@ -134,8 +148,16 @@ class Message(Base):
 
     conversation = relationship("Conversation", back_populates="messages")
 
-    def to_dict(self):
-        return {
+    # 按对话倒序取末尾若干条消息（上下文缓存）
+    __table_args__ = (
+        Index("ix_messages_conversation_id_id", "conversation_id", "id"),
+    )
+
+    # 消息详情字段：体积大，消息列表分页接口不返回，展开时通过 /messages/{id}/events 单独获取
+    DETAIL_FIELDS = ("tool_calls", "thinking_content", "vision_content", "message_events")
+
+    def to_dict(self, include_details: bool = True):
+        data = {
             "id": self.id,
             "conversation_id": self.conversation_id,
             "role": self.role,
@@ -145,11 +167,13 @@ class Message(Base):
             "input_tokens": self.input_tokens,
             "output_tokens": self.output_tokens,
             "total_tokens": self.total_tokens,
-            "tool_calls": self.tool_calls,
-            "thinking_content": self.thinking_content,
-            "vision_content": self.vision_content,
-            "message_events": self.message_events,
         }
+        if include_details:
+            data.update(self.details_dict())
+        return data
+
+    def details_dict(self):
+        return {field: getattr(self, field) for field in self.DETAIL_FIELDS}
 
 
 class UploadedFile(Base):
@@ -252,11 +276,22 @@ class KnowledgeChunk(Base):
 
     chunk_index = Column(Integer, nullable=False)
     content = Column(Text, nullable=False)
-    embedding = Column(Text, nullable=False)  # JSON 格式的向量
+    embedding = Column(LargeBinary, nullable=False)  # 打包的二进制向量（格式见 embedding_codec）
 
     document = relationship("KnowledgeDocument", back_populates="chunks")
 
 
+# 查询向量缓存（EMBEDDING_CACHE_PERSIST 开启时使用）
+class EmbeddingCacheEntry(Base):
+    __tablename__ = "embedding_cache"
+
+    # sha256(api_base, model, 归一化后的查询文本)
+    key = Column(String(64), primary_key=True)
+    model = Column(String(255), nullable=False)
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
 # 新增：知识库文档（与上传文件绑定）
 class KnowledgeDocument(Base):
     __tablename__ = "knowledge_documents"
@@ -294,6 +329,70 @@ class KnowledgeDocument(Base):
         }
 
 
+# 上传文件的内容寻址存储：同一内容只保存一份，按引用计数回收
+class FileBlob(Base):
+    __tablename__ = "file_blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), nullable=False, index=True)
+    # uploads/blobs/<sha256 前两位>/<sha256><扩展名>；扩展名决定解析方式，同一内容不同扩展名分别保存
+    path = Column(String(1024), nullable=False, unique=True)
+    size = Column(Integer, nullable=False, default=0)
+    # 引用方：uploaded_files、knowledge_documents 以及处理中的 ingestion_jobs
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# 知识库导入任务（上传后在后台抽取、切分、向量化、入库）
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # 知识库 / 文档删除后任务记录保留，引用置空（crud 删除时也会显式置空，兼容旧表）
+    kb_id = Column(Integer, ForeignKey("knowledge_bases.id", ondelete="SET NULL"), nullable=True, index=True)
+    document_id = Column(Integer, ForeignKey("knowledge_documents.id", ondelete="SET NULL"), nullable=True)
+
+    file_name = Column(String(255), nullable=False)
+    file_path = Column(String(1024), nullable=False)
+    embedding_model = Column(String(255), nullable=False)
+    extract_images = Column(Boolean, default=False)
+    vision_model = Column(String(255), nullable=True)
+
+    # pending / running / succeeded / failed
+    status = Column(String(20), nullable=False, default="pending", index=True)
+    # queued / extracting / chunking / embedding / storing / done
+    stage = Column(String(20), nullable=False, default="queued")
+    progress = Column(Integer, default=0)  # 0-100
+    chunks_total = Column(Integer, default=0)
+    chunks_done = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kb_id": self.kb_id,
+            "document_id": self.document_id,
+            "file_name": self.file_name,
+            "embedding_model": self.embedding_model,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "chunks_total": self.chunks_total,
+            "chunks_done": self.chunks_done,
+            "chunks_count": self.chunks_total if self.status == "succeeded" else None,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
 # 新增：MCP服务器配置
 class MCPServer(Base):
     __tablename__ = "mcp_servers"
@@ -435,3 +534,15 @@ class KnowledgeRelation(Base):
             "weight": self.weight,
             "created_at": self.created_at.isoformat() if self.created_at else None,
         }
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _create_fulltext_index(target, connection, **kw):
+    """create_all 之后创建 FTS5 全文索引及同步触发器（仅 SQLite）"""
+    if connection.dialect.name != "sqlite":
+        return
+    cursor = connection.connection.cursor()
+    try:
+        ensure_fulltext_index(cursor)
+    finally:
+        cursor.close()
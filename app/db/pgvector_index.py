@@ -0,0 +1,223 @@
+# app/db/pgvector_index.py
+"""
+PostgreSQL + pgvector 向量检索
+向量另存一份到 knowledge_chunks.embedding_vec（vector 类型，不限定维度），相似度检索在数据库内完成，
+多个应用节点共用同一份索引，不需要在各自进程内加载向量矩阵：
+
+- 每种维度一个 HNSW 部分索引：WHERE vector_dims(embedding_vec) = dim，按 vector(dim) 建余弦距离索引；
+- 首次使用时创建扩展和列，并把已有 chunk 的二进制向量（embedding 列）回填到 embedding_vec；
+- add 在 chunk 写入后填充对应行；删除 chunk / 知识库时向量随行删除，无需额外处理；
+- HNSW 先取候选再按知识库 / 模型过滤，小知识库可能凑不满 top_k：pgvector >= 0.8 时开启迭代扫描，
+  结果仍不足 top_k 时改用不走索引的精确检索；
+- 扩展不可用（未安装或没有权限）时退回父类的进程内精确检索。
+"""
+from __future__ import annotations
+
+import threading
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.database import engine
+from app.db.embedding_codec import decode_embedding
+from app.db.vector_index import VectorIndex
+from app.utils.logger import db_logger
+
+VECTOR_COLUMN = "embedding_vec"
+
+# pgvector 的 HNSW 索引最多支持 2000 维，更高维度只能顺序扫描
+HNSW_MAX_DIMS = 2000
+
+# hnsw.iterative_scan 从 pgvector 0.8.0 开始提供
+_ITERATIVE_SCAN_VERSION = (0, 8, 0)
+
+
+def vector_literal(embedding: Sequence[float]) -> str:
+    """pgvector 的文本格式：[x1,x2,...]"""
+    return "[" + ",".join(map(str, np.asarray(embedding, dtype=np.float32).tolist())) + "]"
+
+
+def _parse_version(version: Optional[str]) -> Tuple[int, ...]:
+    parts = []
+    for part in (version or "").split("."):
+        digits = "".join(ch for ch in part if ch.isdigit())
+        parts.append(int(digits) if digits else 0)
+    return tuple(parts)
+
+
+class PgVectorIndex(VectorIndex):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._ready: Optional[bool] = None
+        self._setup_lock = threading.Lock()
+        self._indexed_dims: Set[int] = set()
+        self._iterative_scan = False
+
+    # ---------- 初始化 ----------
+
+    def _ensure_ready(self) -> bool:
+        if self._ready is not None:
+            return self._ready
+        with self._setup_lock:
+            if self._ready is None:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+                        conn.execute(text(
+                            f"ALTER TABLE knowledge_chunks ADD COLUMN IF NOT EXISTS {VECTOR_COLUMN} vector"
+                        ))
+                        version = conn.execute(
+                            text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+                        ).scalar()
+                    self._iterative_scan = _parse_version(version) >= _ITERATIVE_SCAN_VERSION
+                    filled = self._backfill()
+                    if filled:
+                        db_logger.info(f"[pgvector] 已回填 {filled} 个 chunk 向量")
+                    self._ready = True
+                except Exception as e:
+                    db_logger.warning(f"[pgvector] 不可用，退回进程内向量检索: {e}")
+                    self._ready = False
+        return self._ready
+
+    def _backfill(self, batch_size: int = 500) -> int:
+        """把 embedding_vec 为空的 chunk 从二进制向量回填"""
+        filled = 0
+        last_id = 0
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(
+                    text(
+                        f"SELECT id, embedding FROM knowledge_chunks "
+                        f"WHERE id > :last_id AND {VECTOR_COLUMN} IS NULL ORDER BY id LIMIT :limit"
+                    ),
+                    {"last_id": last_id, "limit": batch_size},
+                ).fetchall()
+                if not rows:
+                    return filled
+                last_id = rows[-1][0]
+                pairs = []
+                for chunk_id, raw in rows:
+                    emb = decode_embedding(raw)
+                    if emb is not None and len(emb):
+                        pairs.append((chunk_id, emb))
+                filled += self._write(conn, pairs)
+
+    def _write(self, conn, pairs: Sequence[Tuple[int, Sequence[float]]]) -> int:
+        if not pairs:
+            return 0
+        conn.execute(
+            text(f"UPDATE knowledge_chunks SET {VECTOR_COLUMN} = CAST(:vec AS vector) WHERE id = :id"),
+            [{"id": chunk_id, "vec": vector_literal(emb)} for chunk_id, emb in pairs],
+        )
+        for dim in {len(emb) for _, emb in pairs}:
+            self._ensure_dim_index(conn, dim)
+        return len(pairs)
+
+    def _ensure_dim_index(self, conn, dim: int) -> None:
+        if dim in self._indexed_dims:
+            return
+        if dim <= HNSW_MAX_DIMS:
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_knowledge_chunks_{VECTOR_COLUMN}_{dim} "
+                f"ON knowledge_chunks USING hnsw (({VECTOR_COLUMN}::vector({dim})) vector_cosine_ops) "
+                f"WHERE vector_dims({VECTOR_COLUMN}) = {dim}"
+            ))
+        else:
+            db_logger.warning(f"[pgvector] {dim} 维向量超过 HNSW 上限 {HNSW_MAX_DIMS}，将顺序扫描")
+        self._indexed_dims.add(dim)
+
+    # ---------- 同步 ----------
+
+    def add(
+        self,
+        kb_id: Optional[int],
+        embedding_model: Optional[str],
+        ids: Sequence[int],
+        embeddings: Sequence[Sequence[float]],
+    ) -> None:
+        if not self._ensure_ready():
+            super().add(kb_id, embedding_model, ids, embeddings)
+            return
+        pairs = [(chunk_id, emb) for chunk_id, emb in zip(ids, embeddings) if len(emb)]
+        try:
+            with engine.begin() as conn:
+                self._write(conn, pairs)
+        except Exception as e:
+            # 未写入的行在下次启动时由 _backfill 补上
+            db_logger.error(f"[pgvector] 写入向量失败: {e}")
+
+    def remove_chunks(
+        self,
+        chunk_ids: Iterable[int],
+        kb_id: Optional[int] = None,
+        embedding_model: Optional[str] = None,
+    ) -> None:
+        if self._ready is False:
+            super().remove_chunks(chunk_ids, kb_id=kb_id, embedding_model=embedding_model)
+
+    def drop_kb(self, kb_id: Optional[int]) -> None:
+        if self._ready is False:
+            super().drop_kb(kb_id)
+
+    # ---------- 检索 ----------
+
+    def search(
+        self,
+        db: Session,
+        *,
+        query_embedding: Sequence[float],
+        kb_id: Optional[int] = None,
+        embedding_model: Optional[str] = None,
+        top_k: int = 5,
+    ) -> List[Tuple[int, float]]:
+        if not self._ensure_ready():
+            return super().search(
+                db,
+                query_embedding=query_embedding,
+                kb_id=kb_id,
+                embedding_model=embedding_model,
+                top_k=top_k,
+            )
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.ndim != 1 or not len(query) or not np.any(query) or top_k <= 0:
+            return []
+
+        dim = len(query)
+        sql = (
+            "SELECT c.id, 1 - ({distance}) AS score FROM knowledge_chunks c "
+            "JOIN knowledge_documents d ON d.id = c.document_id "
+            f"WHERE vector_dims(c.{VECTOR_COLUMN}) = {dim}"
+        )
+        params = {"query": vector_literal(query), "top_k": top_k}
+        if kb_id is not None:
+            sql += " AND d.kb_id = :kb_id"
+            params["kb_id"] = kb_id
+        if embedding_model is not None:
+            sql += " AND d.embedding_model = :embedding_model"
+            params["embedding_model"] = embedding_model
+        sql += " ORDER BY {distance} LIMIT :top_k"
+
+        # 以下设置只对当前事务生效；HNSW 先取 ef_search 个候选再按知识库过滤，候选数至少为 top_k
+        db.execute(
+            text("SELECT set_config('hnsw.ef_search', :ef, true)"),
+            {"ef": str(max(settings.PGVECTOR_EF_SEARCH, top_k))},
+        )
+        if self._iterative_scan:
+            # 过滤后不足 top_k 时继续扫描索引，而不是直接返回
+            db.execute(text("SELECT set_config('hnsw.iterative_scan', 'strict_order', true)"))
+        # 按 vector(dim) 表达式排序时走对应维度的 HNSW 部分索引
+        indexed = f"c.{VECTOR_COLUMN}::vector({dim}) <=> CAST(:query AS vector({dim}))"
+        hits = self._fetch(db, sql.format(distance=indexed), params)
+        if len(hits) < top_k:
+            # 索引候选被过滤掉太多：不带类型转换的表达式不匹配任何索引，按过滤条件精确计算
+            exact = f"c.{VECTOR_COLUMN} <=> CAST(:query AS vector)"
+            hits = self._fetch(db, sql.format(distance=exact), params)
+        return hits
+
+    @staticmethod
+    def _fetch(db: Session, sql: str, params: dict) -> List[Tuple[int, float]]:
+        return [(int(chunk_id), float(score)) for chunk_id, score in db.execute(text(sql), params)]
@@ -0,0 +1,586 @@
+# app/db/segment_index.py
+"""
+磁盘分段向量索引（memory-mapped）
+每个 (知识库, 向量模型) 对应 vector_index/ 下的一个目录：
+
+    seg_kb{kb_id}_{sha1(model)[:12]}/
+        manifest.json          段列表（含段序号）、维度、墓碑（chunk_id -> 删除时的段序号）
+        seg_000001.ids.npy     int64 chunk_id
+        seg_000001.vec.npy     float32 (n, dim)，L2 归一化
+        .lock                  跨进程写锁
+
+- 段文件只追加、不修改；检索时以 np.load(mmap_mode="r") 映射，
+  多个 uvicorn worker 通过操作系统页缓存共享同一份数据，不占用 Python 堆；
+- 删除只写墓碑，由后台线程在墓碑比例或段数过多时合并压缩；
+  墓碑只作用于删除时已存在的段，SQLite 复用已删除的 chunk_id 时，新写入的行不受影响；
+- manifest 通过临时文件 + os.replace 原子替换，读取方按 mtime 感知变化并重新映射。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import models
+from app.db.embedding_codec import decode_embedding
+from app.db.vector_index import PartitionKey, VectorIndex, default_index_dir
+from app.utils.logger import db_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".lock"
+MANIFEST_VERSION = 2
+# 从数据库重建 / 追赶时每个段的最大行数
+_BUILD_BATCH = 20000
+# 按 id 补取缺失 chunk 时每次 IN 查询的 id 数
+_FETCH_BATCH = 500
+
+
+@contextmanager
+def _file_lock(dir_path: str):
+    """目录级排他锁（跨进程、跨线程）"""
+    os.makedirs(dir_path, exist_ok=True)
+    fh = open(os.path.join(dir_path, LOCK_NAME), "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        else:
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+        yield
+    finally:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            else:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            fh.close()
+
+
+def _empty_manifest(dim: int) -> Dict:
+    return {
+        "version": MANIFEST_VERSION,
+        "dim": dim,
+        "seq": 0,
+        "segments": [],
+        # [[chunk_id, seq], ...]：段序号不大于 seq 的段中该 chunk_id 的行已删除
+        "tombstones": [],
+    }
+
+
+def _tombstone_arrays(manifest: Dict) -> Tuple[np.ndarray, np.ndarray]:
+    """墓碑按 chunk_id 排序后的 (ids, seqs)"""
+    pairs = sorted((int(i), int(seq)) for i, seq in manifest["tombstones"])
+    ids = np.fromiter((i for i, _ in pairs), dtype=np.int64, count=len(pairs))
+    seqs = np.fromiter((seq for _, seq in pairs), dtype=np.int64, count=len(pairs))
+    return ids, seqs
+
+
+def _dead_mask(ids: np.ndarray, seg_seq: int, tomb_ids: np.ndarray, tomb_seqs: np.ndarray) -> np.ndarray:
+    """段 seg_seq 中哪些行已被墓碑删除"""
+    if not len(tomb_ids) or not len(ids):
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.clip(np.searchsorted(tomb_ids, ids), 0, len(tomb_ids) - 1)
+    return (tomb_ids[pos] == ids) & (tomb_seqs[pos] >= seg_seq)
+
+
+def read_manifest(dir_path: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(dir_path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(dir_path: str, manifest: Dict) -> None:
+    """原子替换 manifest（调用方需持有目录锁）"""
+    tmp_path = os.path.join(dir_path, MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(dir_path, MANIFEST_NAME))
+
+
+def _save_npy(path: str, arr: np.ndarray) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        # Windows 下仍被其他进程映射的文件无法删除，留待下次压缩清理
+        pass
+
+
+class SegmentPartition:
+    """单个 (知识库, 模型) 的分段索引；内存中只保留各段的 mmap 视图"""
+
+    def __init__(self, dir_path: str, dim: int) -> None:
+        self.dir_path = dir_path
+        self.dim = dim
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._segments: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._order: List[str] = []
+        self._seg_seqs: Dict[str, int] = {}
+        self._tomb_ids = np.empty(0, dtype=np.int64)
+        self._tomb_seqs = np.empty(0, dtype=np.int64)
+
+        with _file_lock(dir_path):
+            manifest = read_manifest(dir_path)
+            if manifest is None or manifest.get("dim") != dim:
+                # 首次创建，或换了同名但维度不同的模型：以新维度重建
+                self._reset_locked(dim)
+        self.refresh()
+
+    def _reset_locked(self, dim: int) -> None:
+        write_manifest(self.dir_path, _empty_manifest(dim))
+        # 旧维度或旧版本 manifest 留下的段文件
+        for fname in os.listdir(self.dir_path):
+            if fname.startswith("seg_"):
+                _remove_quietly(os.path.join(self.dir_path, fname))
+
+    def __len__(self) -> int:
+        return len(self.live_ids())
+
+    def _seg_paths(self, name: str) -> Tuple[str, str]:
+        return (
+            os.path.join(self.dir_path, f"{name}.ids.npy"),
+            os.path.join(self.dir_path, f"{name}.vec.npy"),
+        )
+
+    def _remove_segment_files(self, name: str) -> None:
+        for path in self._seg_paths(name):
+            _remove_quietly(path)
+
+    # ---------- 读取 ----------
+
+    def refresh(self) -> None:
+        """manifest 变化（本进程或其他 worker 写入）时重新映射段文件"""
+        try:
+            st = os.stat(os.path.join(self.dir_path, MANIFEST_NAME))
+        except OSError:
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        manifest = read_manifest(self.dir_path)
+        if manifest is None:
+            return
+
+        segments: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        order: List[str] = []
+        seg_seqs: Dict[str, int] = {}
+        for seg in manifest["segments"]:
+            name = seg["name"]
+            mapped = self._segments.get(name)
+            if mapped is None:
+                ids_path, vec_path = self._seg_paths(name)
+                try:
+                    mapped = (
+                        np.load(ids_path, mmap_mode="r"),
+                        np.load(vec_path, mmap_mode="r"),
+                    )
+                except (OSError, ValueError) as e:
+                    db_logger.warning(f"[向量段] 无法映射 {vec_path}: {e}")
+                    continue
+            segments[name] = mapped
+            order.append(name)
+            seg_seqs[name] = int(seg["seq"])
+
+        self._segments = segments
+        self._order = order
+        self._seg_seqs = seg_seqs
+        self._tomb_ids, self._tomb_seqs = _tombstone_arrays(manifest)
+        self.dim = int(manifest["dim"])
+        self._stamp = stamp
+
+    def _live(self, segments: Iterable[Tuple[np.ndarray, int]], tomb_ids, tomb_seqs) -> np.ndarray:
+        parts = [
+            np.asarray(ids[~_dead_mask(ids, seq, tomb_ids, tomb_seqs)])
+            for ids, seq in segments
+        ]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def live_ids(self) -> np.ndarray:
+        """分区中未被删除的 chunk_id"""
+        self.refresh()
+        return self._live(
+            ((self._segments[name][0], self._seg_seqs[name]) for name in self._order),
+            self._tomb_ids,
+            self._tomb_seqs,
+        )
+
+    def _live_on_disk(self, manifest: Dict) -> np.ndarray:
+        """按磁盘上的 manifest 计算存活的 chunk_id（调用方需持有目录锁）"""
+        segments = []
+        for seg in manifest["segments"]:
+            mapped = self._segments.get(seg["name"])
+            ids = mapped[0] if mapped is not None else np.load(self._seg_paths(seg["name"])[0], mmap_mode="r")
+            segments.append((ids, int(seg["seq"])))
+        return self._live(segments, *_tombstone_arrays(manifest))
+
+    def top_k(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self.refresh()
+        if k <= 0 or not self._order:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # 多取墓碑数量的候选，过滤已删除的 chunk 后仍能凑满 k 个
+        want = k + len(self._tomb_ids)
+        cand_ids: List[np.ndarray] = []
+        cand_scores: List[np.ndarray] = []
+        for name in self._order:
+            ids, vecs = self._segments[name]
+            n = len(ids)
+            if n == 0:
+                continue
+            scores = vecs @ query
+            if want < n:
+                idx = np.argpartition(scores, -want)[-want:]
+            else:
+                idx = np.arange(n)
+            seg_ids = np.asarray(ids[idx])
+            alive = ~_dead_mask(seg_ids, self._seg_seqs[name], self._tomb_ids, self._tomb_seqs)
+            cand_ids.append(seg_ids[alive])
+            cand_scores.append(scores[idx][alive])
+        if not cand_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        ids = np.concatenate(cand_ids)
+        scores = np.concatenate(cand_scores)
+        order = np.argsort(scores)[::-1][:k]
+        return ids[order], scores[order]
+
+    # ---------- 写入（均持有目录锁，且以磁盘上的最新 manifest 为准） ----------
+
+    def append(self, ids: np.ndarray, rows: np.ndarray) -> int:
+        """
+        追加一个新段；已在分区中存活的 chunk_id 跳过（并发的 add 与数据库追赶可能写入同一批行）。
+        已删除后被 SQLite 复用的 chunk_id 视为新行：新段的序号大于墓碑记录的序号，不会被过滤。
+        """
+        with _file_lock(self.dir_path):
+            manifest = read_manifest(self.dir_path) or _empty_manifest(self.dim)
+            fresh = ~np.isin(ids, self._live_on_disk(manifest))
+            if not fresh.any():
+                return 0
+            ids = np.ascontiguousarray(ids[fresh], dtype=np.int64)
+            rows = np.ascontiguousarray(rows[fresh], dtype=np.float32)
+
+            manifest["seq"] += 1
+            name = f"seg_{manifest['seq']:06d}"
+            ids_path, vec_path = self._seg_paths(name)
+            _save_npy(ids_path, ids)
+            _save_npy(vec_path, rows)
+            manifest["segments"].append({"name": name, "seq": manifest["seq"], "count": int(len(ids))})
+            write_manifest(self.dir_path, manifest)
+        return int(len(ids))
+
+    def remove(self, chunk_ids: np.ndarray) -> int:
+        """为本分区中存活的 chunk 写墓碑，墓碑只作用于当前已有的段"""
+        if not len(np.intersect1d(self.live_ids(), chunk_ids)):
+            return 0
+        with _file_lock(self.dir_path):
+            manifest = read_manifest(self.dir_path)
+            if manifest is None:
+                return 0
+            hit = np.intersect1d(self._live_on_disk(manifest), chunk_ids)
+            if not len(hit):
+                return 0
+            tombstones = {int(i): int(seq) for i, seq in manifest["tombstones"]}
+            for chunk_id in hit:
+                tombstones[int(chunk_id)] = manifest["seq"]
+            manifest["tombstones"] = sorted([i, seq] for i, seq in tombstones.items())
+            write_manifest(self.dir_path, manifest)
+        return int(len(hit))
+
+    def needs_compaction(self) -> bool:
+        manifest = read_manifest(self.dir_path)
+        if manifest is None:
+            return False
+        total = sum(seg["count"] for seg in manifest["segments"])
+        if len(manifest["segments"]) > settings.VECTOR_SEGMENT_MAX_COUNT:
+            return True
+        return bool(total) and len(manifest["tombstones"]) / total > settings.VECTOR_SEGMENT_COMPACT_RATIO
+
+    def _write_merged(self, name: str, sources, live: int, dim: int) -> None:
+        ids_path, vec_path = self._seg_paths(name)
+        new_ids = np.empty(live, dtype=np.int64)
+        # 直接写入目标文件的映射，合并过程不在堆上持有整份矩阵
+        tmp_vec_path = vec_path + ".tmp"
+        new_vecs = np.lib.format.open_memmap(
+            tmp_vec_path, mode="w+", dtype=np.float32, shape=(live, dim)
+        )
+        pos = 0
+        for old_name, ids, keep in sources:
+            count = int(keep.sum())
+            if not count:
+                continue
+            vecs = np.load(self._seg_paths(old_name)[1], mmap_mode="r")
+            new_ids[pos:pos + count] = ids[keep]
+            new_vecs[pos:pos + count] = vecs[keep]
+            pos += count
+        new_vecs.flush()
+        del new_vecs
+        os.replace(tmp_vec_path, vec_path)
+        _save_npy(ids_path, new_ids)
+
+    def compact(self) -> None:
+        """把所有存活行合并为一个新段，清空墓碑并删除旧段文件"""
+        with _file_lock(self.dir_path):
+            if not self.needs_compaction():
+                return
+            manifest = read_manifest(self.dir_path)
+            tomb_ids, tomb_seqs = _tombstone_arrays(manifest)
+            dim = manifest["dim"]
+
+            sources = []
+            live = 0
+            for seg in manifest["segments"]:
+                ids_path, vec_path = self._seg_paths(seg["name"])
+                ids = np.load(ids_path, mmap_mode="r")
+                keep = ~_dead_mask(np.asarray(ids), int(seg["seq"]), tomb_ids, tomb_seqs)
+                sources.append((seg["name"], ids, keep))
+                live += int(keep.sum())
+
+            old_names = [seg["name"] for seg in manifest["segments"]]
+            manifest["segments"] = []
+            if live:
+                manifest["seq"] += 1
+                name = f"seg_{manifest['seq']:06d}"
+                self._write_merged(name, sources, live, dim)
+                manifest["segments"].append({"name": name, "seq": manifest["seq"], "count": live})
+            manifest["tombstones"] = []
+            write_manifest(self.dir_path, manifest)
+
+            for old_name in old_names:
+                self._remove_segment_files(old_name)
+            # 清理之前因仍被映射而未能删除的残留段
+            referenced = {seg["name"] for seg in manifest["segments"]}
+            for fname in os.listdir(self.dir_path):
+                if fname.startswith("seg_") and fname.split(".")[0] not in referenced:
+                    _remove_quietly(os.path.join(self.dir_path, fname))
+        db_logger.info(f"[向量段] 压缩完成: {self.dir_path} -> {live} 行")
+
+
+class SegmentVectorIndex(VectorIndex):
+    """
+    以磁盘分段替代常驻内存矩阵的向量索引。
+    数据库仍是唯一的真实来源：首次打开分区时与数据库中的 chunk_id 对比，
+    缺失的 chunk 补写成新段、数据库中已不存在的写墓碑，因此索引目录丢失或落后时会自动重建 / 追赶。
+    """
+
+    def __init__(self, index_dir: Optional[str] = None) -> None:
+        super().__init__()
+        self.index_dir = index_dir or default_index_dir()
+        self._compact_queue: "queue.Queue[SegmentPartition]" = queue.Queue()
+        self._compact_pending: set = set()
+        self._compactor: Optional[threading.Thread] = None
+
+    def _partition_dir(self, key: PartitionKey) -> str:
+        kb_id, model_name = key
+        model_hash = hashlib.sha1((model_name or "").encode("utf-8")).hexdigest()[:12]
+        kb_part = "none" if kb_id is None else str(kb_id)
+        return os.path.join(self.index_dir, f"seg_kb{kb_part}_{model_hash}")
+
+    def _all_dirs(self, prefix: str = "seg_kb") -> List[str]:
+        try:
+            names = os.listdir(self.index_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.index_dir, n) for n in names if n.startswith(prefix)]
+
+    def _kb_dirs(self, kb_id: Optional[int]) -> List[str]:
+        return self._all_dirs(f"seg_kb{'none' if kb_id is None else kb_id}_")
+
+    def _new_partition(self, key: PartitionKey, dim: int) -> SegmentPartition:
+        return SegmentPartition(self._partition_dir(key), dim)
+
+    def _open_existing(self, key: PartitionKey) -> Optional[SegmentPartition]:
+        part = self._partitions.get(key)
+        if part is not None:
+            return part
+        dir_path = self._partition_dir(key)
+        manifest = read_manifest(dir_path)
+        if manifest is None:
+            return None
+        part = SegmentPartition(dir_path, int(manifest["dim"]))
+        self._partitions[key] = part
+        return part
+
+    # ---------- 加载 ----------
+
+    def _load(self, db: Session, kb_id: Optional[int], all_kbs: bool) -> None:
+        q = db.query(
+            models.KnowledgeDocument.kb_id,
+            models.KnowledgeDocument.embedding_model,
+        ).distinct()
+        if not all_kbs:
+            q = q.filter(models.KnowledgeDocument.kb_id == kb_id)
+        for row_kb_id, model_name in q.all():
+            self._sync_from_db(db, (row_kb_id, model_name))
+
+        if all_kbs:
+            self._all_loaded = True
+        else:
+            self._loaded_kbs.add(kb_id)
+
+    def _sync_from_db(self, db: Session, key: PartitionKey) -> None:
+        """
+        与数据库对齐：缺失的 chunk 补写为新段，数据库中已删除的写墓碑。
+        按 id 集合对比而不是按最大 id 追赶，SQLite 复用已删除的 id 时同样能发现新行。
+        """
+        part = self._open_existing(key)
+        kb_id, model_name = key
+
+        def scoped(q):
+            q = q.join(
+                models.KnowledgeDocument,
+                models.KnowledgeChunk.document_id == models.KnowledgeDocument.id,
+            ).filter(models.KnowledgeDocument.kb_id == kb_id)
+            if model_name is None:
+                return q.filter(models.KnowledgeDocument.embedding_model.is_(None))
+            return q.filter(models.KnowledgeDocument.embedding_model == model_name)
+
+        indexed = part.live_ids() if part is not None else np.empty(0, dtype=np.int64)
+        ids: List[int] = []
+        rows: List[np.ndarray] = []
+
+        def collect(chunk_id: int, raw) -> None:
+            emb = decode_embedding(raw)
+            if emb is None or not len(emb):
+                return
+            ids.append(chunk_id)
+            rows.append(emb)
+            if len(ids) >= _BUILD_BATCH:
+                flush()
+
+        def flush() -> None:
+            if ids:
+                self._add_locked(key, ids, rows)
+                ids.clear()
+                rows.clear()
+
+        if not len(indexed):
+            # 新分区：顺序读出全部向量
+            q = scoped(db.query(models.KnowledgeChunk.id, models.KnowledgeChunk.embedding))
+            for chunk_id, raw in q.order_by(models.KnowledgeChunk.id.asc()).yield_per(2000):
+                collect(chunk_id, raw)
+        else:
+            db_ids = np.fromiter(
+                (row[0] for row in scoped(db.query(models.KnowledgeChunk.id)).yield_per(20000)),
+                dtype=np.int64,
+            )
+            stale = np.setdiff1d(indexed, db_ids)
+            if len(stale):
+                part.remove(stale)
+            missing = np.setdiff1d(db_ids, indexed)
+            for start in range(0, len(missing), _FETCH_BATCH):
+                batch = [int(i) for i in missing[start:start + _FETCH_BATCH]]
+                q = db.query(models.KnowledgeChunk.id, models.KnowledgeChunk.embedding).filter(
+                    models.KnowledgeChunk.id.in_(batch)
+                )
+                for chunk_id, raw in q.order_by(models.KnowledgeChunk.id.asc()):
+                    collect(chunk_id, raw)
+        flush()
+        self._schedule_compaction(self._partitions.get(key))
+
+    # ---------- 同步 ----------
+
+    def add(
+        self,
+        kb_id: Optional[int],
+        embedding_model: Optional[str],
+        ids: Sequence[int],
+        embeddings: Sequence[Sequence[float]],
+    ) -> None:
+        """分区已在磁盘上时直接追加新段；否则留给首次检索时从数据库构建"""
+        key = (kb_id, embedding_model)
+        with self._lock:
+            if self._open_existing(key) is None and not self._is_loaded(kb_id):
+                return
+            self._add_locked(key, list(ids), list(embeddings))
+            self._schedule_compaction(self._partitions.get(key))
+
+    def remove_chunks(
+        self,
+        chunk_ids: Iterable[int],
+        kb_id: Optional[int] = None,
+        embedding_model: Optional[str] = None,
+    ) -> None:
+        ids = np.fromiter(chunk_ids, dtype=np.int64)
+        if not len(ids):
+            return
+        with self._lock:
+            # 未指明分区时检查磁盘上的所有候选分区（其他 worker 可能已构建）
+            if kb_id is not None and embedding_model is not None:
+                dirs = [self._partition_dir((kb_id, embedding_model))]
+            elif kb_id is not None:
+                dirs = self._kb_dirs(kb_id)
+            else:
+                dirs = self._all_dirs()
+            opened = {part.dir_path: part for part in self._partitions.values()}
+            for dir_path in dirs:
+                part = opened.get(dir_path)
+                if part is None:
+                    manifest = read_manifest(dir_path)
+                    if manifest is None:
+                        continue
+                    part = SegmentPartition(dir_path, int(manifest["dim"]))
+                if part.remove(ids):
+                    self._schedule_compaction(part)
+
+    def drop_kb(self, kb_id: Optional[int]) -> None:
+        with self._lock:
+            for key in [k for k in self._partitions if k[0] == kb_id]:
+                del self._partitions[key]
+            for dir_path in self._kb_dirs(kb_id):
+                shutil.rmtree(dir_path, ignore_errors=True)
+
+    # ---------- 后台压缩 ----------
+
+    def _schedule_compaction(self, part: Optional[SegmentPartition]) -> None:
+        if part is None or part.dir_path in self._compact_pending:
+            return
+        if not part.needs_compaction():
+            return
+        self._compact_pending.add(part.dir_path)
+        self._compact_queue.put(part)
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(
+                target=self._compact_worker, name="vector-segment-compactor", daemon=True
+            )
+            self._compactor.start()
+
+    def _compact_worker(self) -> None:
+        while True:
+            part = self._compact_queue.get()
+            try:
+                if os.path.isdir(part.dir_path):
+                    part.compact()
+            except Exception as e:
+                db_logger.error(f"[向量段] 压缩失败 {part.dir_path}: {e}")
+            finally:
+                self._compact_pending.discard(part.dir_path)
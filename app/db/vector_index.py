@@ -0,0 +1,293 @@
+# app/db/vector_index.py
+"""
+知识库向量索引
+按 (知识库, 向量模型) 分区常驻内存，保存 L2 归一化后的 float32 矩阵；
+检索时一次矩阵-向量乘法 + argpartition 取 top-k，避免逐条解析 JSON 计算余弦相似度。
+"""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import models
+from app.db.embedding_codec import decode_embedding
+
+# 分区键：(kb_id, embedding_model)
+PartitionKey = Tuple[Optional[int], Optional[str]]
+
+
+def default_index_dir() -> str:
+    """索引文件目录：VECTOR_INDEX_DIR，或 SQLite 数据库文件旁的 vector_index/"""
+    if settings.VECTOR_INDEX_DIR:
+        return settings.VECTOR_INDEX_DIR
+    base_dir = "."
+    if settings.DATABASE_URL.startswith("sqlite"):
+        db_path = settings.DATABASE_URL.replace("sqlite:///", "")
+        base_dir = os.path.dirname(db_path) or "."
+    return os.path.join(base_dir, "vector_index")
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """按行 L2 归一化（零向量保持为零）"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class FlatPartition:
+    """单个 (知识库, 模型) 分区的精确检索实现：ids 与归一化矩阵一一对应"""
+
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+        self.ids = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, dim), dtype=np.float32)
+        # 追加的数据先放入待合并列表，检索前再一次性拼接，避免频繁 vstack
+        self._pending_ids: List[np.ndarray] = []
+        self._pending_rows: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self.ids) + sum(len(p) for p in self._pending_ids)
+
+    def append(self, ids: np.ndarray, rows: np.ndarray) -> None:
+        self._pending_ids.append(ids)
+        self._pending_rows.append(rows)
+
+    def consolidate(self) -> None:
+        if not self._pending_ids:
+            return
+        self.ids = np.concatenate([self.ids] + self._pending_ids)
+        self.matrix = np.vstack([self.matrix] + self._pending_rows)
+        self._pending_ids = []
+        self._pending_rows = []
+
+    def contains(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """chunk_ids 中每个 id 是否已在分区内（布尔掩码）"""
+        self.consolidate()
+        return np.isin(chunk_ids, self.ids)
+
+    def remove(self, chunk_ids: np.ndarray) -> int:
+        self.consolidate()
+        keep = ~np.isin(self.ids, chunk_ids)
+        removed = int(len(keep) - keep.sum())
+        if removed:
+            self.ids = self.ids[keep]
+            self.matrix = self.matrix[keep]
+        return removed
+
+    def top_k(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self.consolidate()
+        n = len(self.ids)
+        if n == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = self.matrix @ query
+        if k < n:
+            idx = np.argpartition(scores, -k)[-k:]
+        else:
+            idx = np.arange(n)
+        idx = idx[np.argsort(scores[idx])[::-1]]
+        return self.ids[idx], scores[idx]
+
+
+class VectorIndex:
+    """
+    进程内向量索引。
+    - 分区按需从数据库加载（首次检索某个知识库时）；
+    - create_knowledge_chunks / delete_knowledge_document / delete_knowledge_base
+      通过 add / remove_chunks / drop_kb 保持同步。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._partitions: Dict[PartitionKey, FlatPartition] = {}
+        self._loaded_kbs: Set[Optional[int]] = set()
+        self._all_loaded = False
+
+    # ---------- 加载 ----------
+
+    def _is_loaded(self, kb_id: Optional[int]) -> bool:
+        return self._all_loaded or kb_id in self._loaded_kbs
+
+    def _load(self, db: Session, kb_id: Optional[int], all_kbs: bool) -> None:
+        q = (
+            db.query(
+                models.KnowledgeChunk.id,
+                models.KnowledgeChunk.embedding,
+                models.KnowledgeDocument.kb_id,
+                models.KnowledgeDocument.embedding_model,
+            )
+            .join(
+                models.KnowledgeDocument,
+                models.KnowledgeChunk.document_id == models.KnowledgeDocument.id,
+            )
+        )
+        if all_kbs:
+            # 全量加载时直接重建，避免与已加载的分区重复
+            self._partitions.clear()
+            self._loaded_kbs.clear()
+        else:
+            q = q.filter(models.KnowledgeDocument.kb_id == kb_id)
+
+        grouped: Dict[PartitionKey, Tuple[List[int], List[np.ndarray]]] = {}
+        for chunk_id, raw, row_kb_id, model_name in q.yield_per(2000):
+            emb = decode_embedding(raw)
+            if emb is None or not len(emb):
+                continue
+            ids, rows = grouped.setdefault((row_kb_id, model_name), ([], []))
+            ids.append(chunk_id)
+            rows.append(emb)
+
+        for key, (ids, rows) in grouped.items():
+            self._add_locked(key, ids, rows)
+
+        if all_kbs:
+            self._all_loaded = True
+        else:
+            self._loaded_kbs.add(kb_id)
+
+    def _add_locked(self, key: PartitionKey, ids: Sequence[int], rows: Sequence[Sequence[float]]) -> None:
+        if not ids:
+            return
+        dim = len(rows[0])
+        # 过滤维度不一致的异常向量
+        pairs = [(i, r) for i, r in zip(ids, rows) if len(r) == dim]
+        if not pairs:
+            return
+        id_arr = np.fromiter((i for i, _ in pairs), dtype=np.int64, count=len(pairs))
+        matrix = normalize_rows(np.asarray([r for _, r in pairs], dtype=np.float32))
+        part = self._partitions.get(key)
+        if part is None or part.dim != dim:
+            # 同一分区出现不同维度（换了模型但沿用名称）时，以新数据为准
+            part = self._new_partition(key, dim)
+            self._partitions[key] = part
+        part.append(id_arr, matrix)
+
+    def _new_partition(self, key: PartitionKey, dim: int):
+        """创建分区，子类可替换为其他检索实现"""
+        return FlatPartition(dim)
+
+    # ---------- 同步 ----------
+
+    def add(
+        self,
+        kb_id: Optional[int],
+        embedding_model: Optional[str],
+        ids: Sequence[int],
+        embeddings: Sequence[Sequence[float]],
+    ) -> None:
+        """
+        新增 chunk 后调用；分区尚未加载时跳过（首次检索时会从数据库加载）。
+        chunk 提交后、add 之前可能有并发检索从数据库加载了同一分区，已在分区内的 id 不再重复追加。
+        """
+        key = (kb_id, embedding_model)
+        with self._lock:
+            if not self._is_loaded(kb_id):
+                return
+            ids, embeddings = list(ids), list(embeddings)
+            part = self._partitions.get(key)
+            if part is not None and ids:
+                known = part.contains(np.asarray(ids, dtype=np.int64))
+                if known.any():
+                    pairs = [(i, e) for i, e, k in zip(ids, embeddings, known) if not k]
+                    ids = [i for i, _ in pairs]
+                    embeddings = [e for _, e in pairs]
+            self._add_locked(key, ids, embeddings)
+
+    def remove_chunks(
+        self,
+        chunk_ids: Iterable[int],
+        kb_id: Optional[int] = None,
+        embedding_model: Optional[str] = None,
+    ) -> None:
+        """删除 chunk；kb_id / embedding_model 为可选的分区提示，用于缩小查找范围"""
+        ids = np.fromiter(chunk_ids, dtype=np.int64)
+        if not len(ids):
+            return
+        with self._lock:
+            for (part_kb, part_model), part in self._partitions.items():
+                if kb_id is not None and part_kb != kb_id:
+                    continue
+                if embedding_model is not None and part_model != embedding_model:
+                    continue
+                part.remove(ids)
+
+    def drop_kb(self, kb_id: Optional[int]) -> None:
+        with self._lock:
+            for key in [k for k in self._partitions if k[0] == kb_id]:
+                del self._partitions[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._partitions.clear()
+            self._loaded_kbs.clear()
+            self._all_loaded = False
+
+    # ---------- 检索 ----------
+
+    def search(
+        self,
+        db: Session,
+        *,
+        query_embedding: Sequence[float],
+        kb_id: Optional[int] = None,
+        embedding_model: Optional[str] = None,
+        top_k: int = 5,
+    ) -> List[Tuple[int, float]]:
+        """
+        返回 [(chunk_id, score), ...]，按相似度降序。
+        kb_id 为空时检索所有知识库；embedding_model 为空时检索所有维度一致的分区。
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.ndim != 1 or not len(query):
+            return []
+        norm = float(np.linalg.norm(query))
+        if norm == 0:
+            return []
+        query = query / norm
+
+        with self._lock:
+            if kb_id is None:
+                if not self._all_loaded:
+                    self._load(db, None, all_kbs=True)
+            elif not self._is_loaded(kb_id):
+                self._load(db, kb_id, all_kbs=False)
+
+            candidates: List[Tuple[np.ndarray, np.ndarray]] = []
+            for (part_kb, part_model), part in self._partitions.items():
+                if kb_id is not None and part_kb != kb_id:
+                    continue
+                if embedding_model is not None and part_model != embedding_model:
+                    continue
+                if part.dim != len(query):
+                    continue
+                candidates.append(part.top_k(query, top_k))
+
+        if not candidates:
+            return []
+        ids = np.concatenate([c[0] for c in candidates])
+        scores = np.concatenate([c[1] for c in candidates])
+        order = np.argsort(scores)[::-1][:top_k]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+
+def create_vector_index() -> VectorIndex:
+    """根据 VECTOR_SEARCH_ENGINE 选择检索引擎"""
+    engine = (settings.VECTOR_SEARCH_ENGINE or "exact").lower()
+    if engine == "pgvector" or (engine == "exact" and settings.DATABASE_URL.startswith("postgresql")):
+        from app.db.pgvector_index import PgVectorIndex
+        return PgVectorIndex()
+    if engine == "ivf":
+        from app.db.ivf_index import IVFIndex
+        return IVFIndex()
+    if engine == "mmap":
+        from app.db.segment_index import SegmentVectorIndex
+        return SegmentVectorIndex()
+    return VectorIndex()
+
+
+# 进程级单例
+vector_index = create_vector_index()
@@ -2,32 +2,41 @@
 from __future__ import annotations
 
 import os
+import re
 import json
-import shutil
 import asyncio
 from typing import Any, Dict, List, Optional
 
 from fastapi import (
     FastAPI,
     Depends,
-    File,
     Form,
     HTTPException,
-    UploadFile,
+    Request,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 
 from app.core.config import settings
 from app.db.database import SessionLocal, engine, Base
 from app.db import crud, models
+from app.db.blob_store import blob_store
 from app.ai.ai_manager import AIManager
+from app.ai.provider_registry import ProviderSnapshot, provider_registry
+from app.ai.tool_call_stream import FUNCTION_CALLS_CLOSE_RE, FUNCTION_CALLS_OPEN_RE, XMLToolCallFilter
 from app.ai import tools as ai_tools
+from app.ai.embedding_cache import embedding_cache
+from app.ai.http_pool import http_pool
+from app.ai.ingestion import IMAGE_EXTENSIONS, ingestion_worker
 from app.ai.mcp_client import mcp_client, MCPClient
 from app.utils.logger import logger, log_api_call, chat_logger
 from app.utils.context_manager import ContextManager
+from app.utils.document_parser import shutdown_pdf_pool
+from app.utils.extraction_cache import extraction_cache
+from app.utils.upload_stream import receive_upload
 
 # OCR 功能(延迟导入,避免启动时加载)
 def get_ocr_module():
@@ -72,6 +81,7 @@ def parse_bool(value: Optional[Any]) -> Optional[bool]:
         return value.strip().lower() in {"1", "true", "yes", "on"}
     return bool(value)
 
+# 全局默认客户端：仅保存 .env / /provider/config 的默认 Provider，处理请求时按会话创建独立客户端
 ai_manager = AIManager()
 
 # MCP 服务器启动事件
@@ -97,10 +107,20 @@ async def startup_event():
     except Exception as e:
         chat_logger.error(f"[MCP] 加载配置失败: {e}")
 
+    # 恢复上次未完成的知识库导入任务
+    try:
+        ingestion_worker.resume_pending()
+    except Exception as e:
+        chat_logger.error(f"[导入任务] 恢复失败: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
-    """应用关闭时停止所有 MCP 服务"""
+    """应用关闭时停止所有 MCP 服务、后台导入线程池和 PDF 抽取进程池，关闭 Provider 连接池"""
     await mcp_client.stop_all()
+    ingestion_worker.shutdown()
+    shutdown_pdf_pool()
+    http_pool.close_all()
+    await http_pool.aclose_all()
 
 # ========== 基础接口 ==========
 
@@ -285,15 +305,57 @@ def create_conversation(
 @app.get("/conversations")
 def list_conversations(
     project_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    with_message_count: bool = False,
     db: Session = Depends(get_db),
 ):
-    """获取对话列表，可按项目筛选"""
-    conversations = crud.get_conversations(db, project_id=project_id)
-    return [conv.to_dict() for conv in conversations]
+    """
+    获取对话列表，可按项目筛选
+    - 不带 limit / cursor：返回全部对话的列表（兼容旧调用方）
+    - 带 limit 或 cursor：keyset 分页，返回 {conversations, has_more, next_cursor}，
+      下一页把 next_cursor 作为 cursor 传入
+    - with_message_count：附带每个对话的消息数（message_count）
+    """
+    after = None
+    if cursor:
+        try:
+            pinned, last_id = cursor.split(":", 1)
+            after = (pinned == "1", int(last_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    paginated = limit is not None or cursor is not None
+    page_size = None
+    if paginated:
+        page_size = min(max(limit or settings.CONVERSATION_PAGE_SIZE, 1), settings.CONVERSATION_PAGE_MAX_SIZE)
+    
+    # 分页时多取一条判断是否还有下一页
+    conversations = crud.get_conversations(
+        db, project_id=project_id, limit=page_size + 1 if paginated else None, after=after
+    )
+    has_more = paginated and len(conversations) > page_size
+    if has_more:
+        conversations = conversations[:page_size]
+    
+    counts = crud.get_message_counts(db, [conv.id for conv in conversations]) if with_message_count else {}
+    items = [conv.to_dict(message_count=counts.get(conv.id)) for conv in conversations]
+    if not paginated:
+        return items
+    
+    next_cursor = None
+    if has_more:
+        last = conversations[-1]
+        next_cursor = f"{1 if last.is_pinned else 0}:{last.id}"
+    return {"conversations": items, "has_more": has_more, "next_cursor": next_cursor}
 
 @app.delete("/conversations/{conversation_id}")
 def delete_conversation(conversation_id: int, db: Session = Depends(get_db)):
+    file_paths = [f.filepath for f in crud.get_uploaded_files(db, conversation_id)]
     crud.delete_conversation(db, conversation_id)
+    # 释放对话文件的引用，没有其他引用的文件随之删除
+    for path in file_paths:
+        blob_store.release(db, path, remove_unmanaged=True)
     return {"success": True}
 
 @app.put("/conversations/{conversation_id}")
@@ -394,8 +456,8 @@ def auto_generate_conversation_title(
 标题:"""
 
     try:
-        # 配置AI Provider
-        _configure_ai_provider_for_conversation(db, conversation)
+        # 获取会话的 AI 客户端
+        ai = _get_ai_client_for_conversation(db, conversation)
         
         # 确定使用的模型:优先参数,其次设置中的 auto_title_model,再次会话全局默认
         selected_model = model
@@ -413,7 +475,7 @@ def auto_generate_conversation_title(
         
         # 添加超时和重试机制
         try:
-            result = ai_manager.chat(title_messages, model=use_model, stream=False)
+            result = ai.chat(title_messages, model=use_model, stream=False)
             # 从结果中提取内容
             if isinstance(result, dict) and "content" in result:
                 generated_title = result["content"]
@@ -515,9 +577,40 @@ def set_conversation_provider(
 # ========== 消息与聊天 ==========
 
 @app.get("/conversations/{conversation_id}/messages")
-def get_messages(conversation_id: int, db: Session = Depends(get_db)):
-    messages = crud.get_messages(db, conversation_id)
-    return [msg.to_dict() for msg in messages]
+def get_messages(
+    conversation_id: int,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    获取对话消息
+    - 不带 before_id / limit：返回全部消息的完整字段（兼容旧调用方）
+    - 带 before_id 或 limit：按游标分页，返回 before_id 之前最新的 limit 条消息（按时间顺序），
+      不含消息详情（工具调用、思考、视觉识别、消息事件），has_details 为真时通过
+      /conversations/{conversation_id}/messages/{message_id}/events 获取
+    """
+    if before_id is None and limit is None:
+        messages = crud.get_messages(db, conversation_id)
+        return [msg.to_dict() for msg in messages]
+    
+    limit = min(max(limit or settings.MESSAGE_PAGE_SIZE, 1), settings.MESSAGE_PAGE_MAX_SIZE)
+    page, has_more = crud.get_messages_page(db, conversation_id, before_id=before_id, limit=limit)
+    return {
+        "messages": [
+            {**msg.to_dict(include_details=False), "has_details": has_details}
+            for msg, has_details in page
+        ],
+        "has_more": has_more,
+    }
+
+@app.get("/conversations/{conversation_id}/messages/{message_id}/events")
+def get_message_events(conversation_id: int, message_id: int, db: Session = Depends(get_db)):
+    """获取单条消息的详情：消息事件流，以及旧格式的工具调用、思考和视觉识别内容"""
+    msg = crud.get_message(db, conversation_id, message_id)
+    if not msg:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return {"id": msg.id, **msg.details_dict()}
 
 @app.post("/conversations/{conversation_id}/messages/partial")
 def save_partial_message(
@@ -554,44 +647,49 @@ def save_partial_message(
     
     return {"success": True, "message_id": msg.id}
 
-def _configure_ai_provider_for_conversation(
+def _with_session(fn, *args, **kwargs):
+    """在独立的短会话中执行 fn(db, *args, **kwargs)，用完立即关闭（供流式响应在线程池中调用）"""
+    db = SessionLocal()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+def _get_ai_client_for_conversation(
     db: Session,
     conversation: models.Conversation,
     override_provider_id: Optional[int] = None,
-) -> None:
+) -> AIManager:
     """
-    根据会话绑定的 provider 或覆盖参数,配置 AIManager 当前使用的 provider.
+    根据会话绑定的 provider 或覆盖参数,创建本次请求使用的 AI 客户端.
+    每次返回新实例,不修改全局 ai_manager,并发请求之间互不影响.
     """
-    provider: Optional[models.Provider] = None
+    provider: Optional[ProviderSnapshot] = None
 
     if override_provider_id is not None:
-        provider = crud.get_provider(db, override_provider_id)
+        provider = provider_registry.get(db, override_provider_id)
     elif conversation.provider_id:
-        provider = crud.get_provider(db, conversation.provider_id)
+        provider = provider_registry.get(db, conversation.provider_id)
 
     # 如果没有找到 provider,尝试使用第一个可用的 provider
     if not provider:
-        all_providers = crud.list_providers(db)
-        if all_providers:
-            provider = all_providers[0]
+        provider = provider_registry.first(db)
 
     if provider:
-        ai_manager.set_provider(
-            api_base=provider.api_base,
-            api_key=provider.api_key,
-            default_model=conversation.model or provider.default_model,
-        )
-    else:
-        # 使用全局默认
-        if not settings.AI_API_BASE:
-            raise HTTPException(status_code=400, detail="未配置任何 Provider,请先在设置中添加 Provider")
-        ai_manager.set_provider(
-            api_base=settings.AI_API_BASE,
-            api_key=settings.AI_API_KEY,
-            default_model=conversation.model or settings.AI_MODEL,
-        )
+        return provider_registry.client(provider, default_model=conversation.model)
+
+    # 使用全局默认(.env 或 /provider/config 的运行时覆盖)
+    default = ai_manager.provider
+    if not default.api_base:
+        raise HTTPException(status_code=400, detail="未配置任何 Provider,请先在设置中添加 Provider")
+    return AIManager.for_provider(
+        api_base=default.api_base,
+        api_key=default.api_key,
+        default_model=conversation.model or default.default_model,
+    )
 
 def _execute_chat_with_tools(
+    ai: AIManager,
     messages: List[Dict[str, Any]], 
     tools_list: List[Dict[str, Any]], 
     model: Optional[str],
@@ -601,10 +699,11 @@ def _execute_chat_with_tools(
     """
     执行带工具的对话,包括工具调用循环
     """
-    content, token_info, _ = _execute_chat_with_tools_streaming(messages, tools_list, model, conversation_id, db)
+    content, token_info, _ = _execute_chat_with_tools_streaming(ai, messages, tools_list, model, conversation_id, db)
     return content, token_info
 
 def _execute_chat_with_tools_streaming(
+    ai: AIManager,
     messages: List[Dict[str, Any]], 
     tools_list: List[Dict[str, Any]], 
     model: Optional[str],
@@ -631,7 +730,7 @@ def _execute_chat_with_tools_streaming(
     
     for iteration in range(max_iterations):
         # 调用模型
-        data = ai_manager.run_with_tools(current_messages, tools=tools_list, model=model, stream=False)
+        data = ai.run_with_tools(current_messages, tools=tools_list, model=model, stream=False)
         
         # 累计token统计
         usage = data.get("usage", {})
@@ -764,7 +863,6 @@ def _execute_tool(function_name: str, function_args: Dict[str, Any], conversatio
             
             # 获取知识库使用的 embedding 模型
             embedding_model = None
-            embedding_provider = None
             
             # 1. 先尝试从知识库文档中获取 embedding 模型
             docs = crud.list_knowledge_documents(db, kb_id=kb_id) if kb_id else crud.list_knowledge_documents(db)
@@ -774,29 +872,10 @@ def _execute_tool(function_name: str, function_args: Dict[str, Any], conversatio
                         embedding_model = doc.embedding_model
                         break
             
-            # 2. 查找 Provider 中的 embedding 模型
-            all_providers = crud.list_providers(db)
-            
-            for provider in all_providers:
-                if provider.models_config:
-                    try:
-                        import json as _json
-                        config = _json.loads(provider.models_config)
-                        for model_name in config.keys():
-                            # 检查是否是 embedding 模型
-                            if "embedding" in model_name.lower() or "embed" in model_name.lower():
-                                if not embedding_model:
-                                    embedding_model = model_name
-                                embedding_provider = provider
-                                break
-                    except Exception:
-                        pass
-                if embedding_provider:
-                    break
-            
-            # 3. 如果还是没找到 embedding Provider,使用第一个 Provider
-            if not embedding_provider and all_providers:
-                embedding_provider = all_providers[0]
+            # 2. 文档里没有记录时，使用 Provider 中配置的第一个 embedding 模型
+            if not embedding_model:
+                configured = provider_registry.embedding_models(db)
+                embedding_model = configured[0] if configured else None
             
             if not embedding_model:
                 return "未配置向量模型,无法进行知识库搜索。请在 Provider 设置中添加 embedding 模型(如 text-embedding-3-small)。"
@@ -806,29 +885,36 @@ def _execute_tool(function_name: str, function_args: Dict[str, Any], conversatio
             if chunks_count == 0:
                 return "知识库中没有向量数据。请重新上传文档,并在上传时选择向量模型(如 text-embedding-3-small)。"
             
-            if embedding_provider:
-                ai_manager.set_provider(
-                    api_base=embedding_provider.api_base,
-                    api_key=embedding_provider.api_key,
-                    default_model=embedding_provider.default_model,
-                )
-            else:
-                return "未配置任何 Provider,无法进行知识库搜索"
+            # 查询向量必须和入库时走同一个 Provider（按模型名查找，与导入任务一致），
+            # 使用独立的客户端,不影响当前对话所用的 Provider
+            embedding_ai = provider_registry.embedding_client(db, embedding_model)
             
             # 创建embedding函数
             final_embedding_model = embedding_model
-            def embedding_fn(texts):
+            def compute_embedding(texts):
                 try:
-                    return ai_manager.create_embedding(texts, model=final_embedding_model)
+                    return embedding_ai.create_embedding(texts, model=final_embedding_model)
                 except Exception as e:
                     chat_logger.error(f"Embedding调用失败: {e}")
                     return None
+
+            def embedding_fn(texts):
+                if not settings.EMBEDDING_CACHE_ENABLED:
+                    return compute_embedding(texts)
+                # 相同 (api_base, 模型, 查询) 命中缓存时不再请求 /embeddings
+                return embedding_cache.get_or_compute(
+                    api_base=embedding_ai.provider.api_base,
+                    model=final_embedding_model,
+                    texts=texts,
+                    compute=compute_embedding,
+                )
             
             return ai_tools.run_search_knowledge_tool(
                 query=query,
                 kb_id=kb_id,
                 top_k=top_k,
                 embedding_fn=embedding_fn,
+                embedding_model=final_embedding_model,
                 use_graph=False  # 已移除知识图谱功能
             )
         
@@ -941,8 +1027,11 @@ def _get_conversation_files_context(
                 })
                 continue
             
-            # 尝试提取文本内容
-            content = extract_text_from_file(file_record.filepath, extract_images=False)
+            # 尝试提取文本内容（相同内容的文件直接复用缓存的解析结果）
+            content = extraction_cache.get_or_compute(
+                file_record.filepath, "text",
+                lambda: extract_text_from_file(file_record.filepath, extract_images=False),
+            )
             
             # 检查是否是支持视觉识别的文档且没有提取到内容
             if ext in vision_doc_extensions and (not content or not content.strip()):
@@ -1001,7 +1090,7 @@ def _recognize_images_with_ocr(
         filename = img_info["filename"]
         
         try:
-            text = ocr_image(filepath)
+            text = extraction_cache.get_or_compute(filepath, "ocr", lambda: ocr_image(filepath))
             if text and text.strip():  # 有内容就用
                 ocr_results.append(f"【图片: {filename}】\n{text}")
             else:
@@ -1039,7 +1128,7 @@ def _recognize_images_with_ocr_stream(
         yield {"type": "progress", "message": f"正在OCR识别 ({idx + 1}/{total}): {filename}"}
         
         try:
-            text = ocr_image(filepath)
+            text = extraction_cache.get_or_compute(filepath, "ocr", lambda: ocr_image(filepath))
             if text and text.strip():
                 # 分块输出
                 for line in text.split('\n'):
@@ -1092,6 +1181,12 @@ def _recognize_docs_with_ocr_stream(
             
             yield {"type": "progress", "message": f"正在OCR识别文档 ({file_idx + 1}/{total_files}): {filename}"}
             
+            cached = extraction_cache.get(extraction_cache.file_digest(filepath), "doc-ocr")
+            if cached:
+                yield {"type": "chunk", "content": cached}
+                yield {"type": "result", "content": f"【文档: {filename}(OCR识别)】\n" + cached}
+                continue
+            
             try:
                 from PIL import Image
                 import io
@@ -1148,7 +1243,9 @@ def _recognize_docs_with_ocr_stream(
                             pass
                 
                 if page_contents:
-                    result_content = f"【文档: {filename}(OCR识别)】\n" + "\n\n".join(page_contents)
+                    body = "\n\n".join(page_contents)
+                    extraction_cache.put(extraction_cache.file_digest(filepath), "doc-ocr", body)
+                    result_content = f"【文档: {filename}(OCR识别)】\n" + body
                     yield {"type": "result", "content": result_content}
                 else:
                     yield {"type": "result", "content": f"【文档: {filename}】\n(OCR未识别到文字)"}
@@ -1167,6 +1264,7 @@ def _recognize_docs_with_ocr_stream(
     yield {"type": "end"}
 
 def _recognize_images_with_vision_model(
+    ai: AIManager,
     db: Session,
     image_files: List[Dict[str, Any]],
     vision_model: str
@@ -1175,12 +1273,13 @@ def _recognize_images_with_vision_model(
     使用视觉模型识别图片内容(同步版本)
     """
     results = []
-    for event in _recognize_images_with_vision_model_stream(db, image_files, vision_model):
+    for event in _recognize_images_with_vision_model_stream(ai, db, image_files, vision_model):
         if event["type"] == "result":
             results.append(event["content"])
     return "\n\n".join(results) if results else ""
 
 def _recognize_images_with_vision_model_stream(
+    ai: AIManager,
     db: Session,
     image_files: List[Dict[str, Any]],
     vision_model: str
@@ -1208,6 +1307,14 @@ def _recognize_images_with_vision_model_stream(
             
             yield {"type": "progress", "message": f"正在识别图片 ({idx + 1}/{total}): {filename}"}
             
+            # 同一张图片、同一视觉模型的描述直接复用
+            digest = extraction_cache.file_digest(filepath)
+            cached = extraction_cache.get(digest, f"vision:{vision_model}")
+            if cached:
+                yield {"type": "chunk", "content": cached}
+                yield {"type": "result", "content": f"【图片: {filename}】\n{cached}"}
+                continue
+            
             # 读取图片并转为 base64
             with open(filepath, "rb") as f:
                 image_data = base64.b64encode(f.read()).decode("utf-8")
@@ -1245,7 +1352,7 @@ def _recognize_images_with_vision_model_stream(
             
             # 调用视觉模型(流式)
             content_parts = []
-            for chunk in ai_manager.chat(messages, model=vision_model, stream=True):
+            for chunk in ai.chat(messages, model=vision_model, stream=True):
                 if isinstance(chunk, dict):
                     chunk_content = chunk.get("content", "")
                 else:
@@ -1256,6 +1363,7 @@ def _recognize_images_with_vision_model_stream(
             
             content = "".join(content_parts)
             if content:
+                extraction_cache.put(digest, f"vision:{vision_model}", content)
                 yield {"type": "result", "content": f"【图片: {filename}】\n{content}"}
                 
         except Exception as e:
@@ -1265,6 +1373,7 @@ def _recognize_images_with_vision_model_stream(
     yield {"type": "end"}
 
 def _recognize_pdf_with_vision_model(
+    ai: AIManager,
     db: Session,
     pdf_files: List[Dict[str, Any]],
     vision_model: str
@@ -1274,12 +1383,13 @@ def _recognize_pdf_with_vision_model(
     支持 PDF、Word、PPT
     """
     results = []
-    for event in _recognize_docs_with_vision_model_stream(db, pdf_files, vision_model):
+    for event in _recognize_docs_with_vision_model_stream(ai, db, pdf_files, vision_model):
         if event["type"] == "result":
             results.append(event["content"])
     return "\n\n".join(results) if results else ""
 
 def _recognize_docs_with_vision_model_stream(
+    ai: AIManager,
     db: Session,
     doc_files: List[Dict[str, Any]],
     vision_model: str
@@ -1306,6 +1416,12 @@ def _recognize_docs_with_vision_model_stream(
             
             yield {"type": "progress", "message": f"正在处理文档 ({file_idx + 1}/{total_files}): {filename}"}
             
+            cached = extraction_cache.get(extraction_cache.file_digest(filepath), f"doc-vision:{vision_model}")
+            if cached:
+                yield {"type": "chunk", "content": cached}
+                yield {"type": "result", "content": f"【文档: {filename}(视觉识别)】\n" + cached}
+                continue
+            
             try:
                 from PIL import Image
                 import io
@@ -1408,7 +1524,7 @@ def _recognize_docs_with_vision_model_stream(
                     
                     # 调用视觉模型(流式)
                     content_parts = []
-                    for chunk in ai_manager.chat(messages, model=vision_model, stream=True):
+                    for chunk in ai.chat(messages, model=vision_model, stream=True):
                         if isinstance(chunk, dict):
                             chunk_content = chunk.get("content", "")
                         else:
@@ -1422,7 +1538,9 @@ def _recognize_docs_with_vision_model_stream(
                         page_contents.append(f"[第 {page_range} 页]\n{content}")
                 
                 if page_contents:
-                    result_content = f"【文档: {filename}(视觉识别)】\n" + "\n\n".join(page_contents)
+                    body = "\n\n".join(page_contents)
+                    extraction_cache.put(extraction_cache.file_digest(filepath), f"doc-vision:{vision_model}", body)
+                    result_content = f"【文档: {filename}(视觉识别)】\n" + body
                     yield {"type": "result", "content": result_content}
                     
             except ImportError as e:
@@ -1730,19 +1848,17 @@ def chat_with_conversation(
         logger.log_error(e, "创建用户消息失败")
         raise
 
-    # 2. 配置 Provider
+    # 2. 获取本次请求的 AI 客户端
     try:
-        _configure_ai_provider_for_conversation(db, conversation, override_provider_id=provider_id)
+        ai = _get_ai_client_for_conversation(db, conversation, override_provider_id=provider_id)
         logger.log_performance("配置Provider", (datetime.now() - start_time).total_seconds())
     except Exception as e:
         logger.log_error(e, "配置Provider失败")
         raise
 
-    # 3. 准备上下文消息(只包含完整问答对)
+    # 3. 准备上下文消息(只包含完整问答对)；历史对话在确定系统提示和工具之后按 token 预算插入
     context_messages = crud.get_context_messages(db, conversation_id)
-    messages: List[Dict[str, Any]] = [
-        {"role": m.role, "content": m.content} for m in context_messages
-    ]
+    messages: List[Dict[str, Any]] = []
     
     # 3.5 读取对话关联的文件内容和图片
     # 获取当前使用的模型
@@ -1750,18 +1866,13 @@ def chat_with_conversation(
     
     # 检查当前模型是否支持视觉
     model_supports_vision = False
-    all_providers = crud.list_providers(db)
+    model_caps: Dict[str, Any] = {}
+    all_providers = provider_registry.list(db)
     for provider in all_providers:
-        if provider.models_config:
-            try:
-                import json as _json
-                config = _json.loads(provider.models_config)
-                if current_model in config:
-                    caps = config[current_model]
-                    model_supports_vision = caps.get("vision", False)
-                    break
-            except:
-                pass
+        if current_model in provider.models_config:
+            model_caps = provider.capabilities(current_model)
+            model_supports_vision = model_caps.get("vision", False)
+            break
     
     # 读取文件内容、图片列表和需要视觉识别的文档（只处理未处理的文件）
     file_context, image_files, files_need_vision, processed_file_ids = _get_conversation_files_context(db, conversation_id, only_unprocessed=True)
@@ -1786,15 +1897,13 @@ def chat_with_conversation(
             default_vision_model = vision_value
             # 遍历所有 provider 查找包含该模型的 provider
             for p in all_providers:
-                if p.models_config:
-                    try:
-                        import json as _json
-                        config = _json.loads(p.models_config)
-                        if default_vision_model in config:
-                            vision_provider_id = p.id
-                            break
-                    except:
-                        pass
+                if default_vision_model in p.models_config:
+                    vision_provider_id = p.id
+                    break
+    
+    # 视觉识别使用视觉模型所在 Provider 的独立客户端,找不到时沿用当前对话的客户端
+    vision_provider = provider_registry.get(db, vision_provider_id)
+    vision_ai = provider_registry.client(vision_provider, default_model=default_vision_model) if vision_provider else ai
     
     # 准备需要视觉识别的文件列表(延迟到流式处理中执行)
     images_need_vision = []  # 需要视觉模型识别的图片
@@ -1854,21 +1963,7 @@ def chat_with_conversation(
         if image_files and not model_supports_vision:
             if vision_mode == "vision" and default_vision_model:
                 # 用户选择视觉模型识别
-                if vision_provider_id:
-                    vision_provider = crud.get_provider(db, vision_provider_id)
-                    if vision_provider:
-                        ai_manager.set_provider(
-                            api_base=vision_provider.api_base,
-                            api_key=vision_provider.api_key,
-                            default_model=default_vision_model
-                        )
-                image_context = _recognize_images_with_vision_model(db, image_files, default_vision_model)
-                if vision_provider_id and provider:
-                    ai_manager.set_provider(
-                        api_base=provider.api_base,
-                        api_key=provider.api_key,
-                        default_model=model
-                    )
+                image_context = _recognize_images_with_vision_model(vision_ai, db, image_files, default_vision_model)
             elif vision_mode == "ocr":
                 # 用户选择本地OCR
                 ocr_context, _ = _recognize_images_with_ocr(image_files, use_ocr=True)
@@ -1878,26 +1973,7 @@ def chat_with_conversation(
         
         # 处理需要视觉模型识别的文档
         if docs_need_vision and default_vision_model:
-            
-            # 如果有指定视觉模型的 provider,切换到该 provider
-            if vision_provider_id:
-                vision_provider = crud.get_provider(db, vision_provider_id)
-                if vision_provider:
-                    ai_manager.set_provider(
-                        api_base=vision_provider.api_base,
-                        api_key=vision_provider.api_key,
-                        default_model=default_vision_model
-                    )
-            
-            doc_context = _recognize_pdf_with_vision_model(db, docs_need_vision, default_vision_model)
-            
-            # 恢复原来的 provider
-            if vision_provider_id and provider:
-                ai_manager.set_provider(
-                    api_base=provider.api_base,
-                    api_key=provider.api_key,
-                    default_model=model
-                )
+            doc_context = _recognize_pdf_with_vision_model(vision_ai, db, docs_need_vision, default_vision_model)
         
         # 处理需要OCR识别的文档（场景2：模型不支持视觉且未勾选眼睛按钮）
         if docs_need_ocr:
@@ -2016,9 +2092,6 @@ def chat_with_conversation(
     else:
         messages.append({"role": "user", "content": user_content})
 
-    # 优化上下文，限制对话轮数
-    messages = ContextManager.optimize_messages(messages, max_turns=6)
-
     # 如果对话关联了项目，且项目有系统提示词，添加到消息开头
     if conversation.project and conversation.project.system_prompt:
         project_system_prompt = conversation.project.system_prompt.strip()
@@ -2075,6 +2148,14 @@ def chat_with_conversation(
         enable_web_search=smart_tools['web_search'],
     )
 
+    # 按模型上下文窗口插入历史对话(系统提示、当前消息和工具定义的 token 先预留)
+    messages = ContextManager.build_context(
+        messages,
+        context_messages,
+        budget=ContextManager.context_budget(model_caps),
+        tools=tools_list,
+    )
+
     # 记录聊天上下文
     logger.log_chat_context(messages, tools_list)
 
@@ -2086,8 +2167,8 @@ def chat_with_conversation(
         try:
             # 记录AI API调用
             logger.log_ai_api_call(
-                api_base=ai_manager._provider.api_base,
-                model=model or ai_manager._provider.default_model,
+                api_base=ai.provider.api_base,
+                model=model or ai.provider.default_model,
                 messages_count=len(messages),
                 tools_count=len(tools_list),
                 stream=False
@@ -2096,10 +2177,10 @@ def chat_with_conversation(
             if use_tools:
                 # 执行带工具的对话，包括工具调用循环
                 content, token_info = _execute_chat_with_tools(
-                    messages, tools_list, model, conversation_id, db
+                    ai, messages, tools_list, model, conversation_id, db
                 )
             else:
-                result = ai_manager.chat(messages, model=model, stream=False)
+                result = ai.chat(messages, model=model, stream=False)
                 content = result["content"]
                 token_info = {
                     "model": result["model"],
@@ -2168,7 +2249,9 @@ def chat_with_conversation(
             raise HTTPException(status_code=500, detail=f"AI调用失败: {str(e)}")
 
     # 流式:返回 StreamingResponse，最终拼接完整文本写入 DB
-    def event_stream():
+    async def event_stream():
+        # 异步生成器：等待模型输出时不占用线程，数据库读写、工具执行、OCR 和视觉识别放到线程池；
+        # 数据库读写各自使用短会话（_with_session），流式输出期间不占用连接池中的连接
         nonlocal messages  # 需要修改外部的 messages 变量
         accumulated = []
         token_info = None
@@ -2184,11 +2267,24 @@ def chat_with_conversation(
                 "timestamp": time.time()
             })
         
+        def emit_filter_event(event) -> str:
+            """把 XMLToolCallFilter 输出的事件转为 SSE 文本，并记录正文和消息事件"""
+            kind, text = event
+            if kind == "text":
+                accumulated.append(text)
+                add_event("text", text)
+                return f"data: {json.dumps(text, ensure_ascii=False)}\n\n"
+            if kind == "thinking_end":
+                if text:
+                    add_event("thinking", text)
+                return f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(text, ensure_ascii=False)}}}\n\n"
+            return f"event: thinking\ndata: {json.dumps(text, ensure_ascii=False)}\n\n"
+        
         # 记录流式输出开始
         chat_logger.info(f"[STREAM] 开始流式输出，对话ID: {conversation_id}, 模型: {model}")
         
         # 首先发送 ack 事件，确认用户消息已保存
-        yield f"event: ack\ndata: {{\"user_message_id\": {user_msg.id}}}\n\n"
+        yield f"event: ack\ndata: {{\"user_message_id\": {user_msg_id}}}\n\n"
         
         # 流式模式下执行视觉识别(如果需要)
         stream_image_context = ""
@@ -2201,17 +2297,8 @@ def chat_with_conversation(
         if image_files and not model_supports_vision:
             if vision_mode == "vision" and default_vision_model:
                 # 用户选择视觉模型识别
-                if vision_provider_id:
-                    vision_provider = crud.get_provider(db, vision_provider_id)
-                    if vision_provider:
-                        ai_manager.set_provider(
-                            api_base=vision_provider.api_base,
-                            api_key=vision_provider.api_key,
-                            default_model=default_vision_model
-                        )
-                
                 image_results = []
-                for event in _recognize_images_with_vision_model_stream(db, image_files, default_vision_model):
+                async for event in iterate_in_threadpool(_recognize_images_with_vision_model_stream(vision_ai, db, image_files, default_vision_model)):
                     if event["type"] == "start":
                         yield f"event: vision_start\ndata: {json.dumps({'model': event['model'], 'total': event['total'], 'file_type': event['file_type'], 'message': '正在进行图片识别...'}, ensure_ascii=False)}\n\n"
                     elif event["type"] == "progress":
@@ -2226,24 +2313,17 @@ def chat_with_conversation(
                 if stream_image_context:
                     vision_content_parts.append(stream_image_context)
                     add_event("vision", stream_image_context)
-                
-                if vision_provider_id and provider:
-                    ai_manager.set_provider(
-                        api_base=provider.api_base,
-                        api_key=provider.api_key,
-                        default_model=model
-                    )
             elif vision_mode == "ocr":
                 # 用户选择本地OCR
                 # 检查 OCR 是否可用
-                ocr_image_fn, is_ocr_available_fn = get_ocr_module()
-                ocr_available = is_ocr_available_fn() if is_ocr_available_fn else False
+                ocr_image_fn, is_ocr_available_fn = await run_in_threadpool(get_ocr_module)
+                ocr_available = await run_in_threadpool(is_ocr_available_fn) if is_ocr_available_fn else False
                 chat_logger.info(f"[STREAM] OCR 可用性检查: ocr_available={ocr_available}")
                 
                 # 发送开始事件
                 yield f"event: vision_start\ndata: {json.dumps({'model': '本地OCR', 'total': len(image_files), 'file_type': 'image', 'message': '正在进行图片识别...'}, ensure_ascii=False)}\n\n"
                 
-                ocr_context, _ = _recognize_images_with_ocr(image_files, use_ocr=True)
+                ocr_context, _ = await run_in_threadpool(_recognize_images_with_ocr, image_files, use_ocr=True)
                 if ocr_context:
                     yield f"event: vision_progress\ndata: {json.dumps({'message': 'OCR识别完成'}, ensure_ascii=False)}\n\n"
                     for line in ocr_context.split('\n'):
@@ -2260,18 +2340,8 @@ def chat_with_conversation(
         # 处理需要视觉模型识别的文档（场景1和场景3）
         if docs_need_vision and default_vision_model and not model_supports_vision:
             # 场景3：模型不支持视觉，勾选了眼睛按钮，用视觉模型识别文档
-            # 如果有指定视觉模型的 provider，切换到该 provider
-            if vision_provider_id:
-                vision_provider = crud.get_provider(db, vision_provider_id)
-                if vision_provider:
-                    ai_manager.set_provider(
-                        api_base=vision_provider.api_base,
-                        api_key=vision_provider.api_key,
-                        default_model=default_vision_model
-                    )
-            
             doc_results = []
-            for event in _recognize_docs_with_vision_model_stream(db, docs_need_vision, default_vision_model):
+            async for event in iterate_in_threadpool(_recognize_docs_with_vision_model_stream(vision_ai, db, docs_need_vision, default_vision_model)):
                 if event["type"] == "start":
                     yield f"event: vision_start\ndata: {json.dumps({'model': event['model'], 'total': event['total'], 'file_type': event['file_type'], 'message': '正在进行文档识别...'}, ensure_ascii=False)}\n\n"
                 elif event["type"] == "progress":
@@ -2286,19 +2356,11 @@ def chat_with_conversation(
             if stream_doc_context:
                 vision_content_parts.append(stream_doc_context)
                 add_event("vision", stream_doc_context)
-            
-            # 恢复原来的 provider
-            if vision_provider_id and provider:
-                ai_manager.set_provider(
-                    api_base=provider.api_base,
-                    api_key=provider.api_key,
-                    default_model=model
-                )
         
         # 处理需要OCR识别的文档（场景2：模型不支持视觉且未勾选眼睛按钮）
         if docs_need_ocr:
             doc_ocr_results = []
-            for event in _recognize_docs_with_ocr_stream(docs_need_ocr):
+            async for event in iterate_in_threadpool(_recognize_docs_with_ocr_stream(docs_need_ocr)):
                 if event["type"] == "start":
                     yield f"event: vision_start\ndata: {json.dumps({'model': event['model'], 'total': event['total'], 'file_type': event['file_type'], 'message': '正在OCR识别文档...'}, ensure_ascii=False)}\n\n"
                 elif event["type"] == "progress":
@@ -2374,7 +2436,7 @@ def chat_with_conversation(
                         tool_call_id = msg.get('tool_call_id')
                         content_preview = str(content)[:50] if content else 'None'
                     
-                    data = ai_manager.run_with_tools(current_messages, tools=tools_list, model=model, stream=False)
+                    data = await ai.arun_with_tools(current_messages, tools=tools_list, model=model, stream=False)
                     
                     usage = data.get("usage", {})
                     total_input_tokens += usage.get("prompt_tokens", 0)
@@ -2449,7 +2511,9 @@ def chat_with_conversation(
                         tool_calls_info.append(tool_info)
                         
                         try:
-                            result = _execute_tool(function_name, function_args, conversation_id, db)
+                            result = await run_in_threadpool(
+                                _with_session, lambda s: _execute_tool(function_name, function_args, conversation_id, s)
+                            )
                             tool_info["status"] = "success"
                             # 提取结果预览
                             result_preview = result[:150] + "..." if len(result) > 150 else result
@@ -2488,11 +2552,6 @@ def chat_with_conversation(
                 final_response_iterations = 0
                 max_final_iterations = 5  # 深度思考阶段最多允许的额外工具调用轮数
                 
-                # 初始化 XML 工具调用相关变量(在循环外)
-                xml_tool_buffer = ""
-                in_xml_tool_call = False
-                has_xml_tool_call = False
-                
                 while final_response_iterations < max_final_iterations:
                     final_response_iterations += 1
                     
@@ -2500,14 +2559,14 @@ def chat_with_conversation(
                     if enable_thinking and not is_thinking_done:
                         yield f"event: thinking_start\ndata: {{\"status\": \"thinking\", \"message\": \"正在深度思考...\"}}\n\n"
                     
-                    # 重置待输出内容(每次迭代都重置)
-                    pending_output = []  # 待输出的内容，用于延迟输出以检测 XML 工具调用
+                    # 每轮使用新的过滤器：增量检测正文 / 思考内容中的 XML 工具调用，
+                    # 可能是标签开头的内容延迟输出，工具调用内容不推给前端
+                    xml_filter = XMLToolCallFilter(enable_thinking)
                     
                     # 标记是否已经有正文内容(用于判断 reasoning_content 是否应该作为正文)
                     has_real_content = False
-                    thinking_buffer = []  # 用于累积思考内容，检测XML工具调用
                     
-                    for chunk in ai_manager.chat(current_messages, model=model, stream=True, enable_thinking=enable_thinking):
+                    async for chunk in await ai.achat(current_messages, model=model, stream=True, enable_thinking=enable_thinking):
                         if isinstance(chunk, dict):
                             chunk_type = chunk.get("type", "")
                             
@@ -2521,73 +2580,8 @@ def chat_with_conversation(
                             if chunk_type == "thinking":
                                 thinking = chunk.get("content", "")
                                 if thinking:
-                                    thinking_content.append(thinking)
-                                    thinking_buffer.append(thinking)
-                                    
-                                    # 检测思考内容中是否有XML工具调用
-                                    thinking_so_far = "".join(thinking_buffer)
-                                    import re
-                                    # 支持多种格式: <function_calls>, <| DSML | function_calls>, <function_calls> 等
-                                    fc_match = re.search(r'<[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', thinking_so_far, re.IGNORECASE)
-                                    if fc_match:
-                                        # 发送思考结束事件(只发送 <function_calls> 之前的内容)
-                                        fc_start = fc_match.start()
-                                        thinking_before_fc = thinking_so_far[:fc_start]
-                                        if thinking_before_fc.strip():
-                                            yield f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(thinking_before_fc, ensure_ascii=False)}}}\n\n"
-                                            add_event("thinking", thinking_before_fc)
-                                        is_thinking_done = True
-                                        
-                                        # 开始收集XML工具调用
-                                        in_xml_tool_call = True
-                                        xml_tool_buffer = thinking_so_far[fc_start:]
-                                        thinking_buffer = []  # 清空缓冲区
-                                        
-                                        # 检测是否已经结束
-                                        # 支持多种格式: </function_calls>, </| DSML | function_calls>
-                                        if re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', xml_tool_buffer, re.IGNORECASE):
-                                            in_xml_tool_call = False
-                                            has_xml_tool_call = True
-                                        continue
-                                    
-                                    # 如果正在收集XML工具调用，继续收集
-                                    if in_xml_tool_call:
-                                        xml_tool_buffer += thinking
-                                        # 支持多种格式
-                                        if re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', xml_tool_buffer, re.IGNORECASE):
-                                            in_xml_tool_call = False
-                                            has_xml_tool_call = True
-                                        continue
-                                    
-                                    # 检测是否可能是 XML 工具调用的开始（需要等待更多内容）
-                                    # 检查最后是否有未完成的 < 标签
-                                    potential_xml_in_thinking = False
-                                    if '<' in thinking_so_far:
-                                        last_lt_pos = thinking_so_far.rfind('<')
-                                        remaining = thinking_so_far[last_lt_pos:].lower().replace(' ', '').replace('\n', '')
-                                        # 检查是否可能是 <function_calls> 或 <| DSML | function_calls> 的开始
-                                        possible_starts = ['<function_calls>', '<|dsml|function_calls>', '<|', '<f', '<fu', '<fun', '<func', '<funct', '<functi', '<functio', '<function', '<function_', '<function_c', '<function_ca', '<function_cal', '<function_call', '<function_calls', '<ds', '<dsm', '<dsml']
-                                        for ps in possible_starts:
-                                            if ps.startswith(remaining) or remaining.startswith(ps.rstrip('>')):
-                                                potential_xml_in_thinking = True
-                                                break
-                                    
-                                    if potential_xml_in_thinking:
-                                        # 可能是 XML 开始，暂不发送，继续缓冲
-                                        continue
-                                    
-                                    # 不是 XML，发送思考内容
-                                    # 但只发送到最后一个 < 之前的内容（如果有的话）
-                                    if '<' in thinking_so_far:
-                                        last_lt_pos = thinking_so_far.rfind('<')
-                                        safe_content = thinking_so_far[:last_lt_pos]
-                                        if safe_content.strip():
-                                            yield f"event: thinking\ndata: {json.dumps(safe_content, ensure_ascii=False)}\n\n"
-                                        # 保留 < 之后的内容继续缓冲
-                                        thinking_buffer = [thinking_so_far[last_lt_pos:]]
-                                    else:
-                                        yield f"event: thinking\ndata: {json.dumps(thinking_so_far, ensure_ascii=False)}\n\n"
-                                        thinking_buffer = []  # 清空缓冲区
+                                    for event in xml_filter.feed_thinking(thinking):
+                                        yield emit_filter_event(event)
                                 continue
                             
                             # 处理正文内容
@@ -2601,163 +2595,18 @@ def chat_with_conversation(
                             delta = str(chunk)
                         
                         if delta:
-                            # 如果已经在收集 XML 工具调用，继续收集
-                            if in_xml_tool_call:
-                                xml_tool_buffer += delta
-                                # 检测工具调用结束(支持多种格式)
-                                import re
-                                if re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', xml_tool_buffer, re.IGNORECASE):
-                                    in_xml_tool_call = False
-                                    has_xml_tool_call = True
-                                continue
-                            
-                            # 累积内容用于检测 XML 工具调用开始
-                            pending_output.append(delta)
-                            pending_content = "".join(pending_output)
-                            
-                            # 检测是否可能是 XML 工具调用的开始
-                            # 检查是否包含 < 且可能是 <function_calls> 的开始
-                            potential_xml_start = False
-                            if "<" in pending_content:
-                                # 检查是否是 <function_calls> 或其变体的部分匹配
-                                last_lt_pos = pending_content.rfind("<")
-                                remaining = pending_content[last_lt_pos:].lower().replace(" ", "").replace("\n", "")
-                                # 检查是否是各种变体的开始（包括 <function_calls>）
-                                # 完整的目标标签列表
-                                target_tags = [
-                                    '<function_calls>',
-                                    '<function_calls>',
-                                    '<|dsml|function_calls>',
-                                ]
-                                # 生成所有可能的前缀
-                                possible_prefixes = set()
-                                for tag in target_tags:
-                                    for i in range(1, len(tag)):
-                                        possible_prefixes.add(tag[:i].lower())
-                                
-                                # 检查 remaining 是否是某个目标标签的前缀
-                                for tag in target_tags:
-                                    tag_lower = tag.lower()
-                                    if tag_lower.startswith(remaining) and len(remaining) < len(tag_lower):
-                                        potential_xml_start = True
-                                        break
-                                
-                                # 如果缓冲内容太长（超过50字符）还没匹配到，说明不是 XML
-                                if potential_xml_start and len(remaining) > 50:
-                                    potential_xml_start = False
-                            
-                            # 检测完整的 <function_calls> 标签(支持多种格式)
-                            # 使用正则表达式进行更灵活的匹配
-                            import re
-                            fc_match = re.search(r'<[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', pending_content, re.IGNORECASE)
-                            if fc_match:
-                                in_xml_tool_call = True
-                                fc_start = fc_match.start()
-                                # 输出 <function_calls> 之前的内容
-                                if fc_start > 0:
-                                    before_fc = pending_content[:fc_start]
-                                    if before_fc.strip():
-                                        # 发送思考结束事件
-                                        if enable_thinking and not is_thinking_done:
-                                            is_thinking_done = True
-                                            full_thinking = "".join(thinking_content) if thinking_content else ""
-                                            yield f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(full_thinking, ensure_ascii=False)}}}\n\n"
-                                            # 记录思考事件
-                                            if full_thinking:
-                                                add_event("thinking", full_thinking)
-                                        yield f"data: {json.dumps(before_fc, ensure_ascii=False)}\n\n"
-                                        accumulated.append(before_fc)
-                                        # 记录正文事件
-                                        add_event("text", before_fc)
-                                # 开始收集工具调用内容
-                                xml_tool_buffer = pending_content[fc_start:]
-                                pending_output = []
-                                # 检测工具调用是否已经结束(支持多种格式)
-                                fc_end_match = re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', xml_tool_buffer, re.IGNORECASE)
-                                if fc_end_match:
-                                    in_xml_tool_call = False
-                                    has_xml_tool_call = True
-                                continue
-                            
-                            # 如果可能是 XML 开始，继续等待更多内容
-                            if potential_xml_start:
-                                continue
-                            
-                            # 不是 XML 工具调用，正常输出
-                            # 如果启用了深度思考且还没发送结束事件，在开始输出正文时发送
-                            if enable_thinking and not is_thinking_done:
-                                is_thinking_done = True
-                                full_thinking = "".join(thinking_content) if thinking_content else ""
-                                yield f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(full_thinking, ensure_ascii=False)}}}\n\n"
-                                # 记录思考事件
-                                if full_thinking:
-                                    add_event("thinking", full_thinking)
-                            
-                            # 输出所有待输出的内容
-                            output_content = "".join(pending_output)
-                            if output_content:
-                                accumulated.append(output_content)
-                                yield f"data: {json.dumps(output_content, ensure_ascii=False)}\n\n"
-                                # 记录正文事件
-                                add_event("text", output_content)
-                            pending_output = []
+                            for event in xml_filter.feed_content(delta):
+                                yield emit_filter_event(event)
                     
-                    # 流结束后，检查思考内容中是否有未处理的 XML 工具调用
-                    if thinking_buffer and not in_xml_tool_call and not has_xml_tool_call:
-                        thinking_so_far = "".join(thinking_buffer)
-                        import re
-                        # 支持多种格式
-                        fc_match = re.search(r'<[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', thinking_so_far, re.IGNORECASE)
-                        if fc_match:
-                            fc_start = fc_match.start()
-                            xml_tool_buffer = thinking_so_far[fc_start:]
-                            if re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', xml_tool_buffer, re.IGNORECASE):
-                                has_xml_tool_call = True
-                                # 发送思考结束事件(只发送 <function_calls> 之前的内容)
-                                thinking_before_fc = thinking_so_far[:fc_start]
-                                if thinking_before_fc.strip() and not is_thinking_done:
-                                    yield f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(thinking_before_fc, ensure_ascii=False)}}}\n\n"
-                                    add_event("thinking", thinking_before_fc)
-                                    is_thinking_done = True
-                    
-                    # 流结束后，处理剩余内容
-                    # 如果正在收集 XML 工具调用，检查是否完整
-                    if in_xml_tool_call:
-                        import re
-                        if re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', xml_tool_buffer, re.IGNORECASE):
-                            in_xml_tool_call = False
-                            has_xml_tool_call = True
-                        else:
-                            # XML 不完整，作为普通内容输出
-                            if enable_thinking and not is_thinking_done:
-                                is_thinking_done = True
-                                full_thinking = "".join(thinking_content) if thinking_content else ""
-                                yield f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(full_thinking, ensure_ascii=False)}}}\n\n"
-                                if full_thinking:
-                                    add_event("thinking", full_thinking)
-                            accumulated.append(xml_tool_buffer)
-                            yield f"data: {json.dumps(xml_tool_buffer, ensure_ascii=False)}\n\n"
-                            add_event("text", xml_tool_buffer)
-                            in_xml_tool_call = False
-                    
-                    # 输出剩余的待输出内容
-                    if pending_output and not in_xml_tool_call:
-                        if enable_thinking and not is_thinking_done:
-                            is_thinking_done = True
-                            full_thinking = "".join(thinking_content) if thinking_content else ""
-                            yield f"event: thinking_end\ndata: {{\"thinking\": {json.dumps(full_thinking, ensure_ascii=False)}}}\n\n"
-                            # 记录思考事件
-                            if full_thinking:
-                                add_event("thinking", full_thinking)
-                        output_content = "".join(pending_output)
-                        if output_content:
-                            accumulated.append(output_content)
-                            yield f"data: {json.dumps(output_content, ensure_ascii=False)}\n\n"
-                            # 记录正文事件
-                            add_event("text", output_content)
+                    # 流结束后，处理不完整的 XML 工具调用和剩余的待输出内容
+                    for event in xml_filter.finish():
+                        yield emit_filter_event(event)
+                    is_thinking_done = xml_filter.is_thinking_done
+                    thinking_content = xml_filter.thinking_content
                     
                     # 检查是否有 XML 工具调用需要执行
-                    if has_xml_tool_call:
+                    if xml_filter.has_xml_tool_call:
+                        xml_tool_buffer = xml_filter.xml_tool_buffer
                         
                         # 解析 XML 工具调用(支持多种格式)
                         # 支持: <invoke name="...">, <| DSML | invoke name="...">, <invoke name="...">
@@ -2801,7 +2650,9 @@ def chat_with_conversation(
                             tool_calls_info.append(tool_info)
                             
                             try:
-                                result = _execute_tool(tool_name, params, conversation_id, db)
+                                result = await run_in_threadpool(
+                                    _with_session, lambda s: _execute_tool(tool_name, params, conversation_id, s)
+                                )
                                 tool_info["status"] = "success"
                                 tool_info["result_preview"] = result[:100] + "..." if len(result) > 100 else result
                                 xml_tool_results.append(f"工具 {tool_name} 执行结果:\n{result}")
@@ -2841,9 +2692,6 @@ def chat_with_conversation(
                         # 重置状态，继续下一轮
                         is_thinking_done = False
                         thinking_content = []  # 清空思考内容，准备新一轮
-                        xml_tool_buffer = ""  # 重置 XML 工具调用缓冲区
-                        in_xml_tool_call = False
-                        has_xml_tool_call = False
                         continue
                     else:
                         # 没有工具调用，结束循环
@@ -2863,9 +2711,8 @@ def chat_with_conversation(
                     full_thinking_as_content = "".join(thinking_content)
                     
                     # 检查是否有 XML 工具调用(支持多种格式)
-                    import re
-                    fc_match = re.search(r'<[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', full_thinking_as_content, re.IGNORECASE)
-                    fc_end_match = re.search(r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>', full_thinking_as_content, re.IGNORECASE)
+                    fc_match = FUNCTION_CALLS_OPEN_RE.search(full_thinking_as_content)
+                    fc_end_match = FUNCTION_CALLS_CLOSE_RE.search(full_thinking_as_content)
                     
                     if fc_match and fc_end_match:
                         has_xml_tool_call = True
@@ -2912,13 +2759,15 @@ def chat_with_conversation(
                 full_thinking = "".join(thinking_content) if thinking_content else None
                 full_vision = "\n\n".join(vision_content_parts) if vision_content_parts else None
                 message_events_json = json.dumps(message_events, ensure_ascii=False) if message_events else None
-                crud.create_message(db, conversation_id, "assistant", full_text, token_info, 
-                                   tool_calls=tool_calls_json, thinking_content=full_thinking,
-                                   vision_content=full_vision, message_events=message_events_json)
+                await run_in_threadpool(
+                    _with_session, crud.create_message, conversation_id, "assistant", full_text, token_info,
+                    tool_calls=tool_calls_json, thinking_content=full_thinking,
+                    vision_content=full_vision, message_events=message_events_json,
+                )
                 
                 # 标记文件为已处理
                 if processed_file_ids:
-                    crud.mark_files_as_processed(db, processed_file_ids)
+                    await run_in_threadpool(_with_session, crud.mark_files_as_processed, processed_file_ids)
                 
             except Exception as e:
                 chat_logger.error(f"[STREAM] 工具模式错误: {str(e)}")
@@ -2939,7 +2788,7 @@ def chat_with_conversation(
                     yield f"event: thinking_start\ndata: {{\"status\": \"thinking\", \"message\": \"正在深度思考...\"}}\n\n"
                 
                 # 普通流式对话，直接消费 include_usage 终结器
-                for chunk in ai_manager.chat(messages, model=model, stream=True, enable_thinking=enable_thinking):
+                async for chunk in await ai.achat(messages, model=model, stream=True, enable_thinking=enable_thinking):
                     if isinstance(chunk, dict):
                         if chunk.get("type") == "usage":
                             token_info = chunk.get("usage")
@@ -3013,45 +2862,71 @@ def chat_with_conversation(
                 full_thinking = "".join(thinking_content) if thinking_content else None
                 full_vision = "\n\n".join(vision_content_parts) if vision_content_parts else None
                 message_events_json = json.dumps(message_events, ensure_ascii=False) if message_events else None
-                crud.create_message(db, conversation_id, "assistant", full_text, token_info,
-                                   tool_calls=None, thinking_content=full_thinking,
-                                   vision_content=full_vision, message_events=message_events_json)
+                await run_in_threadpool(
+                    _with_session, crud.create_message, conversation_id, "assistant", full_text, token_info,
+                    tool_calls=None, thinking_content=full_thinking,
+                    vision_content=full_vision, message_events=message_events_json,
+                )
                 
                 # 标记文件为已处理
                 if processed_file_ids:
-                    crud.mark_files_as_processed(db, processed_file_ids)
+                    await run_in_threadpool(_with_session, crud.mark_files_as_processed, processed_file_ids)
                 
             except Exception as e:
                 chat_logger.error(f"[STREAM] 普通模式错误: {str(e)}")
                 yield f"data: [错误] {str(e)}\n\n"
                 yield "data: [DONE]\n\n"
 
+    # 请求的数据库会话到此为止，归还连接；否则每个流式响应都会占住一个连接直到生成结束
+    user_msg_id = user_msg.id
+    db.close()
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 # ========== 文件上传(对话级) ==========
 
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = settings.UPLOAD_DIR
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-@app.post("/upload")
-def upload_file(
-    conversation_id: int = Form(...),
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db),
-):
-    conversation = crud.get_conversation(db, conversation_id)
-    if not conversation:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-
-    save_dir = os.path.join(UPLOAD_DIR, str(conversation_id))
-    os.makedirs(save_dir, exist_ok=True)
+def _form_int(fields: Dict[str, str], name: str) -> Optional[int]:
+    value = (fields.get(name) or "").strip()
+    if not value or value in ("null", "undefined"):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"参数 {name} 必须是整数")
 
-    save_path = os.path.join(save_dir, file.filename)
-    with open(save_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+@app.post("/upload")
+async def upload_file(request: Request):
+    """
+    上传对话文件（multipart 表单：conversation_id, file）。
+    请求体流式写入内容寻址存储，传输期间不占用线程池和数据库连接。
+    """
+    upload = await receive_upload(request, open_sink=blob_store.open_writer)
 
-    record = crud.create_uploaded_file(db, conversation_id, file.filename, save_path)
-    return record.to_dict()
+    def save() -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            conversation_id = _form_int(upload.fields, "conversation_id")
+            if conversation_id is None or not crud.get_conversation(db, conversation_id):
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            # 按内容保存：相同文件只存一份，记录直接引用存储路径
+            blob = upload.sink.commit(db)
+            try:
+                record = crud.create_uploaded_file(db, conversation_id, upload.filename, blob.path)
+            except BaseException:
+                # 引用已提交，记录没建成时要还回去，否则文件永远不会被回收
+                db.rollback()
+                blob_store.release(db, blob.path)
+                raise
+            return record.to_dict()
+        except BaseException:
+            upload.abort()
+            raise
+        finally:
+            db.close()
+
+    return await run_in_threadpool(save)
 
 @app.get("/conversations/{conversation_id}/files")
 def list_conversation_files(
@@ -3067,14 +2942,10 @@ def delete_conversation_file(file_id: int, db: Session = Depends(get_db)):
     if not file_record:
         raise HTTPException(status_code=404, detail="File not found")
 
-    # 删除本地文件
-    try:
-        if os.path.exists(file_record.filepath):
-            os.remove(file_record.filepath)
-    except Exception:
-        pass
-
+    file_path = file_record.filepath
     crud.delete_uploaded_file(db, file_id)
+    # 释放引用，最后一个引用删除时才删除本地文件
+    blob_store.release(db, file_path, remove_unmanaged=True)
     return {"success": True}
 
 @app.get("/files/{path:path}")
@@ -3139,6 +3010,7 @@ def create_provider(
             models_config=models_config,
             is_default=is_default,
         )
+        provider_registry.invalidate()
         return provider.to_dict()
     except HTTPException:
         raise
@@ -3174,11 +3046,13 @@ def update_provider(
     )
     if not provider:
         raise HTTPException(status_code=404, detail="Provider not found")
+    provider_registry.invalidate()
     return provider.to_dict()
 
 @app.delete("/providers/{provider_id}")
 def delete_provider(provider_id: int, db: Session = Depends(get_db)):
     crud.delete_provider(db, provider_id)
+    provider_registry.invalidate()
     return {"success": True}
 
 @app.get("/providers/{provider_id}/models")
@@ -3280,7 +3154,10 @@ def create_knowledge_base(
 
 @app.delete("/knowledge/bases/{kb_id}")
 def delete_knowledge_base(kb_id: int, db: Session = Depends(get_db)):
+    file_paths = [doc.file_path for doc in crud.list_knowledge_documents(db, kb_id=kb_id)]
     crud.delete_knowledge_base(db, kb_id)
+    for path in file_paths:
+        blob_store.release(db, path)
     return {"success": True}
 
 @app.get("/knowledge/documents")
@@ -3294,296 +3171,148 @@ def list_knowledge_documents(
 @app.delete("/knowledge/documents/{doc_id}")
 def delete_knowledge_document(doc_id: int, db: Session = Depends(get_db)):
     """删除知识库中的单个文档"""
+    doc = crud.get_knowledge_document(db, doc_id)
+    file_path = doc.file_path if doc else None
     crud.delete_knowledge_document(db, doc_id)
+    blob_store.release(db, file_path)
     return {"success": True}
 
 @app.post("/knowledge/upload")
-def upload_knowledge_file(
-    kb_id: Optional[int] = Form(None),
-    embedding_model: Optional[str] = Form(None),
-    extract_images: Optional[bool] = Form(False),  # 是否提取文档内图片
-    vision_model: Optional[str] = Form(None),  # 图片识别用的视觉模型
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db),
-):
+async def upload_knowledge_file(request: Request):
     """
-    上传一个文件到指定知识库:
-    1. 保存原始文件；
-    2. 抽取文本(支持 PDF/DOCX/PPTX/XLSX/TXT/MD/CSV/图片 等)；
-    3. 如果启用图片提取，识别文档内嵌图片；
-    4. 切分为若干段落；
-    5. 调用 embedding 接口生成向量；
-    6. 存入 KnowledgeDocument + KnowledgeChunk；
+    上传一个文件到指定知识库（multipart 表单：kb_id, embedding_model, extract_images, vision_model, file）:
+    1. 流式接收文件：格式和大小在传输过程中校验，传输期间不占用数据库连接；
+    2. 校验向量模型和视觉模型，保存原始文件并创建导入任务，立即返回 job_id；
+    3. 后台任务依次抽取文本(可选识别图片)、切分段落、批量生成向量、写入 KnowledgeDocument + KnowledgeChunk；
+       进度见 GET /knowledge/jobs/{job_id} 或 GET /knowledge/jobs/{job_id}/events。
     """
-    from app.utils.document_parser import extract_text_from_file, get_supported_extensions, set_image_recognition_callback
-    
-    # 检查文件格式
-    ext = os.path.splitext(file.filename)[1].lower()
-    supported = get_supported_extensions()
-    if ext not in supported:
+    from app.utils.document_parser import get_supported_extensions
+
+    upload = await receive_upload(
+        request,
+        open_sink=blob_store.open_writer,
+        allowed_extensions=get_supported_extensions(),
+    )
+
+    def create_job() -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            return _create_ingestion_job_for_upload(db, upload)
+        except BaseException:
+            upload.abort()
+            raise
+        finally:
+            db.close()
+
+    return await run_in_threadpool(create_job)
+
+def _create_ingestion_job_for_upload(db: Session, upload) -> Dict[str, Any]:
+    fields = upload.fields
+    kb_id = _form_int(fields, "kb_id")
+    embedding_model = fields.get("embedding_model") or None
+    extract_images = parse_bool(fields.get("extract_images")) or False  # 是否提取文档内图片
+    vision_model = fields.get("vision_model") or None  # 图片识别用的视觉模型
+    ext = os.path.splitext(upload.filename)[1].lower()
+    
+    # 上传图片必须配置视觉模型；仅提取文档图片但没配置时跳过图片提取
+    if ext in IMAGE_EXTENSIONS and not vision_model:
         raise HTTPException(
-            status_code=400, 
-            detail=f"不支持的文件格式: {ext}。支持的格式: {', '.join(supported)}"
+            status_code=400,
+            detail="上传图片需要配置图片识别方案。请在设置中选择视觉模型。"
         )
-    
-    # 如果需要提取图片或上传的是图片文件，设置图片识别回调
-    image_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
-    need_vision = extract_images or ext in image_extensions
-    
-    if need_vision:
-        # 获取视觉模型配置
-        selected_vision_model = vision_model
-        
-        if not selected_vision_model:
-            if ext in image_extensions:
-                raise HTTPException(
-                    status_code=400,
-                    detail="上传图片需要配置图片识别方案。请在设置中选择视觉模型。"
-                )
-            # 如果只是提取文档图片但没配置，则跳过图片提取
-            extract_images = False
-        else:
-            # 设置图片识别回调
-            def create_vision_callback(model_name: str):
-                # 查找包含该模型的 Provider
-                api_base = None
-                api_key = None
-                
-                if model_name.startswith("vision:"):
-                    model_name = model_name[7:]
-                
-                providers = crud.list_providers(db)
-                for provider in providers:
-                    # 检查 models_config 中是否有该模型
-                    if provider.models_config:
-                        try:
-                            import json as _json
-                            config = _json.loads(provider.models_config)
-                            if model_name in config:
-                                api_base = provider.api_base
-                                api_key = provider.api_key
-                                break
-                        except:
-                            pass
-                    # 兼容旧的 models 字段
-                    if not api_base and provider.models and model_name in provider.models:
-                        api_base = provider.api_base
-                        api_key = provider.api_key
-                        break
-                
-                if not api_base:
-                    # 使用第一个可用的 Provider
-                    if providers:
-                        api_base = providers[0].api_base
-                        api_key = providers[0].api_key
-                    else:
-                        api_base = settings.AI_API_BASE
-                        api_key = settings.AI_API_KEY
-                
-                def vision_callback(image_bytes: bytes, mime_type: str) -> str:
-                    import httpx
-                    import base64
-                    
-                    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                    image_url = f"data:{mime_type};base64,{image_base64}"
-                    
-                    headers = {"Content-Type": "application/json"}
-                    if api_key:
-                        headers["Authorization"] = f"Bearer {api_key}"
-                    
-                    payload = {
-                        "model": model_name,
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": "请详细描述这张图片的内容，包括图片中的所有文字、图表、数据、图形等信息。如果有文字，请完整提取出来。"
-                                    },
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {"url": image_url}
-                                    }
-                                ]
-                            }
-                        ],
-                        "max_tokens": 2048
-                    }
-                    
-                    with httpx.Client(timeout=60.0) as client:
-                        response = client.post(
-                            f"{api_base.rstrip('/')}/chat/completions",
-                            headers=headers,
-                            json=payload
-                        )
-                        response.raise_for_status()
-                        result = response.json()
-                    
-                    if "choices" in result and len(result["choices"]) > 0:
-                        return result["choices"][0].get("message", {}).get("content", "")
-                    return ""
-                
-                return vision_callback
-            
-            set_image_recognition_callback(create_vision_callback(selected_vision_model))
+    if not vision_model:
+        extract_images = False
     
     # 验证向量模型 - 从 Provider 配置中获取可用的 embedding 模型
     selected_embedding_model = embedding_model or settings.EMBEDDING_MODEL
     
     # 获取所有可用的 embedding 模型(包括 Provider 中配置的)
     available_embedding_models = set(settings.embedding_models)
-    all_providers = crud.list_providers(db)
-    for provider in all_providers:
-        if provider.models_config:
-            try:
-                import json as _json
-                config = _json.loads(provider.models_config)
-                for model_name in config.keys():
-                    if "embedding" in model_name.lower() or "embed" in model_name.lower():
-                        available_embedding_models.add(model_name)
-            except:
-                pass
+    available_embedding_models.update(provider_registry.embedding_models(db))
     
     if selected_embedding_model and selected_embedding_model not in available_embedding_models:
         selected_embedding_model = None
     
-    # 1. 保存文件
-    kb_dir = os.path.join(UPLOAD_DIR, "knowledge")
-    os.makedirs(kb_dir, exist_ok=True)
-    save_path = os.path.join(kb_dir, file.filename)
-    with open(save_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-
-    # 2. 提取文本(支持多种格式，可选提取图片)
-    try:
-        content = extract_text_from_file(save_path, extract_images=extract_images)
-    except ImportError as e:
-        raise HTTPException(status_code=500, detail=f"缺少依赖库: {e}")
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"文件解析失败: {e}")
-    finally:
-        # 清理回调
-        set_image_recognition_callback(None)
-
-    # 3. 智能切分段落(chunk_size = 512)
-    CHUNK_SIZE = 512
-    CHUNK_OVERLAP = 50  # 重叠部分，保持上下文连贯
-    
-    paragraphs: List[str] = []
-    current_chunk = ""
-    
-    for line in content.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        
-        # 如果当前块加上新行不超过 chunk_size，则合并
-        if len(current_chunk) + len(line) + 1 <= CHUNK_SIZE:
-            if current_chunk:
-                current_chunk += "\n" + line
-            else:
-                current_chunk = line
-        else:
-            # 保存当前块
-            if current_chunk:
-                paragraphs.append(current_chunk)
-            
-            # 如果单行超过 chunk_size，按句子切分
-            if len(line) > CHUNK_SIZE:
-                import re
-                sentences = re.split(r'(?<=[。！？!?.;])\s*', line)
-                temp_chunk = ""
-                for sent in sentences:
-                    sent = sent.strip()
-                    if not sent:
-                        continue
-                    if len(temp_chunk) + len(sent) + 1 <= CHUNK_SIZE:
-                        if temp_chunk:
-                            temp_chunk += sent
-                        else:
-                            temp_chunk = sent
-                    else:
-                        if temp_chunk:
-                            paragraphs.append(temp_chunk)
-                        temp_chunk = sent
-                current_chunk = temp_chunk
-            else:
-                current_chunk = line
-    
-    # 保存最后一个块
-    if current_chunk:
-        paragraphs.append(current_chunk)
-
-    if not paragraphs:
-        raise HTTPException(status_code=400, detail="文件中未检测到有效文本内容。")
-
-    # 4. 生成向量(如果有向量模型)
-    embeddings = None
-    if selected_embedding_model:
-        try:
-            # 配置 ai_manager 使用第一个可用的 Provider
-            all_providers = crud.list_providers(db)
-            if all_providers:
-                provider = all_providers[0]
-                ai_manager.set_provider(
-                    api_base=provider.api_base,
-                    api_key=provider.api_key,
-                    default_model=provider.default_model,
-                )
-            
-            embeddings = ai_manager.create_embedding(paragraphs, model=selected_embedding_model)
-        except Exception as e:
-            chat_logger.error(f"向量生成失败: {e}")
-            # 删除已保存的文件
-            try:
-                os.remove(save_path)
-            except:
-                pass
-            raise HTTPException(status_code=500, detail=f"向量生成失败: {str(e)}，文件未加入知识库。")
-    
-    # 如果选择了向量模型但没有生成向量，不写入数据库
-    if selected_embedding_model and (not embeddings or len(embeddings) != len(paragraphs)):
-        # 删除已保存的文件
-        try:
-            os.remove(save_path)
-        except:
-            pass
-        raise HTTPException(status_code=500, detail="向量生成失败或数量不匹配，文件未加入知识库。")
-    
-    # 如果没有选择向量模型，也不写入数据库
+    # 没有选择向量模型时不入库
     if not selected_embedding_model:
-        # 删除已保存的文件
-        try:
-            os.remove(save_path)
-        except:
-            pass
         raise HTTPException(status_code=400, detail="请选择向量模型，否则文件无法用于知识库搜索。")
 
-    # 5. 写入 DB(只有成功生成向量才写入)
-    doc = crud.create_knowledge_document(
-        db,
-        kb_id=kb_id,
-        file_name=file.filename,
-        file_path=save_path,
-        content=content[:2000],
-        embedding_model=selected_embedding_model,
-    )
+    # 1. 按内容保存文件（导入任务持有引用，成功后转给知识库文档）
+    save_path = upload.sink.commit(db).path
 
-    # 存储向量块
-    chunks_data = []
-    for idx, (para, emb) in enumerate(zip(paragraphs, embeddings)):
-        chunks_data.append((idx, para, emb))
-    crud.create_knowledge_chunks(db, document_id=doc.id, chunks=chunks_data)
+    # 2. 创建导入任务，交给后台线程池处理（任务没建成时释放刚拿到的引用）
+    try:
+        job = crud.create_ingestion_job(
+            db,
+            kb_id=kb_id,
+            file_name=upload.filename,
+            file_path=save_path,
+            embedding_model=selected_embedding_model,
+            extract_images=bool(extract_images),
+            vision_model=vision_model,
+        )
+    except BaseException:
+        db.rollback()
+        blob_store.release(db, save_path)
+        raise
+    ingestion_worker.submit(job.id)
 
     return {
-        "success": True, 
-        "document": doc.to_dict(),
-        "chunks_count": len(paragraphs),
+        "success": True,
+        "job_id": job.id,
+        "job": job.to_dict(),
     }
 
+@app.get("/knowledge/jobs")
+def list_ingestion_jobs(
+    kb_id: Optional[int] = None,
+    status: Optional[str] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+):
+    """列出知识库导入任务(最新的在前)"""
+    jobs = crud.list_ingestion_jobs(db, kb_id=kb_id, status=status, limit=limit)
+    return [job.to_dict() for job in jobs]
+
+@app.get("/knowledge/jobs/{job_id}")
+def get_ingestion_job(job_id: int, db: Session = Depends(get_db)):
+    """查询导入任务的状态和进度"""
+    job = crud.get_ingestion_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="导入任务不存在")
+    return job.to_dict()
+
+def _load_ingestion_job_dict(job_id: int) -> Optional[Dict[str, Any]]:
+    db = SessionLocal()
+    try:
+        job = crud.get_ingestion_job(db, job_id)
+        return job.to_dict() if job else None
+    finally:
+        db.close()
+
+@app.get("/knowledge/jobs/{job_id}/events")
+async def stream_ingestion_job(job_id: int):
+    """以 SSE 推送导入任务进度，任务结束(succeeded / failed)后关闭"""
+    if await asyncio.to_thread(_load_ingestion_job_dict, job_id) is None:
+        raise HTTPException(status_code=404, detail="导入任务不存在")
+
+    async def event_stream():
+        last_updated = None
+        while True:
+            job = await asyncio.to_thread(_load_ingestion_job_dict, job_id)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': '导入任务不存在'}, ensure_ascii=False)}\n\n"
+                return
+            if job["updated_at"] != last_updated:
+                last_updated = job["updated_at"]
+                yield f"event: progress\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+            if job["status"] in ("succeeded", "failed"):
+                yield f"event: done\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 # ========== MCP 服务器管理接口 ==========
 
 @app.get("/mcp/servers")
@@ -3939,8 +3668,12 @@ def update_settings(
     if global_api_key is not None:
         crud.set_setting(db, "global_api_key", global_api_key)
         settings_data["global_api_key"] = global_api_key
-        # 同时更新AI管理器的配置
-        ai_manager._provider.api_key = global_api_key
+        # 同时更新全局默认客户端的配置(整体替换,已创建的请求客户端不受影响)
+        ai_manager.set_provider(
+            api_base=ai_manager.provider.api_base,
+            api_key=global_api_key,
+            default_model=ai_manager.provider.default_model,
+        )
         # 更新环境变量(如果需要持久化)
         import os
         os.environ["AI_API_KEY"] = global_api_key
@@ -3948,13 +3681,21 @@ def update_settings(
     if global_api_base is not None:
         crud.set_setting(db, "global_api_base", global_api_base)
         settings_data["global_api_base"] = global_api_base
-        ai_manager._provider.api_base = global_api_base.rstrip("/")
+        ai_manager.set_provider(
+            api_base=global_api_base,
+            api_key=ai_manager.provider.api_key,
+            default_model=ai_manager.provider.default_model,
+        )
         os.environ["AI_API_BASE"] = global_api_base
         
     if global_default_model is not None:
         crud.set_setting(db, "global_default_model", global_default_model)
         settings_data["global_default_model"] = global_default_model
-        ai_manager._provider.default_model = global_default_model
+        ai_manager.set_provider(
+            api_base=ai_manager.provider.api_base,
+            api_key=ai_manager.provider.api_key,
+            default_model=global_default_model,
+        )
         os.environ["AI_MODEL"] = global_default_model
     
     return {"success": True, "settings": settings_data}
@@ -4166,8 +3907,7 @@ def test_provider_connection(
     """测试指定Provider的连接"""
     try:
         # 创建临时的AI管理器实例进行测试
-        temp_manager = AIManager()
-        temp_manager.set_provider(
+        temp_manager = AIManager.for_provider(
             api_base=api_base,
             api_key=api_key,
             default_model=model
@@ -4186,9 +3926,9 @@ def get_api_status():
     """获取API配置状态"""
     return {
         "configured": ai_manager.is_configured(),
-        "api_base": ai_manager._provider.api_base,
-        "has_api_key": bool(ai_manager._provider.api_key),
-        "default_model": ai_manager._provider.default_model
+        "api_base": ai_manager.provider.api_base,
+        "has_api_key": bool(ai_manager.provider.api_key),
+        "default_model": ai_manager.provider.default_model
     }
 
 # ========== 知识图谱接口 ==========
@@ -4346,6 +4086,33 @@ def get_graph_context(
     context = search_graph_context(db, query, kb_id=kb_id, max_entities=max_entities)
     return {"context": context}
 
+@app.get("/knowledge/embedding-cache/stats")
+def get_embedding_cache_stats():
+    """查询向量缓存的命中统计"""
+    return embedding_cache.stats()
+
+@app.delete("/knowledge/embedding-cache")
+def clear_embedding_cache():
+    """清空查询向量缓存（含持久化部分）"""
+    embedding_cache.clear()
+    return {"success": True}
+
+@app.get("/ai/http-pool/stats")
+def get_http_pool_stats():
+    """查询调用 Provider 的 HTTP 连接池占用情况"""
+    return http_pool.stats()
+
+@app.get("/extraction-cache/stats")
+def get_extraction_cache_stats():
+    """查询文件解析结果缓存的命中统计"""
+    return extraction_cache.stats()
+
+@app.delete("/extraction-cache")
+def clear_extraction_cache():
+    """清空文件解析结果缓存"""
+    extraction_cache.clear()
+    return {"success": True}
+
 @app.get("/knowledge/embedding-models")
 def get_embedding_models(db: Session = Depends(get_db)):
     """获取可用的向量模型列表 - 基于用户配置的Provider，按Provider分组"""
@@ -4517,19 +4284,9 @@ def generate_image(
     - provider_id: 使用的 Provider ID
     - conversation_id: 关联的对话 ID(可选，用于保存到对话历史)
     """
-    from app.ai.ai_manager import AIManager
-    
     # 配置 Provider
-    ai = AIManager()
-    
-    if provider_id:
-        provider = crud.get_provider(db, provider_id)
-        if provider:
-            ai.set_provider(
-                api_base=provider.api_base,
-                api_key=provider.api_key,
-                default_model=provider.default_model
-            )
+    provider = provider_registry.get(db, provider_id) if provider_id else None
+    ai = provider_registry.client(provider) if provider else AIManager()
     
     # 调用生图 API
     result = ai.generate_image(
@@ -3,76 +3,117 @@
 上下文管理器 - 优化token使用
 """
 
-from typing import List, Dict, Any, Optional
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Sequence
+
+from app.core.config import settings
 from app.utils.logger import logger
+from app.utils.token_estimator import estimate_message_tokens, estimate_tokens
+
+
+class _MessageTokenCache:
+    """历史消息 token 估算结果的 LRU 缓存，按 Message.id（消息写入后不再修改）"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, int]" = OrderedDict()
+
+    def get(self, message_id: int, message: Dict[str, Any]) -> int:
+        with self._lock:
+            tokens = self._entries.get(message_id)
+            if tokens is not None:
+                self._entries.move_to_end(message_id)
+                return tokens
+        tokens = estimate_message_tokens(message)
+        with self._lock:
+            self._entries[message_id] = tokens
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return tokens
+
+
+_token_cache = _MessageTokenCache(settings.CONTEXT_TOKEN_CACHE_SIZE)
+
 
 class ContextManager:
     """智能上下文管理，减少不必要的token使用"""
     
     @staticmethod
-    def optimize_messages(messages: List[Dict[str, Any]], max_turns: int = 6) -> List[Dict[str, Any]]:
+    def context_budget(model_caps: Optional[Dict[str, Any]] = None) -> int:
         """
-        优化消息上下文，限制对话轮数
+        模型可用于输入的 token 数：上下文窗口减去为输出预留的部分
         
         Args:
-            messages: 原始消息列表
-            max_turns: 最大对话轮数（一轮 = 用户消息 + AI回复）
-        
-        Returns:
-            优化后的消息列表
+            model_caps: Provider models_config 中该模型的配置，可包含 context_window / max_output_tokens
         """
-        if not messages:
-            return messages
-        
-        logger.log_performance("上下文分析", 0, {
-            "original_messages": len(messages),
-            "max_turns": max_turns
-        })
-        
-        # 如果消息数量很少，直接返回
-        if len(messages) <= max_turns * 2:  # 每轮2条消息
-            return messages
-        
-        # 保留策略：
-        # 1. 保留系统消息
-        # 2. 保留最后N轮对话（用户+AI回复）
-        
-        optimized = []
-        
-        # 先提取系统消息
-        system_messages = [msg for msg in messages if msg.get('role') == 'system']
-        non_system_messages = [msg for msg in messages if msg.get('role') != 'system']
+        model_caps = model_caps or {}
+        try:
+            window = int(model_caps.get("context_window") or settings.CONTEXT_WINDOW_TOKENS)
+            reserve = int(model_caps.get("max_output_tokens") or settings.CONTEXT_OUTPUT_RESERVE_TOKENS)
+        except (TypeError, ValueError):
+            window, reserve = settings.CONTEXT_WINDOW_TOKENS, settings.CONTEXT_OUTPUT_RESERVE_TOKENS
+        return max(window - reserve, 0)
+    
+    @staticmethod
+    def build_context(
+        messages: List[Dict[str, Any]],
+        history: Sequence[Any],
+        budget: int,
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        按 token 预算把历史对话插入到当前消息之前
         
-        # 添加系统消息
-        optimized.extend(system_messages)
+        Args:
+            messages: 不含历史的消息列表（系统提示 + 当前用户消息，当前消息在最后，已包含文件内容）
+            history: 历史消息（models.Message 或 context_cache.ContextMessage，按时间顺序）
+            budget: 输入 token 预算，见 context_budget()
+            tools: 本次请求的工具定义，同样占用输入 token
         
-        # 从后往前保留最后N轮对话
-        # 确保保留完整的对话轮次（用户消息+AI回复）
-        turns_kept = 0
-        i = len(non_system_messages) - 1
-        temp_messages = []
+        Returns:
+            系统提示 + 历史对话 + 当前消息
         
-        while i >= 0 and turns_kept < max_turns:
-            current_msg = non_system_messages[i]
-            temp_messages.insert(0, current_msg)
-            
-            # 如果是用户消息，说明这是一轮对话的开始
-            if current_msg.get('role') == 'user':
-                turns_kept += 1
-            
-            i -= 1
+        系统提示、当前消息和工具定义必须发送，先从预算中扣除；
+        剩余预算从最新的一轮开始按整轮（用户消息 + 回复）装入，装不下的那一轮及更早的对话全部丢弃。
+        """
+        if not history or not messages:
+            return messages
         
-        # 添加保留的对话消息
-        optimized.extend(temp_messages)
+        reserved = sum(estimate_message_tokens(m) for m in messages)
+        if tools:
+            reserved += estimate_tokens(json.dumps(tools, ensure_ascii=False))
+        available = budget - reserved
+        
+        # 按用户消息切分为轮次
+        turns: List[List[Any]] = []
+        for msg in history:
+            if msg.role == "user" or not turns:
+                turns.append([])
+            turns[-1].append(msg)
+        
+        kept_turns: List[List[Dict[str, Any]]] = []
+        used = 0
+        for turn in reversed(turns):
+            turn_messages = [{"role": m.role, "content": m.content} for m in turn]
+            turn_tokens = sum(_token_cache.get(m.id, d) for m, d in zip(turn, turn_messages))
+            if used + turn_tokens > available:
+                break
+            kept_turns.append(turn_messages)
+            used += turn_tokens
+        selected = [m for turn in reversed(kept_turns) for m in turn]
         
         logger.log_performance("上下文优化", 0, {
-            "optimized_messages": len(optimized),
-            "turns_kept": turns_kept,
-            "system_messages": len(system_messages),
-            "reduction_ratio": f"{(1 - len(optimized)/len(messages))*100:.1f}%" if messages else "0%"
+            "budget_tokens": budget,
+            "reserved_tokens": reserved,
+            "history_tokens": used,
+            "turns_kept": len(kept_turns),
+            "turns_total": len(turns),
         })
         
-        return optimized
+        return messages[:-1] + selected + messages[-1:]
     
     @staticmethod
     def should_enable_tools(user_input: str, conversation_settings: Dict[str, bool]) -> Dict[str, bool]:
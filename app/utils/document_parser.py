@@ -2,36 +2,59 @@
 文档解析工具 - 支持多种文件格式
 支持: PDF, DOCX, DOC, PPTX, XLSX, TXT, MD, CSV, 图片
 支持提取文档内嵌图片并用视觉模型识别
+
+iter_text_from_file / iter_* 以生成器逐页、逐工作表、逐段产出文本，大文件无需整体载入内存；
+extract_* 为对应的整段文本版本。产出的每一段都以完整的行结束。
+页数较多的 PDF 按页区间分片交给进程池并行抽取（PyMuPDF），输出顺序与页码一致。
 """
 import os
 import base64
+import codecs
 import io
-from typing import Optional, List, Tuple, Callable
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, List, Tuple, Callable, Iterator
+
+from app.core.config import settings
 
 
-# 图片识别回调函数（由外部设置）
-_image_recognition_callback: Optional[Callable[[bytes, str], str]] = None
+# 图片识别回调函数（由外部设置）；按线程保存，并发解析的任务互不影响
+_callback_state = threading.local()
 
 
-def set_image_recognition_callback(callback: Callable[[bytes, str], str]):
+def set_image_recognition_callback(callback: Optional[Callable[[bytes, str], str]]):
     """
-    设置图片识别回调函数
+    设置当前线程的图片识别回调函数
     callback: 接收 (image_bytes, mime_type) 返回识别结果文本
     """
-    global _image_recognition_callback
-    _image_recognition_callback = callback
+    _callback_state.callback = callback
+
+
+def _image_recognition_callback() -> Optional[Callable[[bytes, str], str]]:
+    return getattr(_callback_state, "callback", None)
 
 
 def recognize_image(image_bytes: bytes, mime_type: str = "image/png") -> Optional[str]:
     """调用图片识别回调"""
-    if _image_recognition_callback:
+    callback = _image_recognition_callback()
+    if callback:
         try:
-            return _image_recognition_callback(image_bytes, mime_type)
+            return callback(image_bytes, mime_type)
         except Exception:
             return None
     return None
 
 
+# 文本文件编码探测只读取开头的样本
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# 流式读取文本文件的块大小
+_READ_BLOCK_SIZE = 1024 * 1024
+# XLSX 每次产出的行数
+_XLSX_ROWS_PER_PIECE = 1000
+
+
 def extract_text_from_file(file_path: str, extract_images: bool = False) -> str:
     """
     根据文件扩展名自动选择解析方法提取文本
@@ -67,9 +90,45 @@ def extract_text_from_file(file_path: str, extract_images: bool = False) -> str:
     return extractor(file_path)
 
 
+def iter_text_from_file(file_path: str, extract_images: bool = False) -> Iterator[str]:
+    """
+    extract_text_from_file 的流式版本：按页 / 工作表 / 段落逐块产出文本。
+    异常类型与 extract_text_from_file 一致（ImportError / ValueError）。
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    
+    image_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+    if ext in image_extensions:
+        yield extract_image_file(file_path)
+        return
+    
+    iterators = {
+        '.pdf': lambda p: iter_pdf(p, extract_images),
+        '.docx': lambda p: iter_docx(p, extract_images),
+        '.pptx': lambda p: iter_pptx(p, extract_images),
+        '.xlsx': iter_xlsx,
+        '.xls': iter_xlsx,
+        '.txt': iter_text,
+        '.md': iter_text,
+        '.csv': iter_text,
+        '.json': iter_text,
+        '.xml': iter_text,
+        # DOC / HTML 需要整体处理，一次产出
+        '.doc': lambda p: iter([extract_doc(p)]),
+        '.html': lambda p: iter([extract_html(p)]),
+        '.htm': lambda p: iter([extract_html(p)]),
+    }
+    
+    iterator = iterators.get(ext)
+    if not iterator:
+        raise ValueError(f"不支持的文件格式: {ext}")
+    
+    yield from iterator(file_path)
+
+
 def extract_image_file(file_path: str) -> str:
     """提取单独图片文件的内容"""
-    if not _image_recognition_callback:
+    if not _image_recognition_callback():
         raise ValueError("未配置图片识别方案，请在知识库设置中选择图片识别方案")
     
     ext = os.path.splitext(file_path)[1].lower()
@@ -94,29 +153,111 @@ def extract_image_file(file_path: str) -> str:
 
 def extract_pdf(file_path: str, extract_images: bool = False) -> str:
     """提取 PDF 文本和图片"""
+    return "\n\n".join(iter_pdf(file_path, extract_images))
+
+
+# PDF 并行抽取的进程池（进程级共享，首次使用时创建），PDF_EXTRACT_WORKERS 限制总进程数
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn：服务进程里有多个线程，fork 子进程可能继承被占用的锁
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=settings.PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pdf_pool
+
+
+def shutdown_pdf_pool() -> None:
+    """关闭 PDF 抽取进程池（应用关闭时调用）"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = None
+
+
+def _extract_pdf_page_range(file_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """子进程中执行：独立打开文件，抽取 [start, end) 页的文本，返回 (页码, 文本)"""
+    import fitz  # PyMuPDF
+    
+    pages = []
+    with fitz.open(file_path) as doc:
+        for page_no in range(start, end):
+            pages.append((page_no + 1, doc[page_no].get_text("text")))
+    return pages
+
+
+def _pdf_page_count(file_path: str) -> int:
+    """返回页数；PyMuPDF 未安装时返回 -1"""
     try:
-        from PyPDF2 import PdfReader
-        reader = PdfReader(file_path)
-        text_parts = []
+        import fitz  # PyMuPDF
+    except ImportError:
+        return -1
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+
+def _iter_pdf_pages_parallel(file_path: str, page_count: int) -> Iterator[Tuple[int, str]]:
+    """按页区间分片提交到进程池，按提交顺序取回结果以保证页序"""
+    step = max(1, settings.PDF_PAGES_PER_TASK)
+    pool = _get_pdf_pool()
+    futures = [
+        pool.submit(_extract_pdf_page_range, file_path, start, min(start + step, page_count))
+        for start in range(0, page_count, step)
+    ]
+    next_page = 1
+    try:
+        for future in futures:
+            for page_num, page_text in future.result():
+                yield page_num, page_text
+                next_page = page_num + 1
+    except BrokenProcessPool:
+        # 子进程异常退出：丢弃损坏的进程池（下次重新创建），剩余页改为串行抽取
+        shutdown_pdf_pool()
+        yield from _iter_pdf_pages_serial(file_path, start_page=next_page)
+    finally:
+        # 调用方提前结束或出错时，取消尚未开始的分片
+        for future in futures:
+            future.cancel()
+
+
+def _iter_pdf_pages_serial(file_path: str, start_page: int = 1) -> Iterator[Tuple[int, str]]:
+    from PyPDF2 import PdfReader
+    reader = PdfReader(file_path)
+    for page_num in range(start_page, len(reader.pages) + 1):
+        yield page_num, reader.pages[page_num - 1].extract_text()
+
+
+def iter_pdf(file_path: str, extract_images: bool = False) -> Iterator[str]:
+    """逐页产出 PDF 文本，最后产出图片识别结果"""
+    try:
+        use_parallel = settings.PDF_EXTRACT_WORKERS > 1
+        page_count = _pdf_page_count(file_path) if use_parallel else -1
+        if use_parallel and page_count >= settings.PDF_PARALLEL_MIN_PAGES:
+            pages = _iter_pdf_pages_parallel(file_path, page_count)
+        else:
+            pages = _iter_pdf_pages_serial(file_path)
         has_text = False
         
-        for page_num, page in enumerate(reader.pages, 1):
-            page_text = page.extract_text()
+        for page_num, page_text in pages:
             if page_text and page_text.strip():
-                text_parts.append(f"[第 {page_num} 页]\n{page_text}")
                 has_text = True
+                yield f"[第 {page_num} 页]\n{page_text}"
         
         # 提取PDF中的图片
-        if extract_images and _image_recognition_callback:
-            image_texts = extract_pdf_images(file_path)
-            if image_texts:
-                text_parts.extend(image_texts)
-        
-        # 如果提取到文本，直接返回
-        if text_parts:
-            return "\n\n".join(text_parts)
+        if extract_images and _image_recognition_callback():
+            for image_text in extract_pdf_images(file_path):
+                has_text = True
+                yield image_text
         
-        raise ValueError("PDF 中未找到可提取的文本")
+        if not has_text:
+            raise ValueError("PDF 中未找到可提取的文本")
         
     except ImportError:
         raise ImportError("请安装 PyPDF2: pip install PyPDF2")
@@ -176,33 +317,31 @@ def extract_pdf_images(file_path: str) -> List[str]:
 
 def extract_docx(file_path: str, extract_images: bool = False) -> str:
     """提取 DOCX 文本和图片"""
+    return "\n".join(iter_docx(file_path, extract_images))
+
+
+def iter_docx(file_path: str, extract_images: bool = False) -> Iterator[str]:
+    """逐段产出 DOCX 段落、表格行和图片识别结果"""
     try:
         from docx import Document
-        from docx.opc.constants import RELATIONSHIP_TYPE as RT
-        import zipfile
         
         doc = Document(file_path)
-        text_parts = []
         
         # 提取段落文本
         for para in doc.paragraphs:
             if para.text.strip():
-                text_parts.append(para.text)
+                yield para.text
         
         # 提取表格内容
         for table in doc.tables:
             for row in table.rows:
                 row_text = [cell.text.strip() for cell in row.cells if cell.text.strip()]
                 if row_text:
-                    text_parts.append(" | ".join(row_text))
+                    yield " | ".join(row_text)
         
         # 提取图片
-        if extract_images and _image_recognition_callback:
-            image_texts = extract_docx_images(file_path)
-            if image_texts:
-                text_parts.extend(image_texts)
-        
-        return "\n".join(text_parts)
+        if extract_images and _image_recognition_callback():
+            yield from extract_docx_images(file_path)
     except ImportError:
         raise ImportError("请安装 python-docx: pip install python-docx")
     except Exception as e:
@@ -284,13 +423,15 @@ def extract_doc(file_path: str) -> str:
 
 def extract_pptx(file_path: str, extract_images: bool = False) -> str:
     """提取 PPTX 文本和图片"""
+    return "\n\n".join(iter_pptx(file_path, extract_images))
+
+
+def iter_pptx(file_path: str, extract_images: bool = False) -> Iterator[str]:
+    """逐张幻灯片产出 PPTX 文本，最后产出图片识别结果"""
     try:
         from pptx import Presentation
-        from pptx.enum.shapes import MSO_SHAPE_TYPE
-        import zipfile
         
         prs = Presentation(file_path)
-        text_parts = []
         
         for slide_num, slide in enumerate(prs.slides, 1):
             slide_texts = [f"[幻灯片 {slide_num}]"]
@@ -305,15 +446,11 @@ def extract_pptx(file_path: str, extract_images: bool = False) -> str:
                             slide_texts.append(" | ".join(row_text))
             
             if len(slide_texts) > 1:
-                text_parts.append("\n".join(slide_texts))
+                yield "\n".join(slide_texts)
         
         # 提取图片
-        if extract_images and _image_recognition_callback:
-            image_texts = extract_pptx_images(file_path)
-            if image_texts:
-                text_parts.extend(image_texts)
-        
-        return "\n\n".join(text_parts)
+        if extract_images and _image_recognition_callback():
+            yield from extract_pptx_images(file_path)
     except ImportError:
         raise ImportError("请安装 python-pptx: pip install python-pptx")
     except Exception as e:
@@ -361,23 +498,33 @@ def extract_pptx_images(file_path: str) -> List[str]:
 
 def extract_xlsx(file_path: str) -> str:
     """提取 XLSX/XLS 文本"""
+    return "\n".join(iter_xlsx(file_path))
+
+
+def iter_xlsx(file_path: str) -> Iterator[str]:
+    """
+    以只读模式流式读取工作簿，每个工作表按 _XLSX_ROWS_PER_PIECE 行一块产出；
+    每个工作表的第一块以 [工作表: 名称] 开头。
+    """
     try:
         from openpyxl import load_workbook
-        wb = load_workbook(file_path, data_only=True)
-        text_parts = []
-        for sheet_name in wb.sheetnames:
-            sheet = wb[sheet_name]
-            sheet_texts = [f"[工作表: {sheet_name}]"]
-            for row in sheet.iter_rows():
-                row_values = []
-                for cell in row:
-                    if cell.value is not None:
-                        row_values.append(str(cell.value))
-                if row_values:
-                    sheet_texts.append(" | ".join(row_values))
-            if len(sheet_texts) > 1:
-                text_parts.append("\n".join(sheet_texts))
-        return "\n\n".join(text_parts)
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for sheet_name in wb.sheetnames:
+                sheet = wb[sheet_name]
+                header = f"[工作表: {sheet_name}]"
+                rows: List[str] = []
+                for row in sheet.iter_rows(values_only=True):
+                    row_values = [str(value) for value in row if value is not None]
+                    if row_values:
+                        rows.append(" | ".join(row_values))
+                    if len(rows) >= _XLSX_ROWS_PER_PIECE:
+                        yield "\n".join([header] + rows if header else rows)
+                        header, rows = "", []
+                if rows:
+                    yield "\n".join([header] + rows if header else rows)
+        finally:
+            wb.close()
     except ImportError:
         raise ImportError("请安装 openpyxl: pip install openpyxl")
     except Exception as e:
@@ -386,27 +533,67 @@ def extract_xlsx(file_path: str) -> str:
 
 def extract_text(file_path: str) -> str:
     """提取纯文本文件"""
+    return "".join(iter_text(file_path))
+
+
+def detect_encoding(file_path: str, sample_size: int = ENCODING_SAMPLE_SIZE) -> str:
+    """只读取文件开头 sample_size 字节判断编码"""
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_size)
+    
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    
     try:
         import chardet
-        with open(file_path, 'rb') as f:
-            raw = f.read()
-            detected = chardet.detect(raw)
-            encoding = detected.get('encoding', 'utf-8') or 'utf-8'
-        return raw.decode(encoding)
+        detected = chardet.detect(sample)
+        encoding = detected.get('encoding') or 'utf-8'
+        # 开头全是 ASCII 不代表后面没有中文，按 UTF-8 处理
+        return 'utf-8' if encoding.lower() == 'ascii' else encoding
     except ImportError:
         pass
     
     encodings = ['utf-8', 'gbk', 'gb2312', 'utf-16', 'latin-1']
     for enc in encodings:
         try:
-            with open(file_path, 'r', encoding=enc) as f:
-                return f.read()
+            # 样本可能截断在多字节字符中间，用增量解码器且不结束
+            codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+            return enc
         except UnicodeDecodeError:
             continue
     
     raise ValueError("无法识别文件编码")
 
 
+def iter_text(file_path: str) -> Iterator[str]:
+    """按块读取并增量解码文本文件，每次产出以换行结尾的若干完整行"""
+    encoding = detect_encoding(file_path)
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    
+    pending = ""
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(_READ_BLOCK_SIZE)
+            text = pending + decoder.decode(block, final=not block)
+            if not block:
+                if text:
+                    yield text
+                return
+            cut = text.rfind("\n")
+            # 没有换行的超长行也按块产出，避免无限累积
+            if cut < 0 and len(text) < _READ_BLOCK_SIZE * 4:
+                pending = text
+                continue
+            cut = cut + 1 if cut >= 0 else len(text)
+            yield text[:cut]
+            pending = text[cut:]
+
+
 def extract_html(file_path: str) -> str:
     """提取 HTML 文本"""
     import re
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+文件解析结果缓存（按内容寻址）
+同一份文件在多轮对话、不同对话或知识库中反复上传时，以文件内容的 SHA-256 为键复用
+文本抽取、OCR 和视觉模型识别的结果，不再重复解析或调用付费的视觉模型。
+
+- 键：(文件 SHA-256, kind)；kind 区分结果类型，如 "text"（extract_text_from_file 的整篇文本）、
+  "text-stream"（知识库导入时 iter_text_from_file 的分段输出）、"ocr"、"vision:<模型>"；
+  同一文件不同序列化方式的结果必须使用不同的 kind；
+- 存储：磁盘目录下每条结果一个 UTF-8 文本文件，写入先落临时文件再原子替换，多进程安全；
+- 淘汰：总大小超过 EXTRACTION_CACHE_MAX_MB 时按最近使用时间（mtime，命中时刷新）删除最旧的条目。
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from app.core.config import settings
+
+# 读取文件计算哈希 / 流式读取缓存的块大小
+_BLOCK_SIZE = 1024 * 1024
+# 文件哈希记忆的条数（按路径 + 大小 + 修改时间）
+_DIGEST_MEMO_SIZE = 1024
+# 淘汰时清理到上限的该比例以下，避免每次写入都触发目录扫描
+_EVICT_TARGET_RATIO = 0.9
+
+
+def default_cache_dir() -> str:
+    """缓存目录：EXTRACTION_CACHE_DIR，或 SQLite 数据库文件旁的 extraction_cache/"""
+    if settings.EXTRACTION_CACHE_DIR:
+        return settings.EXTRACTION_CACHE_DIR
+    base_dir = "."
+    if settings.DATABASE_URL.startswith("sqlite"):
+        db_path = settings.DATABASE_URL.replace("sqlite:///", "")
+        base_dir = os.path.dirname(db_path) or "."
+    return os.path.join(base_dir, "extraction_cache")
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ExtractionCache:
+    def __init__(self, cache_dir: str, max_bytes: int, enabled: bool = True) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._digests: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+        # 目录总大小，首次写入时扫描得到，之后增量维护（其他进程的写入在下次淘汰扫描时校正）
+        self._total_bytes: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- 键 ----------
+
+    def file_digest(self, file_path: str) -> str:
+        """文件内容的 SHA-256；同一路径未修改时直接复用上次结果"""
+        stat = os.stat(file_path)
+        memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+            if digest is not None:
+                self._digests.move_to_end(memo_key)
+                return digest
+
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+
+        with self._lock:
+            self._digests[memo_key] = digest
+            while len(self._digests) > _DIGEST_MEMO_SIZE:
+                self._digests.popitem(last=False)
+        return digest
+
+    def _entry_path(self, digest: str, kind: str) -> str:
+        kind_hash = hashlib.sha1(kind.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{kind_hash}.txt")
+
+    # ---------- 读写 ----------
+
+    def get(self, digest: str, kind: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        path = self._entry_path(digest, kind)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._touch(path)
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, digest: str, kind: str, text: str) -> None:
+        if not self.enabled:
+            return
+        self._write(digest, kind, [text])
+
+    def _touch(self, path: str) -> None:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _write(self, digest: str, kind: str, pieces: Iterable[str]) -> None:
+        path = self._entry_path(digest, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                for piece in pieces:
+                    f.write(piece)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._account(size)
+
+    def _account(self, added: int) -> None:
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan()[1]
+            else:
+                self._total_bytes += added
+            over = self._total_bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    def _scan(self) -> Tuple[list, int]:
+        """返回 [(mtime, size, path)] 和总大小"""
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".txt"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return entries, total
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries, total = self._scan()
+            target = int(self.max_bytes * _EVICT_TARGET_RATIO)
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+            self._total_bytes = total
+
+    # ---------- 对外接口 ----------
+
+    def get_or_compute(
+        self,
+        file_path: str,
+        kind: str,
+        compute: Callable[[], Optional[str]],
+    ) -> Optional[str]:
+        """
+        按文件内容查缓存，未命中时调用 compute 并写入缓存。
+        compute 返回 None 或抛出异常时不缓存（空字符串是有效结果，会被缓存）。
+        """
+        if not self.enabled:
+            return compute()
+        digest = self.file_digest(file_path)
+        cached = self.get(digest, kind)
+        if cached is not None:
+            return cached
+        text = compute()
+        if text is not None:
+            self.put(digest, kind, text)
+        return text
+
+    def iter_or_extract(
+        self,
+        file_path: str,
+        kind: str,
+        extract: Callable[[], Iterable[str]],
+    ) -> Iterator[str]:
+        """
+        get_or_compute 的流式版本：命中时按行分块读出缓存文件；未命中时边产出边写入临时文件，
+        extract 完整结束后才提交到缓存，中途失败或调用方提前停止都不会留下残缺条目。
+        与 document_parser 的 iter_* 一致，产出的每一块都以完整的行结束。
+        """
+        if not self.enabled:
+            yield from extract()
+            return
+        digest = self.file_digest(file_path)
+        path = self._entry_path(digest, kind)
+        try:
+            f = open(path, "r", encoding="utf-8", newline="")
+        except OSError:
+            f = None
+        if f is not None:
+            self._touch(path)
+            with self._lock:
+                self.hits += 1
+            with f:
+                while True:
+                    # readlines 的 hint 在读满约 _BLOCK_SIZE 后停在行尾
+                    lines = f.readlines(_BLOCK_SIZE)
+                    if not lines:
+                        break
+                    yield "".join(lines)
+            return
+
+        with self._lock:
+            self.misses += 1
+        # 先写入临时文件，避免把整个文档留在内存里
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        completed = False
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as out:
+                for piece in extract():
+                    out.write(piece)
+                    # 块之间补换行，缓存读出时块边界仍落在行尾
+                    if not piece.endswith("\n"):
+                        out.write("\n")
+                    yield piece
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            completed = True
+        finally:
+            if not completed:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        self._account(size)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "cache_dir": self.cache_dir,
+                "max_bytes": self.max_bytes,
+                "total_bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            entries, _ = self._scan()
+            for _, _, path in entries:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+
+# 全局缓存实例
+extraction_cache = ExtractionCache(
+    default_cache_dir(),
+    max_bytes=settings.EXTRACTION_CACHE_MAX_MB * 1024 * 1024,
+    enabled=settings.EXTRACTION_CACHE_ENABLED,
+)
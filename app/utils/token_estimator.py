@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+token 数量估算
+不依赖具体模型的分词器，按字符类别做偏保守的估计：
+- 中日韩字符约 1 token / 字；
+- 其余字符约 4 字符 / token（英文、数字、标点）。
+用于给 embedding 批次、上下文预算等设置上限，宁可高估也不要超出模型限制。
+"""
+
+import re
+from typing import Any, Dict, Iterable
+
+# 整段文本用正则统计中日韩字符，比逐字符判断快一个数量级
+_CJK_RE = re.compile(
+    "["
+    "\u4e00-\u9fff"   # CJK 统一表意文字
+    "\u3400-\u4dbf"   # 扩展 A
+    "\u3040-\u30ff"   # 平假名 / 片假名
+    "\uac00-\ud7af"   # 韩文音节
+    "\uf900-\ufaff"   # 兼容表意文字
+    "\u3000-\u303f"   # 中日韩标点
+    "\uff00-\uffef"   # 全角字符
+    "]"
+)
+
+# 每条对话消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 多模态消息中每张图片 / 每个 PDF 附件按固定 token 数估算
+IMAGE_PART_TOKENS = 1000
+
+
+def estimate_tokens(text: str) -> int:
+    """估算单段文本的 token 数"""
+    if not text:
+        return 0
+    if text.isascii():
+        return (len(text) + 3) // 4
+    other = len(_CJK_RE.sub("", text))
+    cjk = len(text) - other
+    return cjk + (other + 3) // 4
+
+
+def estimate_total_tokens(texts: Iterable[str]) -> int:
+    return sum(estimate_tokens(t) for t in texts)
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    """估算一条对话消息（content 为字符串或多模态 parts 列表）的 token 数"""
+    content = message.get("content")
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text") or "")
+            else:
+                tokens += IMAGE_PART_TOKENS
+    else:
+        tokens = estimate_tokens(content or "")
+    return tokens + MESSAGE_OVERHEAD_TOKENS
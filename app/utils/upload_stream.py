@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+流式接收 multipart/form-data 上传
+直接解析请求体，把文件内容按固定大小的块写入目标（如 BlobWriter，写入时同步计算哈希），
+不经过 UploadFile 的临时文件中转，也不占用线程池等待整个上传完成。
+
+- 文件类型：扩展名在文件部分的头部到达时即校验，MIME 由文件开头的魔数判断；
+- 大小限制：按类型（图片 / 纯文本 / 其他文档）分别限制，超出时立即中止接收并返回 413；
+- 普通表单字段一并解析，建议客户端把文件放在最后，以便先拿到字段。
+"""
+
+import mimetypes
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Protocol, Tuple
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# 写入目标的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 判断 MIME 需要的文件开头字节数
+_SNIFF_SIZE = 512
+# 普通表单字段的长度上限
+_MAX_FIELD_SIZE = 64 * 1024
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
+TEXT_EXTENSIONS = {'.txt', '.md', '.csv', '.json', '.xml', '.html', '.htm'}
+
+_MAGIC_NUMBERS: List[Tuple[bytes, str]] = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"PK\x03\x04", "application/zip"),                           # docx / pptx / xlsx
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),  # doc / xls / ppt
+]
+
+
+class UploadSink(Protocol):
+    def write(self, data: bytes) -> None: ...
+    def abort(self) -> None: ...
+
+
+def sniff_mime(head: bytes, filename: str) -> str:
+    """按文件开头的魔数判断 MIME；无法识别时按文本 / 扩展名推断"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            if mime == "application/zip":
+                # Office Open XML 本质是 zip，按扩展名给出具体类型
+                return mimetypes.guess_type(filename)[0] or mime
+            return mime
+    if b"\x00" not in head:
+        return mimetypes.guess_type(filename)[0] or "text/plain"
+    return "application/octet-stream"
+
+
+def size_limit(ext: str, mime: Optional[str] = None) -> int:
+    """按类型返回大小上限（字节）；扩展名和实际内容取更严格的一方"""
+    limits = [settings.UPLOAD_MAX_SIZE_MB]
+    if ext in IMAGE_EXTENSIONS or (mime or "").startswith("image/"):
+        limits.append(settings.UPLOAD_MAX_IMAGE_SIZE_MB)
+    if ext in TEXT_EXTENSIONS or (mime or "").startswith("text/"):
+        limits.append(settings.UPLOAD_MAX_TEXT_SIZE_MB)
+    return min(limits) * 1024 * 1024
+
+
+def _too_large(filename: str, limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"文件 {filename} 超过大小限制（{limit // (1024 * 1024)}MB）",
+    )
+
+
+class StreamedUpload:
+    """接收结果：表单字段 + 已写入 sink 的文件（sink 的提交 / 回滚由调用方负责）"""
+
+    def __init__(self) -> None:
+        self.fields: Dict[str, str] = {}
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.size = 0
+        self.sink: Optional[UploadSink] = None
+
+    def abort(self) -> None:
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+
+
+async def receive_upload(
+    request: Request,
+    *,
+    open_sink: Callable[[str], UploadSink],
+    file_field: str = "file",
+    allowed_extensions: Optional[Iterable[str]] = None,
+) -> StreamedUpload:
+    """
+    流式解析请求体，文件部分写入 open_sink(filename) 返回的目标。
+    出错时（格式不支持、超出大小、客户端断开等）自动 abort 已写入的内容并抛出 HTTPException。
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="请使用 multipart/form-data 上传文件")
+
+    # Content-Length 超出总上限时直接拒绝，不读取请求体
+    max_total = settings.UPLOAD_MAX_SIZE_MB * 1024 * 1024
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_total + _MAX_FIELD_SIZE:
+        raise HTTPException(status_code=413, detail=f"上传内容超过大小限制（{settings.UPLOAD_MAX_SIZE_MB}MB）")
+
+    allowed = {e.lower() for e in allowed_extensions} if allowed_extensions is not None else None
+    result = StreamedUpload()
+
+    # 解析器回调是同步的，只记录状态；文件写入在每次 feed 之后异步完成
+    state = {
+        "header_field": b"",
+        "header_value": b"",
+        "headers": {},
+        "name": None,
+        "is_file": False,
+        "file_seen": False,
+        "file_done": False,
+        "field_value": bytearray(),
+        "error": None,
+    }
+    pending = bytearray()
+
+    def on_part_begin() -> None:
+        state["headers"] = {}
+        state["name"] = None
+        state["is_file"] = False
+        state["field_value"] = bytearray()
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        state["header_value"] += data[start:end]
+
+    def on_header_end() -> None:
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished() -> None:
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = disposition.get(b"name", b"").decode("utf-8", "replace")
+        filename = disposition.get(b"filename")
+        state["name"] = name
+        if filename is not None and name == file_field:
+            if state["file_seen"]:
+                state["error"] = HTTPException(status_code=400, detail="一次只能上传一个文件")
+                return
+            state["is_file"] = True
+            state["file_seen"] = True
+            result.filename = filename.decode("utf-8", "replace")
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if state["is_file"]:
+            pending.extend(data[start:end])
+        elif state["name"] is not None:
+            state["field_value"].extend(data[start:end])
+            if len(state["field_value"]) > _MAX_FIELD_SIZE:
+                state["error"] = HTTPException(status_code=413, detail=f"表单字段 {state['name']} 过长")
+
+    def on_part_end() -> None:
+        if state["is_file"]:
+            state["file_done"] = True
+        elif state["name"] is not None:
+            result.fields[state["name"]] = state["field_value"].decode("utf-8", "replace")
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    limit = max_total
+    sniffed = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if state["error"] is not None:
+                raise state["error"]
+
+            if result.filename is not None and result.sink is None and not sniffed:
+                ext = os.path.splitext(result.filename)[1].lower()
+                if allowed is not None and ext not in allowed:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"不支持的文件格式: {ext}。支持的格式: {', '.join(sorted(allowed))}",
+                    )
+                limit = size_limit(ext)
+                if len(pending) >= _SNIFF_SIZE or state["file_done"]:
+                    # 拿到文件开头后判断实际类型，再按更严格的限制检查
+                    result.content_type = sniff_mime(bytes(pending[:_SNIFF_SIZE]), result.filename)
+                    limit = size_limit(ext, result.content_type)
+                    sniffed = True
+                    result.sink = await run_in_threadpool(open_sink, result.filename)
+
+            if result.size + len(pending) > limit:
+                raise _too_large(result.filename or "", limit)
+
+            if result.sink is not None and (len(pending) >= UPLOAD_CHUNK_SIZE or (state["file_done"] and pending)):
+                data = bytes(pending)
+                pending.clear()
+                result.size += len(data)
+                await run_in_threadpool(result.sink.write, data)
+
+        parser.finalize()
+    except BaseException:
+        await run_in_threadpool(result.abort)
+        raise
+
+    if result.sink is None:
+        raise HTTPException(status_code=400, detail="请求中没有文件")
+    return result
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+知识库 chunk 写入基准测试
+对比旧写法（逐行 db.add + commit + 逐行 db.refresh）与 crud.create_knowledge_chunks
+（分批 INSERT ... RETURNING，单事务）的吞吐量。
+
+用法:
+    python benchmarks/bench_chunk_insert.py                 # 默认 1k / 10k / 100k
+    python benchmarks/bench_chunk_insert.py --sizes 1000 5000 --dim 1536
+
+使用临时 SQLite 数据库，不会影响 app.db。
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp_dir = tempfile.mkdtemp(prefix="linga_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+# 基准只关心写入，不加载常驻向量索引
+os.environ.setdefault("VECTOR_SEARCH_ENGINE", "exact")
+
+from app.core.config import settings  # noqa: E402
+from app.db import crud, models  # noqa: E402
+from app.db.database import Base, SessionLocal, engine  # noqa: E402
+from app.db.embedding_codec import encode_embedding  # noqa: E402
+
+
+def make_chunks(n: int, dim: int):
+    rnd = random.Random(42)
+    vec = [rnd.random() for _ in range(dim)]
+    return [(i, f"第 {i} 段测试内容 lorem ipsum dolor sit amet " * 4, vec) for i in range(n)]
+
+
+def legacy_insert(db, document_id: int, chunks) -> None:
+    """旧实现：逐行 add，提交后逐行 refresh（每行一次 SELECT）"""
+    created = []
+    for idx, content, embedding in chunks:
+        kc = models.KnowledgeChunk(
+            document_id=document_id,
+            chunk_index=idx,
+            content=content,
+            embedding=encode_embedding(embedding, settings.EMBEDDING_STORAGE_DTYPE),
+        )
+        db.add(kc)
+        created.append(kc)
+    db.commit()
+    for kc in created:
+        db.refresh(kc)
+
+
+def bulk_insert(db, document_id: int, chunks) -> None:
+    crud.create_knowledge_chunks(db, document_id=document_id, chunks=chunks)
+
+
+def run(fn, n: int, dim: int) -> float:
+    chunks = make_chunks(n, dim)
+    db = SessionLocal()
+    try:
+        doc = crud.create_knowledge_document(
+            db, kb_id=None, file_name="bench.txt", file_path="bench.txt", content="", embedding_model="bench"
+        )
+        start = time.perf_counter()
+        fn(db, doc.id, chunks)
+        return n / (time.perf_counter() - start)
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="knowledge_chunks 写入基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    print(f"数据库: {settings.DATABASE_URL}  向量维度: {args.dim}")
+    print(f"{'chunks':>8} | {'逐行写入 rows/s':>16} | {'批量写入 rows/s':>16} | {'加速':>6}")
+    print("-" * 58)
+    for n in args.sizes:
+        before = run(legacy_insert, n, args.dim)
+        after = run(bulk_insert, n, args.dim)
+        print(f"{n:>8} | {before:>16,.0f} | {after:>16,.0f} | {after / before:>5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Provider HTTP 连接复用基准测试
+对比旧写法（每次调用新建 httpx.Client）与 http_pool（按 api_base 复用长连接）的流式首字延迟（TTFT）。
+
+用法:
+    python benchmarks/bench_http_pool.py                      # 本地模拟服务，只能体现 TCP 建连开销
+    python benchmarks/bench_http_pool.py --api-base https://api.example.com/v1 --api-key sk-... --model gpt-4o-mini
+
+真实 Provider 的差异主要来自 TLS 握手（HTTPS），应以第二种方式测得的数字为准。
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+from app.ai.http_pool import http_pool  # noqa: E402
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """最小的 OpenAI 兼容流式接口"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = [
+            {"choices": [{"delta": {"content": word}}]} for word in ("你好", "，", "世界")
+        ]
+        body = "".join(f"data: {json.dumps(c, ensure_ascii=False)}\n\n" for c in chunks) + "data: [DONE]\n\n"
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server() -> str:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = ThreadingHTTPServer(("127.0.0.1", port), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def _consume(resp: httpx.Response, start: float) -> float:
+    """读完整个流式响应（连接才能复用），返回收到第一段内容的耗时"""
+    ttft = None
+    for line in resp.iter_lines():
+        if ttft is None and line.startswith("data:") and line[5:].strip() != "[DONE]":
+            ttft = time.perf_counter() - start
+    return ttft if ttft is not None else time.perf_counter() - start
+
+
+def ttft_fresh_client(api_base: str, headers, payload) -> float:
+    """旧实现：每次请求新建客户端"""
+    start = time.perf_counter()
+    with httpx.Client(timeout=None) as client:
+        with client.stream("POST", f"{api_base}/chat/completions", headers=headers, json=payload) as resp:
+            resp.raise_for_status()
+            return _consume(resp, start)
+
+
+def ttft_pooled(api_base: str, headers, payload) -> float:
+    start = time.perf_counter()
+    resp = http_pool.send(api_base, "POST", f"{api_base}/chat/completions",
+                          headers=headers, json=payload, timeout=None, stream=True)
+    try:
+        resp.raise_for_status()
+        return _consume(resp, start)
+    finally:
+        resp.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Provider 连接复用 TTFT 基准")
+    parser.add_argument("--api-base", default=None, help="不指定时启动本地模拟服务")
+    parser.add_argument("--api-key", default="bench")
+    parser.add_argument("--model", default="bench")
+    parser.add_argument("--turns", type=int, default=20, help="连续对话轮数")
+    args = parser.parse_args()
+
+    api_base = (args.api_base or start_stub_server()).rstrip("/")
+    headers = {"Authorization": f"Bearer {args.api_key}", "Content-Type": "application/json"}
+    payload = {"model": args.model, "messages": [{"role": "user", "content": "hi"}], "stream": True, "max_tokens": 8}
+
+    print(f"api_base: {api_base}  轮数: {args.turns}  HTTP/2: {http_pool.http2}")
+    print(f"{'方式':<12} | {'TTFT 中位数 ms':>14} | {'p90 ms':>8}")
+    print("-" * 42)
+    for name, fn in (("每次新建连接", ttft_fresh_client), ("连接池复用", ttft_pooled)):
+        samples = sorted(fn(api_base, headers, payload) * 1000 for _ in range(args.turns))
+        p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+        print(f"{name:<12} | {statistics.median(samples):>14.1f} | {p90:>8.1f}")
+    print(json.dumps(http_pool.stats(), ensure_ascii=False, indent=2))
+    http_pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+SQLite 并发读写基准测试
+模拟流式聊天写消息（crud.create_message，每条一次提交）与侧边栏 / 历史消息读取
+（crud.get_conversations + crud.get_messages_page）同时进行，对比两种连接配置：
+
+- 默认：只有 check_same_thread=False（rollback journal，synchronous=FULL）；
+- 调优：app.db.database.apply_sqlite_pragmas（WAL、synchronous=NORMAL、mmap、cache_size 等，取自 SQLITE_* 配置）。
+
+用法:
+    python benchmarks/bench_sqlite_concurrency.py                        # 2 写 + 8 读线程，每种配置 5 秒
+    python benchmarks/bench_sqlite_concurrency.py --writers 4 --readers 16 --seconds 10
+
+使用临时 SQLite 数据库，不会影响 app.db。
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp_dir = tempfile.mkdtemp(prefix="linga_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'app.db')}"
+# 基准只关心数据库读写，不加载常驻向量索引
+os.environ.setdefault("VECTOR_SEARCH_ENGINE", "exact")
+
+from sqlalchemy import create_engine, event, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.db import crud, models  # noqa: E402,F401
+from app.db.database import Base, apply_sqlite_pragmas, sqlite_pragmas  # noqa: E402
+
+
+def make_engine(path: str, tuned: bool):
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=32,
+        max_overflow=0,
+    )
+    if tuned:
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+    return engine
+
+
+def seed(Session, conversations: int, messages: int) -> list:
+    db = Session()
+    try:
+        ids = []
+        for i in range(conversations):
+            conv = models.Conversation(title=f"对话 {i}", is_pinned=(i % 10 == 0))
+            db.add(conv)
+            db.flush()
+            ids.append(conv.id)
+            for j in range(messages):
+                db.add(models.Message(
+                    conversation_id=conv.id,
+                    role="user" if j % 2 == 0 else "assistant",
+                    content=f"第 {j} 条消息 " * 20,
+                ))
+        db.commit()
+        return ids
+    finally:
+        db.close()
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies = {"read": [], "write": []}
+        self.errors = {"read": 0, "write": 0}
+
+    def record(self, kind: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies[kind].append(seconds)
+
+    def error(self, kind: str) -> None:
+        with self.lock:
+            self.errors[kind] += 1
+
+
+def writer(Session, conv_ids, stop, stats, seed_value):
+    rng = random.Random(seed_value)
+    body = "流式回复内容 " * 100
+    while not stop.is_set():
+        db = Session()
+        start = time.perf_counter()
+        try:
+            crud.create_message(
+                db, rng.choice(conv_ids), "assistant", body,
+                {"model": "bench", "input_tokens": 10, "output_tokens": 100, "total_tokens": 110},
+            )
+            stats.record("write", time.perf_counter() - start)
+        except Exception:
+            db.rollback()
+            stats.error("write")
+        finally:
+            db.close()
+
+
+def reader(Session, conv_ids, stop, stats, seed_value):
+    rng = random.Random(seed_value)
+    while not stop.is_set():
+        db = Session()
+        start = time.perf_counter()
+        try:
+            crud.get_conversations(db, limit=50)
+            crud.get_messages_page(db, rng.choice(conv_ids), limit=50)
+            stats.record("read", time.perf_counter() - start)
+        except Exception:
+            db.rollback()
+            stats.error("read")
+        finally:
+            db.close()
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct), len(values) - 1)]
+
+
+def run(name: str, tuned: bool, args) -> None:
+    path = os.path.join(_tmp_dir, f"{name}.db")
+    engine = make_engine(path, tuned)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    Base.metadata.create_all(bind=engine)
+    conv_ids = seed(Session, args.conversations, args.messages)
+    with engine.connect() as conn:
+        journal = conn.execute(text("PRAGMA journal_mode")).scalar()
+        synchronous = conn.execute(text("PRAGMA synchronous")).scalar()
+
+    stats = Stats()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=writer, args=(Session, conv_ids, stop, stats, i))
+        for i in range(args.writers)
+    ] + [
+        threading.Thread(target=reader, args=(Session, conv_ids, stop, stats, 1000 + i))
+        for i in range(args.readers)
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    engine.dispose()
+
+    print(f"{name:<6} journal={journal} synchronous={synchronous}")
+    for kind in ("write", "read"):
+        lat = stats.latencies[kind]
+        print(
+            f"  {kind:<5} | {len(lat) / args.seconds:>8.0f} ops/s | "
+            f"p50 {percentile(lat, 0.50) * 1000:>7.2f} ms | p99 {percentile(lat, 0.99) * 1000:>8.2f} ms | "
+            f"错误 {stats.errors[kind]}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SQLite 并发读写基准")
+    parser.add_argument("--writers", type=int, default=2, help="写线程数")
+    parser.add_argument("--readers", type=int, default=8, help="读线程数")
+    parser.add_argument("--seconds", type=float, default=5.0, help="每种配置的运行时长")
+    parser.add_argument("--conversations", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=40, help="每个对话的初始消息数")
+    args = parser.parse_args()
+
+    print(f"临时目录: {_tmp_dir}")
+    print(f"调优 PRAGMA: {', '.join(f'{k}={v}' for k, v in sqlite_pragmas()) or '（已关闭）'}")
+    print(f"{args.writers} 写线程 + {args.readers} 读线程，每种配置 {args.seconds:.0f} 秒\n")
+    run("默认", False, args)
+    run("调优", True, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+流式响应（SSE）解析基准测试
+对同一段 chat/completions 流式响应，对比三种解析方式每秒能处理的 chunk 数：
+
+- 旧实现：iter_lines() 逐行解码为 str，每行构造一个 httpx.Response 再 .json()；
+- 逐行 json：iter_lines() + json.loads（去掉 httpx.Response 之后的写法）；
+- SSEDecoder：iter_bytes() 直接交给 app.ai.sse.SSEDecoder，JSON 用 orjson（未安装时为 json）。
+
+用法:
+    python benchmarks/bench_sse_decode.py                       # 生成 10000 个 chunk 的模拟流
+    python benchmarks/bench_sse_decode.py --record stream.sse   # 同时把模拟流写入文件
+    python benchmarks/bench_sse_decode.py --file stream.sse     # 使用录制的真实响应（原始字节）
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+from app.ai.sse import DONE, JSON_BACKEND, decode_json_events, iter_sse_data  # noqa: E402
+
+_WORDS = ["你好", "，", "这是", "一段", "模拟的", "流式", "回复", "。", " Hello", " world", "\n", "**重点**", "`code`"]
+
+
+def generate_stream(chunks: int, seed: int = 42) -> bytes:
+    """模拟 OpenAI 兼容接口的流式响应：少量思考内容 + 正文 + 心跳注释 + usage + [DONE]"""
+    rng = random.Random(seed)
+    parts = []
+    for i in range(chunks):
+        delta = {"reasoning_content": rng.choice(_WORDS)} if i < chunks // 10 else {"content": rng.choice(_WORDS)}
+        obj = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "bench-model",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        parts.append(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n")
+        if i % 500 == 0:
+            parts.append(": keep-alive\n\n")
+    usage = {"choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": chunks, "total_tokens": 100 + chunks}}
+    parts.append(f"data: {json.dumps(usage)}\n\n")
+    parts.append("data: [DONE]\n\n")
+    return "".join(parts).encode("utf-8")
+
+
+def split_network_chunks(body: bytes, seed: int = 7):
+    """按网络读取的粒度随机切块（块边界可能落在行中间和多字节字符中间）"""
+    rng = random.Random(seed)
+    pieces, i = [], 0
+    while i < len(body):
+        n = rng.randint(64, 4096)
+        pieces.append(body[i:i + n])
+        i += n
+    return pieces
+
+
+def _response(pieces) -> httpx.Response:
+    return httpx.Response(200, content=iter(pieces))
+
+
+def legacy_httpx_response(pieces) -> int:
+    count = 0
+    for line in _response(pieces).iter_lines():
+        if not line:
+            continue
+        if line.startswith("data:"):
+            line = line[5:].strip()
+        if line == "[DONE]":
+            break
+        try:
+            obj = httpx.Response(200, content=line).json()
+        except Exception:
+            continue
+        if obj.get("choices"):
+            count += 1
+    return count
+
+
+def line_json(pieces) -> int:
+    count = 0
+    for line in _response(pieces).iter_lines():
+        if not line:
+            continue
+        if line.startswith("data:"):
+            line = line[5:].strip()
+        if line == "[DONE]":
+            break
+        try:
+            obj = json.loads(line)
+        except Exception:
+            continue
+        if obj.get("choices"):
+            count += 1
+    return count
+
+
+def sse_decoder(pieces) -> int:
+    count = 0
+    for data in iter_sse_data(_response(pieces).iter_bytes()):
+        if data.strip() == DONE:
+            break
+        for obj in decode_json_events(data):
+            if obj.get("choices"):
+                count += 1
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SSE 解析基准")
+    parser.add_argument("--chunks", type=int, default=10000, help="模拟流的 chunk 数")
+    parser.add_argument("--file", default=None, help="录制的流式响应原始字节")
+    parser.add_argument("--record", default=None, help="把模拟流写入该文件")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            body = f.read()
+    else:
+        body = generate_stream(args.chunks)
+        if args.record:
+            with open(args.record, "wb") as f:
+                f.write(body)
+    pieces = split_network_chunks(body)
+
+    print(f"流大小: {len(body) / 1024:.0f} KB  网络块: {len(pieces)}  JSON: {JSON_BACKEND}")
+    print(f"{'方式':<20} | {'chunk 数':>8} | {'最好 ms':>8} | {'chunk/s':>10}")
+    print("-" * 56)
+    baseline = None
+    for name, fn in (("旧实现(httpx.Response)", legacy_httpx_response),
+                     ("逐行 json.loads", line_json),
+                     ("SSEDecoder", sse_decoder)):
+        best, count = float("inf"), 0
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = fn(pieces)
+            best = min(best, time.perf_counter() - start)
+        baseline = baseline or best
+        print(f"{name:<20} | {count:>8} | {best * 1000:>8.1f} | {count / best:>10.0f}  (x{baseline / best:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+流式 XML 工具调用检测：回归语料校验 + 基准测试
+legacy_round() 是 event_stream 中旧的逐片段检测逻辑（每个片段 join 缓冲区 + 正则扫描整个缓冲区），
+XMLToolCallFilter 的输出（事件序列和结束时的状态）必须与它逐字节一致。
+
+用法:
+    python benchmarks/bench_tool_call_stream.py             # 校验语料 + 随机切分 + 基准
+    python benchmarks/bench_tool_call_stream.py --record    # 用旧实现重新生成语料的期望输出
+
+语料文件 benchmarks/tool_call_stream_corpus.json，每条为:
+    {"name": ..., "enable_thinking": bool, "chunks": [["thinking" | "content", 文本], ...], "expected": {...}}
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.ai.tool_call_stream import XMLToolCallFilter  # noqa: E402
+
+CORPUS = os.path.join(ROOT, "benchmarks", "tool_call_stream_corpus.json")
+
+_OPEN = r'<[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>'
+_CLOSE = r'</[\s\|]*(?:DSML\s*\|)?\s*(?:antml:)?function_calls\s*>'
+
+
+def legacy_round(chunks, enable_thinking):
+    """旧实现（一轮流式生成），yield 改为记录 (类型, 内容)"""
+    events = []
+    thinking_content = []
+    is_thinking_done = False
+    xml_tool_buffer = ""
+    in_xml_tool_call = False
+    has_xml_tool_call = False
+    pending_output = []
+    thinking_buffer = []
+
+    for chunk_type, text in chunks:
+        if chunk_type == "thinking":
+            thinking = text
+            if thinking:
+                thinking_content.append(thinking)
+                thinking_buffer.append(thinking)
+                thinking_so_far = "".join(thinking_buffer)
+                fc_match = re.search(_OPEN, thinking_so_far, re.IGNORECASE)
+                if fc_match:
+                    fc_start = fc_match.start()
+                    thinking_before_fc = thinking_so_far[:fc_start]
+                    if thinking_before_fc.strip():
+                        events.append(("thinking_end", thinking_before_fc))
+                    is_thinking_done = True
+                    in_xml_tool_call = True
+                    xml_tool_buffer = thinking_so_far[fc_start:]
+                    thinking_buffer = []
+                    if re.search(_CLOSE, xml_tool_buffer, re.IGNORECASE):
+                        in_xml_tool_call = False
+                        has_xml_tool_call = True
+                    continue
+                if in_xml_tool_call:
+                    xml_tool_buffer += thinking
+                    if re.search(_CLOSE, xml_tool_buffer, re.IGNORECASE):
+                        in_xml_tool_call = False
+                        has_xml_tool_call = True
+                    continue
+                potential_xml_in_thinking = False
+                if '<' in thinking_so_far:
+                    last_lt_pos = thinking_so_far.rfind('<')
+                    remaining = thinking_so_far[last_lt_pos:].lower().replace(' ', '').replace('\n', '')
+                    possible_starts = ['<function_calls>', '<|dsml|function_calls>', '<|', '<f', '<fu', '<fun', '<func', '<funct', '<functi', '<functio', '<function', '<function_', '<function_c', '<function_ca', '<function_cal', '<function_call', '<function_calls', '<ds', '<dsm', '<dsml']
+                    for ps in possible_starts:
+                        if ps.startswith(remaining) or remaining.startswith(ps.rstrip('>')):
+                            potential_xml_in_thinking = True
+                            break
+                if potential_xml_in_thinking:
+                    continue
+                if '<' in thinking_so_far:
+                    last_lt_pos = thinking_so_far.rfind('<')
+                    safe_content = thinking_so_far[:last_lt_pos]
+                    if safe_content.strip():
+                        events.append(("thinking", safe_content))
+                    thinking_buffer = [thinking_so_far[last_lt_pos:]]
+                else:
+                    events.append(("thinking", thinking_so_far))
+                    thinking_buffer = []
+            continue
+
+        delta = text
+        if not delta:
+            continue
+        if in_xml_tool_call:
+            xml_tool_buffer += delta
+            if re.search(_CLOSE, xml_tool_buffer, re.IGNORECASE):
+                in_xml_tool_call = False
+                has_xml_tool_call = True
+            continue
+        pending_output.append(delta)
+        pending_content = "".join(pending_output)
+        potential_xml_start = False
+        if "<" in pending_content:
+            last_lt_pos = pending_content.rfind("<")
+            remaining = pending_content[last_lt_pos:].lower().replace(" ", "").replace("\n", "")
+            target_tags = ['<function_calls>', '<function_calls>', '<|dsml|function_calls>']
+            for tag in target_tags:
+                tag_lower = tag.lower()
+                if tag_lower.startswith(remaining) and len(remaining) < len(tag_lower):
+                    potential_xml_start = True
+                    break
+            if potential_xml_start and len(remaining) > 50:
+                potential_xml_start = False
+        fc_match = re.search(_OPEN, pending_content, re.IGNORECASE)
+        if fc_match:
+            in_xml_tool_call = True
+            fc_start = fc_match.start()
+            if fc_start > 0:
+                before_fc = pending_content[:fc_start]
+                if before_fc.strip():
+                    if enable_thinking and not is_thinking_done:
+                        is_thinking_done = True
+                        events.append(("thinking_end", "".join(thinking_content) if thinking_content else ""))
+                    events.append(("text", before_fc))
+            xml_tool_buffer = pending_content[fc_start:]
+            pending_output = []
+            if re.search(_CLOSE, xml_tool_buffer, re.IGNORECASE):
+                in_xml_tool_call = False
+                has_xml_tool_call = True
+            continue
+        if potential_xml_start:
+            continue
+        if enable_thinking and not is_thinking_done:
+            is_thinking_done = True
+            events.append(("thinking_end", "".join(thinking_content) if thinking_content else ""))
+        output_content = "".join(pending_output)
+        if output_content:
+            events.append(("text", output_content))
+        pending_output = []
+
+    if thinking_buffer and not in_xml_tool_call and not has_xml_tool_call:
+        thinking_so_far = "".join(thinking_buffer)
+        fc_match = re.search(_OPEN, thinking_so_far, re.IGNORECASE)
+        if fc_match:
+            fc_start = fc_match.start()
+            xml_tool_buffer = thinking_so_far[fc_start:]
+            if re.search(_CLOSE, xml_tool_buffer, re.IGNORECASE):
+                has_xml_tool_call = True
+                thinking_before_fc = thinking_so_far[:fc_start]
+                if thinking_before_fc.strip() and not is_thinking_done:
+                    events.append(("thinking_end", thinking_before_fc))
+                    is_thinking_done = True
+
+    if in_xml_tool_call:
+        if re.search(_CLOSE, xml_tool_buffer, re.IGNORECASE):
+            in_xml_tool_call = False
+            has_xml_tool_call = True
+        else:
+            if enable_thinking and not is_thinking_done:
+                is_thinking_done = True
+                events.append(("thinking_end", "".join(thinking_content) if thinking_content else ""))
+            events.append(("text", xml_tool_buffer))
+            in_xml_tool_call = False
+
+    if pending_output and not in_xml_tool_call:
+        if enable_thinking and not is_thinking_done:
+            is_thinking_done = True
+            events.append(("thinking_end", "".join(thinking_content) if thinking_content else ""))
+        output_content = "".join(pending_output)
+        if output_content:
+            events.append(("text", output_content))
+
+    return _result(events, is_thinking_done, has_xml_tool_call, xml_tool_buffer, thinking_content)
+
+
+def filter_round(chunks, enable_thinking):
+    f = XMLToolCallFilter(enable_thinking)
+    events = []
+    for chunk_type, text in chunks:
+        if not text:
+            continue
+        if chunk_type == "thinking":
+            events += f.feed_thinking(text)
+        else:
+            events += f.feed_content(text)
+    events += f.finish()
+    xml = f.xml_tool_buffer if f.has_xml_tool_call else ""
+    return _result(events, f.is_thinking_done, f.has_xml_tool_call, xml, f.thinking_content)
+
+
+def _result(events, is_thinking_done, has_xml_tool_call, xml_tool_buffer, thinking_content):
+    # 没有完整工具调用时 xml_tool_buffer 不会被使用，不参与比较
+    return {
+        "events": [list(e) for e in events],
+        "is_thinking_done": is_thinking_done,
+        "has_xml_tool_call": has_xml_tool_call,
+        "xml_tool_buffer": xml_tool_buffer if has_xml_tool_call else "",
+        "thinking": "".join(thinking_content),
+    }
+
+
+# ---------- 语料 ----------
+
+_TOOL_CALLS = [
+    '<function_calls>\n<invoke name="search_knowledge">\n<parameter name="query">灵枢</parameter>\n</invoke>\n</function_calls>',
+    '<function_calls><invoke name="web_search"><parameter name="query">天气</parameter></invoke></function_calls>',
+    '<| DSML | function_calls>\n<| DSML | invoke name="web_search">\n<| DSML | parameter name="query">x</| DSML | parameter>\n</| DSML | invoke>\n</| DSML | function_calls>',
+    '<FUNCTION_CALLS >\n<invoke name="a"></invoke>\n</ function_calls>',
+    '<|dsml|function_calls><invoke name="b"></invoke></|DSML|function_calls>',
+]
+
+_PROSE = [
+    "你好，这是一个普通的回答。\n",
+    "比较大小：a < b 且 b > c。",
+    "HTML 示例 <div>内容</div> 和 <b>粗体</b>。",
+    "以 <f 开头但不是标签 <foo>",
+    "代码 `x<y` 以及 <| 管道 |>",
+    "  \n\n  ",
+    "<d",
+    "<ds 不是 dsml",
+    "<function_call 少了一个 s",
+    "结尾的 <",
+    "<",
+    "<fun",
+]
+
+
+def _base_cases():
+    cases = []
+    for i, call in enumerate(_TOOL_CALLS):
+        cases.append(("content_call_%d" % i, True, [["thinking", "先想一想。"], ["content", "好的，"], ["content", call], ["content", "之后的内容"]]))
+        cases.append(("thinking_call_%d" % i, True, [["thinking", "需要搜索。"], ["thinking", call]]))
+        cases.append(("no_thinking_call_%d" % i, False, [["content", "查一下" + call]]))
+        cases.append(("incomplete_call_%d" % i, True, [["content", "前文"], ["content", call[: len(call) // 2]]]))
+    for i, prose in enumerate(_PROSE):
+        cases.append(("content_prose_%d" % i, True, [["thinking", "思考"], ["content", prose], ["content", "继续"]]))
+        cases.append(("thinking_prose_%d" % i, True, [["thinking", prose], ["thinking", "继续思考"], ["content", "正文"]]))
+        cases.append(("prose_tail_%d" % i, False, [["content", "开头"], ["content", prose]]))
+    cases.append(("thinking_only", True, [["thinking", "只有思考"], ["thinking", "没有正文"]]))
+    cases.append(("mixed_xml_from_content_then_thinking", True,
+                  [["content", "正文<function_calls><invoke name=\"a\">"], ["thinking", "插入的思考 <function_calls>"], ["content", "</invoke></function_calls>"]]))
+    cases.append(("two_calls", True, [["content", _TOOL_CALLS[1]], ["content", "中间"], ["content", _TOOL_CALLS[0]]]))
+    cases.append(("long_whitespace_after_lt", False, [["content", "<" + " " * 100], ["content", "function_calls>"], ["content", "</function_calls>"]]))
+    cases.append(("kelvin_and_long_s", False, [["content", "<function_calls>x</function_calls>"], ["content", "<FUNCTION_CALLſ>"]]))
+    return cases
+
+
+def _random_split(chunks, rng):
+    """把每个片段随机切成更小的片段（保持类型），模拟不同的网络切分"""
+    out = []
+    for chunk_type, text in chunks:
+        i = 0
+        while i < len(text):
+            n = rng.randint(1, 8)
+            out.append([chunk_type, text[i:i + n]])
+            i += n
+    return out
+
+
+def _random_case(rng):
+    pieces = []
+    for _ in range(rng.randint(1, 8)):
+        chunk_type = rng.choice(["thinking", "content", "content"])
+        pieces.append([chunk_type, rng.choice(_PROSE + _TOOL_CALLS + ["普通文本", "<", "</", "|", " "])])
+    return pieces
+
+
+def record() -> None:
+    corpus = []
+    for name, enable_thinking, chunks in _base_cases():
+        corpus.append({"name": name, "enable_thinking": enable_thinking, "chunks": chunks,
+                       "expected": legacy_round(chunks, enable_thinking)})
+    with open(CORPUS, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, ensure_ascii=False, indent=1)
+        f.write("\n")
+    print(f"已写入 {len(corpus)} 条语料: {CORPUS}")
+
+
+def check(fuzz: int) -> bool:
+    with open(CORPUS, encoding="utf-8") as f:
+        corpus = json.load(f)
+    failures = 0
+    for case in corpus:
+        got = filter_round(case["chunks"], case["enable_thinking"])
+        if got != case["expected"]:
+            failures += 1
+            print(f"[语料不一致] {case['name']}\n  期望: {case['expected']}\n  实际: {got}")
+
+    rng = random.Random(0)
+    for n in range(fuzz):
+        base = corpus[n % len(corpus)]["chunks"] if n % 2 else _random_case(rng)
+        chunks = _random_split(base, rng)
+        enable_thinking = bool(n % 3)
+        expected = legacy_round(chunks, enable_thinking)
+        got = filter_round(chunks, enable_thinking)
+        if got != expected:
+            failures += 1
+            if failures <= 5:
+                print(f"[随机切分不一致] #{n}\n  输入: {chunks}\n  期望: {expected}\n  实际: {got}")
+    print(f"语料 {len(corpus)} 条，随机切分 {fuzz} 次，不一致 {failures} 处")
+    return failures == 0
+
+
+def bench() -> None:
+    rng = random.Random(1)
+    words = ["这是", "一段", "较长的", "回答", "，", "。", "\n", " a < b ", "<b>", "粗体", "</b>"]
+    # 正文较长；思考中出现非标签的 '<' 后长时间没有下一个 '<'（旧实现会反复 join + 扫描整段缓冲区）
+    scenarios = {
+        "长正文 20000 片段": [["content", rng.choice(words)] for _ in range(20000)],
+        "思考中 '<b>' 后 5000 片段": [["thinking", "<b>"]] + [["thinking", "思考"] for _ in range(5000)] + [["content", "正文"]],
+        "长工具调用 5000 片段": [["content", "<function_calls>"]] + [["content", "参数"] for _ in range(5000)] + [["content", "</function_calls>"]],
+    }
+    print(f"{'场景':<24} | {'旧实现 ms':>10} | {'状态机 ms':>10}")
+    print("-" * 52)
+    for name, chunks in scenarios.items():
+        timings = []
+        for fn in (legacy_round, filter_round):
+            best = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                result = fn(chunks, True)
+                best = min(best, time.perf_counter() - start)
+            timings.append(best * 1000)
+        assert legacy_round(chunks, True) == result
+        print(f"{name:<24} | {timings[0]:>10.1f} | {timings[1]:>10.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="流式 XML 工具调用检测回归校验")
+    parser.add_argument("--record", action="store_true", help="用旧实现重新生成语料期望输出")
+    parser.add_argument("--fuzz", type=int, default=3000, help="随机切分的次数")
+    args = parser.parse_args()
+    if args.record:
+        record()
+        return
+    ok = check(args.fuzz)
+    bench()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1669,14 +1669,25 @@ function initThinkingToggle() {
     });
 }
 
+// 对话列表每页条数：首页加载后立即渲染，其余页在后台继续加载
+const CONVERSATION_PAGE_SIZE = 200;
+
 async function loadConversations() {
     try {
-        const res = await fetch(`${apiBase}/conversations`);
-        if (!res.ok) return;
-        const raw = await res.json();
-        const data = normalizeApiResponse(raw);
-        conversations = Array.isArray(data) ? data : (data?.conversations || []);
-        renderConversationList();
+        let cursor = null;
+        let loaded = [];
+        do {
+            const params = new URLSearchParams({ limit: CONVERSATION_PAGE_SIZE });
+            if (cursor) params.set("cursor", cursor);
+            const res = await fetch(`${apiBase}/conversations?${params}`);
+            if (!res.ok) return;
+            const raw = await res.json();
+            const data = normalizeApiResponse(raw);
+            loaded = loaded.concat(Array.isArray(data) ? data : (data?.conversations || []));
+            cursor = data?.has_more ? data.next_cursor : null;
+            conversations = loaded;
+            renderConversationList();
+        } while (cursor);
     } catch(e) { console.error(e); }
 }
 
@@ -2571,6 +2582,286 @@ function renderConversationList() {
     });
 }
 
+/**
+ * 渲染历史消息的提示区域（视觉识别、工具调用、深度思考等）
+ * @param {HTMLElement} hintsEl - 消息的提示区域
+ * @param {object} extraData - 消息详情 {message_events, tool_calls, thinking_content, vision_content}
+ */
+function renderMessageHints(hintsEl, extraData) {
+    // 优先使用新的 message_events 格式（按时间顺序记录的事件流）
+    if (extraData.message_events) {
+        try {
+            const events = typeof extraData.message_events === 'string' 
+                ? JSON.parse(extraData.message_events) 
+                : extraData.message_events;
+            
+            if (events && events.length > 0) {
+                // 用于合并连续的同类型事件
+                let toolCallsGroup = [];
+                let textContentGroup = [];  // 合并连续的 text 事件
+                
+                const flushToolCalls = () => {
+                    if (toolCallsGroup.length > 0) {
+                        const toolHint = document.createElement("div");
+                        toolHint.className = "tool-hint completed";
+                        
+                        const toolDetails = document.createElement("details");
+                        toolDetails.className = "tool-details";
+                        
+                        const hasMcpTool = toolCallsGroup.some(tc => tc.name && tc.name.startsWith("mcp_"));
+                        const toolIcon = hasMcpTool ? "🔌" : "🛠️";
+                        
+                        const toolSummary = document.createElement("summary");
+                        toolSummary.innerHTML = `<span class="tool-icon">${toolIcon}</span> <span class="tool-status">工具调用完成 (${toolCallsGroup.length}次)</span>`;
+                        toolDetails.appendChild(toolSummary);
+                        
+                        const toolContent = document.createElement("div");
+                        toolContent.className = "tool-details-content";
+                        toolCallsGroup.forEach((tc, idx) => {
+                            let displayName = tc.name || '未知工具';
+                            if (tc.name && tc.name.startsWith("mcp_")) {
+                                const parts = tc.name.split("_");
+                                if (parts.length >= 3) {
+                                    displayName = "MCP:" + parts[1] + ":" + parts.slice(2).join("_");
+                                }
+                            }
+                            
+                            const callDiv = document.createElement("div");
+                            callDiv.className = "tool-call-item";
+                            callDiv.innerHTML = `
+                                <div class="tool-call-name">${idx + 1}. ${displayName}</div>
+                                <div class="tool-call-args">${typeof tc.args === 'string' ? tc.args : JSON.stringify(tc.args, null, 2)}</div>
+                                ${tc.result_preview ? `<div class="tool-call-result">结果: ${tc.result_preview}</div>` : ""}
+                            `;
+                            toolContent.appendChild(callDiv);
+                        });
+                        toolDetails.appendChild(toolContent);
+                        toolHint.appendChild(toolDetails);
+                        hintsEl.appendChild(toolHint);
+                        toolCallsGroup = [];
+                    }
+                };
+                
+                // 合并并渲染连续的 text 事件
+                const flushTextContent = () => {
+                    if (textContentGroup.length > 0) {
+                        const combinedText = textContentGroup.join('');
+                        const textBlock = document.createElement("div");
+                        textBlock.className = "text-block markdown-body completed";
+                        if (window.MarkdownEngine && window.MarkdownEngine.renderFinal) {
+                            window.MarkdownEngine.renderFinal(textBlock, combinedText);
+                        } else {
+                            textBlock.innerHTML = combinedText.replace(/\n/g, '<br>');
+                        }
+                        hintsEl.appendChild(textBlock);
+                        textContentGroup = [];
+                    }
+                };
+                
+                events.forEach(event => {
+                    if (event.type === "vision") {
+                        flushToolCalls();
+                        flushTextContent();  // 先渲染之前的文本
+                        const visionHint = document.createElement("div");
+                        visionHint.className = "vision-hint completed";
+                        
+                        const visionDetails = document.createElement("details");
+                        visionDetails.className = "vision-details";
+                        
+                        const visionSummary = document.createElement("summary");
+                        visionSummary.innerHTML = `<span class="vision-icon">👁️</span> <span class="vision-status">图片识别完成</span>`;
+                        visionDetails.appendChild(visionSummary);
+                        
+                        const visionContent = document.createElement("div");
+                        visionContent.className = "vision-content";
+                        visionContent.innerHTML = event.content.replace(/\n/g, '<br>');
+                        visionDetails.appendChild(visionContent);
+                        
+                        visionHint.appendChild(visionDetails);
+                        hintsEl.appendChild(visionHint);
+                    } else if (event.type === "tool_call") {
+                        flushTextContent();  // 先渲染之前的文本
+                        // 收集连续的工具调用
+                        toolCallsGroup.push(event.content);
+                    } else if (event.type === "thinking") {
+                        flushToolCalls();
+                        flushTextContent();  // 先渲染之前的文本
+                        const thinkingHint = document.createElement("div");
+                        thinkingHint.className = "thinking-hint completed";
+                        
+                        const thinkingDetails = document.createElement("details");
+                        thinkingDetails.className = "thinking-details";
+                        
+                        const thinkingSummary = document.createElement("summary");
+                        thinkingSummary.innerHTML = `<span class="thinking-icon">🧠</span> <span class="thinking-status">深度思考完成</span>`;
+                        thinkingDetails.appendChild(thinkingSummary);
+                        
+                        const thinkingContent = document.createElement("div");
+                        thinkingContent.className = "thinking-content";
+                        // 使用 Markdown 渲染思考内容
+                        if (window.MarkdownEngine && window.MarkdownEngine.renderFinal) {
+                            window.MarkdownEngine.renderFinal(thinkingContent, event.content);
+                        } else {
+                            thinkingContent.innerHTML = event.content.replace(/\n/g, '<br>');
+                        }
+                        thinkingDetails.appendChild(thinkingContent);
+                        
+                        thinkingHint.appendChild(thinkingDetails);
+                        hintsEl.appendChild(thinkingHint);
+                    } else if (event.type === "text") {
+                        flushToolCalls();
+                        // 收集连续的 text 事件，稍后合并渲染
+                        textContentGroup.push(event.content);
+                    }
+                });
+                
+                // 处理剩余的工具调用和文本内容
+                flushToolCalls();
+                flushTextContent();
+            }
+        } catch (e) {
+            console.warn("解析消息事件失败:", e);
+        }
+    } else {
+        // 回退到旧格式：按固定顺序显示（视觉识别 → 工具调用 → 深度思考）
+        // 1. 首先显示视觉识别历史
+        if (extraData.vision_content) {
+            const visionHint = document.createElement("div");
+            visionHint.className = "vision-hint completed";
+            
+            const visionDetails = document.createElement("details");
+            visionDetails.className = "vision-details";
+            
+            const visionSummary = document.createElement("summary");
+            visionSummary.innerHTML = `<span class="vision-icon">👁️</span> <span class="vision-status">图片识别完成</span>`;
+            visionDetails.appendChild(visionSummary);
+            
+            const visionContent = document.createElement("div");
+            visionContent.className = "vision-content";
+            visionContent.innerHTML = extraData.vision_content.replace(/\n/g, '<br>');
+            visionDetails.appendChild(visionContent);
+            
+            visionHint.appendChild(visionDetails);
+            hintsEl.appendChild(visionHint);
+        }
+        
+        // 2. 然后显示工具调用历史
+        if (extraData.tool_calls) {
+            try {
+                const toolCalls = typeof extraData.tool_calls === 'string' 
+                    ? JSON.parse(extraData.tool_calls) 
+                    : extraData.tool_calls;
+                if (toolCalls && toolCalls.length > 0) {
+                    const toolHint = document.createElement("div");
+                    toolHint.className = "tool-hint completed";
+                    
+                    const toolDetails = document.createElement("details");
+                    toolDetails.className = "tool-details";
+                    
+                    const hasMcpTool = toolCalls.some(tc => tc.name && tc.name.startsWith("mcp_"));
+                    const toolIcon = hasMcpTool ? "🔌" : "🛠️";
+                    
+                    const toolSummary = document.createElement("summary");
+                    toolSummary.innerHTML = `<span class="tool-icon">${toolIcon}</span> <span class="tool-status">工具调用完成 (${toolCalls.length}次)</span>`;
+                    toolDetails.appendChild(toolSummary);
+                    
+                    const toolContent = document.createElement("div");
+                    toolContent.className = "tool-details-content";
+                    toolCalls.forEach((tc, idx) => {
+                        let displayName = tc.name || '未知工具';
+                        if (tc.name && tc.name.startsWith("mcp_")) {
+                            const parts = tc.name.split("_");
+                            if (parts.length >= 3) {
+                                displayName = "MCP:" + parts[1] + ":" + parts.slice(2).join("_");
+                            }
+                        }
+                        
+                        const callDiv = document.createElement("div");
+                        callDiv.className = "tool-call-item";
+                        callDiv.innerHTML = `
+                            <div class="tool-call-name">${idx + 1}. ${displayName}</div>
+                            <div class="tool-call-args">${typeof tc.args === 'string' ? tc.args : JSON.stringify(tc.args, null, 2)}</div>
+                            ${tc.result_preview ? `<div class="tool-call-result">结果: ${tc.result_preview}</div>` : ""}
+                        `;
+                        toolContent.appendChild(callDiv);
+                    });
+                    toolDetails.appendChild(toolContent);
+                    toolHint.appendChild(toolDetails);
+                    hintsEl.appendChild(toolHint);
+                }
+            } catch (e) {
+                console.warn("解析工具调用历史失败:", e);
+            }
+        }
+        
+        // 3. 最后显示深度思考历史
+        if (extraData.thinking_content) {
+            const thinkingHint = document.createElement("div");
+            thinkingHint.className = "thinking-hint completed";
+            
+            const thinkingDetails = document.createElement("details");
+            thinkingDetails.className = "thinking-details";
+            
+            const thinkingSummary = document.createElement("summary");
+            thinkingSummary.innerHTML = `<span class="thinking-icon">🧠</span> <span class="thinking-status">深度思考完成</span>`;
+            thinkingDetails.appendChild(thinkingSummary);
+            
+            const thinkingContent = document.createElement("div");
+            thinkingContent.className = "thinking-content";
+            // 使用 Markdown 渲染思考内容
+            if (window.MarkdownEngine && window.MarkdownEngine.renderFinal) {
+                window.MarkdownEngine.renderFinal(thinkingContent, extraData.thinking_content);
+            } else {
+                thinkingContent.innerHTML = extraData.thinking_content.replace(/\n/g, '<br>');
+            }
+            thinkingDetails.appendChild(thinkingContent);
+            
+            thinkingHint.appendChild(thinkingDetails);
+            hintsEl.appendChild(thinkingHint);
+        }
+    }
+}
+
+/**
+ * 消息详情占位：历史消息分页加载时不带详情，展开时从 detailsUrl 获取后再渲染
+ * @param {HTMLElement} hintsEl - 消息的提示区域
+ * @param {string} detailsUrl - /conversations/{id}/messages/{message_id}/events
+ */
+function appendLazyMessageDetails(hintsEl, detailsUrl) {
+    const detailsHint = document.createElement("div");
+    detailsHint.className = "history-details-hint";
+    
+    const details = document.createElement("details");
+    details.className = "history-details";
+    
+    const summary = document.createElement("summary");
+    summary.innerHTML = `<span class="history-details-icon">🧩</span> <span class="history-details-status">查看思考与工具调用过程</span>`;
+    details.appendChild(summary);
+    detailsHint.appendChild(details);
+    hintsEl.appendChild(detailsHint);
+    
+    const statusEl = summary.querySelector(".history-details-status");
+    details.addEventListener("toggle", async () => {
+        if (!details.open || details.dataset.loading) return;
+        details.dataset.loading = "1";
+        statusEl.textContent = "加载中...";
+        try {
+            const res = await fetch(detailsUrl);
+            if (!res.ok) throw new Error(`HTTP ${res.status}`);
+            const data = normalizeApiResponse(await res.json());
+            detailsHint.remove();
+            renderMessageHints(hintsEl, data);
+            // 用户点击的是展开，加载后直接展开各项详情
+            hintsEl.querySelectorAll("details").forEach(el => { el.open = true; });
+        } catch (e) {
+            console.warn("加载消息详情失败:", e);
+            statusEl.textContent = "加载失败，点击重试";
+            details.open = false;
+            delete details.dataset.loading;
+        }
+    });
+}
+
 /**
  * 添加消息到聊天区域
  * @param {string} role - 'user' 或 'assistant'
@@ -2615,240 +2906,11 @@ function appendMessage(role, content, tokenInfo = null, showFooter = true, extra
         hintsEl.className = "message-hints";
         msgEl.appendChild(hintsEl);
         
-        // 如果有历史的消息事件，按顺序显示它们
-        if (extraData) {
-            // 优先使用新的 message_events 格式（按时间顺序记录的事件流）
-            if (extraData.message_events) {
-                try {
-                    const events = typeof extraData.message_events === 'string' 
-                        ? JSON.parse(extraData.message_events) 
-                        : extraData.message_events;
-                    
-                    if (events && events.length > 0) {
-                        // 用于合并连续的同类型事件
-                        let toolCallsGroup = [];
-                        let textContentGroup = [];  // 合并连续的 text 事件
-                        
-                        const flushToolCalls = () => {
-                            if (toolCallsGroup.length > 0) {
-                                const toolHint = document.createElement("div");
-                                toolHint.className = "tool-hint completed";
-                                
-                                const toolDetails = document.createElement("details");
-                                toolDetails.className = "tool-details";
-                                
-                                const hasMcpTool = toolCallsGroup.some(tc => tc.name && tc.name.startsWith("mcp_"));
-                                const toolIcon = hasMcpTool ? "🔌" : "🛠️";
-                                
-                                const toolSummary = document.createElement("summary");
-                                toolSummary.innerHTML = `<span class="tool-icon">${toolIcon}</span> <span class="tool-status">工具调用完成 (${toolCallsGroup.length}次)</span>`;
-                                toolDetails.appendChild(toolSummary);
-                                
-                                const toolContent = document.createElement("div");
-                                toolContent.className = "tool-details-content";
-                                toolCallsGroup.forEach((tc, idx) => {
-                                    let displayName = tc.name || '未知工具';
-                                    if (tc.name && tc.name.startsWith("mcp_")) {
-                                        const parts = tc.name.split("_");
-                                        if (parts.length >= 3) {
-                                            displayName = "MCP:" + parts[1] + ":" + parts.slice(2).join("_");
-                                        }
-                                    }
-                                    
-                                    const callDiv = document.createElement("div");
-                                    callDiv.className = "tool-call-item";
-                                    callDiv.innerHTML = `
-                                        <div class="tool-call-name">${idx + 1}. ${displayName}</div>
-                                        <div class="tool-call-args">${typeof tc.args === 'string' ? tc.args : JSON.stringify(tc.args, null, 2)}</div>
-                                        ${tc.result_preview ? `<div class="tool-call-result">结果: ${tc.result_preview}</div>` : ""}
-                                    `;
-                                    toolContent.appendChild(callDiv);
-                                });
-                                toolDetails.appendChild(toolContent);
-                                toolHint.appendChild(toolDetails);
-                                hintsEl.appendChild(toolHint);
-                                toolCallsGroup = [];
-                            }
-                        };
-                        
-                        // 合并并渲染连续的 text 事件
-                        const flushTextContent = () => {
-                            if (textContentGroup.length > 0) {
-                                const combinedText = textContentGroup.join('');
-                                const textBlock = document.createElement("div");
-                                textBlock.className = "text-block markdown-body completed";
-                                if (window.MarkdownEngine && window.MarkdownEngine.renderFinal) {
-                                    window.MarkdownEngine.renderFinal(textBlock, combinedText);
-                                } else {
-                                    textBlock.innerHTML = combinedText.replace(/\n/g, '<br>');
-                                }
-                                hintsEl.appendChild(textBlock);
-                                textContentGroup = [];
-                            }
-                        };
-                        
-                        events.forEach(event => {
-                            if (event.type === "vision") {
-                                flushToolCalls();
-                                flushTextContent();  // 先渲染之前的文本
-                                const visionHint = document.createElement("div");
-                                visionHint.className = "vision-hint completed";
-                                
-                                const visionDetails = document.createElement("details");
-                                visionDetails.className = "vision-details";
-                                
-                                const visionSummary = document.createElement("summary");
-                                visionSummary.innerHTML = `<span class="vision-icon">👁️</span> <span class="vision-status">图片识别完成</span>`;
-                                visionDetails.appendChild(visionSummary);
-                                
-                                const visionContent = document.createElement("div");
-                                visionContent.className = "vision-content";
-                                visionContent.innerHTML = event.content.replace(/\n/g, '<br>');
-                                visionDetails.appendChild(visionContent);
-                                
-                                visionHint.appendChild(visionDetails);
-                                hintsEl.appendChild(visionHint);
-                            } else if (event.type === "tool_call") {
-                                flushTextContent();  // 先渲染之前的文本
-                                // 收集连续的工具调用
-                                toolCallsGroup.push(event.content);
-                            } else if (event.type === "thinking") {
-                                flushToolCalls();
-                                flushTextContent();  // 先渲染之前的文本
-                                const thinkingHint = document.createElement("div");
-                                thinkingHint.className = "thinking-hint completed";
-                                
-                                const thinkingDetails = document.createElement("details");
-                                thinkingDetails.className = "thinking-details";
-                                
-                                const thinkingSummary = document.createElement("summary");
-                                thinkingSummary.innerHTML = `<span class="thinking-icon">🧠</span> <span class="thinking-status">深度思考完成</span>`;
-                                thinkingDetails.appendChild(thinkingSummary);
-                                
-                                const thinkingContent = document.createElement("div");
-                                thinkingContent.className = "thinking-content";
-                                // 使用 Markdown 渲染思考内容
-                                if (window.MarkdownEngine && window.MarkdownEngine.renderFinal) {
-                                    window.MarkdownEngine.renderFinal(thinkingContent, event.content);
-                                } else {
-                                    thinkingContent.innerHTML = event.content.replace(/\n/g, '<br>');
-                                }
-                                thinkingDetails.appendChild(thinkingContent);
-                                
-                                thinkingHint.appendChild(thinkingDetails);
-                                hintsEl.appendChild(thinkingHint);
-                            } else if (event.type === "text") {
-                                flushToolCalls();
-                                // 收集连续的 text 事件，稍后合并渲染
-                                textContentGroup.push(event.content);
-                            }
-                        });
-                        
-                        // 处理剩余的工具调用和文本内容
-                        flushToolCalls();
-                        flushTextContent();
-                    }
-                } catch (e) {
-                    console.warn("解析消息事件失败:", e);
-                }
-            } else {
-                // 回退到旧格式：按固定顺序显示（视觉识别 → 工具调用 → 深度思考）
-                // 1. 首先显示视觉识别历史
-                if (extraData.vision_content) {
-                    const visionHint = document.createElement("div");
-                    visionHint.className = "vision-hint completed";
-                    
-                    const visionDetails = document.createElement("details");
-                    visionDetails.className = "vision-details";
-                    
-                    const visionSummary = document.createElement("summary");
-                    visionSummary.innerHTML = `<span class="vision-icon">👁️</span> <span class="vision-status">图片识别完成</span>`;
-                    visionDetails.appendChild(visionSummary);
-                    
-                    const visionContent = document.createElement("div");
-                    visionContent.className = "vision-content";
-                    visionContent.innerHTML = extraData.vision_content.replace(/\n/g, '<br>');
-                    visionDetails.appendChild(visionContent);
-                    
-                    visionHint.appendChild(visionDetails);
-                    hintsEl.appendChild(visionHint);
-                }
-                
-                // 2. 然后显示工具调用历史
-                if (extraData.tool_calls) {
-                    try {
-                        const toolCalls = typeof extraData.tool_calls === 'string' 
-                            ? JSON.parse(extraData.tool_calls) 
-                            : extraData.tool_calls;
-                        if (toolCalls && toolCalls.length > 0) {
-                            const toolHint = document.createElement("div");
-                            toolHint.className = "tool-hint completed";
-                            
-                            const toolDetails = document.createElement("details");
-                            toolDetails.className = "tool-details";
-                            
-                            const hasMcpTool = toolCalls.some(tc => tc.name && tc.name.startsWith("mcp_"));
-                            const toolIcon = hasMcpTool ? "🔌" : "🛠️";
-                            
-                            const toolSummary = document.createElement("summary");
-                            toolSummary.innerHTML = `<span class="tool-icon">${toolIcon}</span> <span class="tool-status">工具调用完成 (${toolCalls.length}次)</span>`;
-                            toolDetails.appendChild(toolSummary);
-                            
-                            const toolContent = document.createElement("div");
-                            toolContent.className = "tool-details-content";
-                            toolCalls.forEach((tc, idx) => {
-                                let displayName = tc.name || '未知工具';
-                                if (tc.name && tc.name.startsWith("mcp_")) {
-                                    const parts = tc.name.split("_");
-                                    if (parts.length >= 3) {
-                                        displayName = "MCP:" + parts[1] + ":" + parts.slice(2).join("_");
-                                    }
-                                }
-                                
-                                const callDiv = document.createElement("div");
-                                callDiv.className = "tool-call-item";
-                                callDiv.innerHTML = `
-                                    <div class="tool-call-name">${idx + 1}. ${displayName}</div>
-                                    <div class="tool-call-args">${typeof tc.args === 'string' ? tc.args : JSON.stringify(tc.args, null, 2)}</div>
-                                    ${tc.result_preview ? `<div class="tool-call-result">结果: ${tc.result_preview}</div>` : ""}
-                                `;
-                                toolContent.appendChild(callDiv);
-                            });
-                            toolDetails.appendChild(toolContent);
-                            toolHint.appendChild(toolDetails);
-                            hintsEl.appendChild(toolHint);
-                        }
-                    } catch (e) {
-                        console.warn("解析工具调用历史失败:", e);
-                    }
-                }
-                
-                // 3. 最后显示深度思考历史
-                if (extraData.thinking_content) {
-                    const thinkingHint = document.createElement("div");
-                    thinkingHint.className = "thinking-hint completed";
-                    
-                    const thinkingDetails = document.createElement("details");
-                    thinkingDetails.className = "thinking-details";
-                    
-                    const thinkingSummary = document.createElement("summary");
-                    thinkingSummary.innerHTML = `<span class="thinking-icon">🧠</span> <span class="thinking-status">深度思考完成</span>`;
-                    thinkingDetails.appendChild(thinkingSummary);
-                    
-                    const thinkingContent = document.createElement("div");
-                    thinkingContent.className = "thinking-content";
-                    // 使用 Markdown 渲染思考内容
-                    if (window.MarkdownEngine && window.MarkdownEngine.renderFinal) {
-                        window.MarkdownEngine.renderFinal(thinkingContent, extraData.thinking_content);
-                    } else {
-                        thinkingContent.innerHTML = extraData.thinking_content.replace(/\n/g, '<br>');
-                    }
-                    thinkingDetails.appendChild(thinkingContent);
-                    
-                    thinkingHint.appendChild(thinkingDetails);
-                    hintsEl.appendChild(thinkingHint);
-                }
-            }
+        // 如果有历史的消息事件，按顺序显示它们；详情未随消息列表返回时显示占位，展开时再加载
+        if (extraData && extraData.details_url) {
+            appendLazyMessageDetails(hintsEl, extraData.details_url);
+        } else if (extraData) {
+            renderMessageHints(hintsEl, extraData);
         }
         
         // 正文区域（用于 Markdown 渲染）
@@ -4798,15 +4860,118 @@ async function selectConversation(id) {
 }
 
 
+// 历史消息每页条数（打开对话时加载最新一页，向上翻页每次加载同样条数）
+const MESSAGE_PAGE_SIZE = 50;
+
+// 获取 beforeId 之前最新的一页消息（不含消息详情），失败时返回 null
+async function fetchMessagePage(conversationId, beforeId = null) {
+    const params = new URLSearchParams({ limit: MESSAGE_PAGE_SIZE });
+    if (beforeId) params.set("before_id", beforeId);
+    const res = await fetch(`${apiBase}/conversations/${conversationId}/messages?${params}`);
+    if (!res.ok) {
+        console.error("加载消息失败:", res.status);
+        return null;
+    }
+    const data = normalizeApiResponse(await res.json()) || {};
+    return { messages: data.messages || [], hasMore: !!data.has_more };
+}
+
+// 把一条历史消息添加到聊天区域末尾
+function appendHistoryMessage(conversationId, msg) {
+    // 使用数据库中保存的token信息
+    let tokenInfo = null;
+    
+    if (msg.role === "assistant") {
+        // 检查是否有保存的token信息
+        if (msg.input_tokens !== null || msg.output_tokens !== null || msg.total_tokens !== null) {
+            tokenInfo = {
+                input_tokens: msg.input_tokens || 0,
+                output_tokens: msg.output_tokens || 0,
+                total_tokens: msg.total_tokens || 0,
+                model: msg.model || "未知模型"
+            };
+        } else {
+            // 如果没有token信息，显示为历史消息
+            tokenInfo = {
+                input_tokens: 0,
+                output_tokens: 0,
+                total_tokens: 0,
+                model: "历史消息"
+            };
+        }
+    }
+
+    // 工具调用、深度思考、视觉识别内容和消息事件流不随列表返回，展开时再加载
+    let extraData = null;
+    if (msg.role === "assistant" && msg.has_details) {
+        extraData = {
+            details_url: `${apiBase}/conversations/${conversationId}/messages/${msg.id}/events`
+        };
+    }
+
+    return appendMessage(msg.role, msg.content, tokenInfo, true, extraData);
+}
+
+// 在聊天区域顶部添加“加载更早的消息”按钮
+function addLoadEarlierButton(conversationId, beforeId) {
+    if (!chatMessagesEl) return;
+    
+    const btn = document.createElement("button");
+    btn.className = "load-earlier-messages";
+    btn.textContent = "加载更早的消息";
+    btn.onclick = async () => {
+        btn.disabled = true;
+        btn.textContent = "加载中...";
+        try {
+            const page = await fetchMessagePage(conversationId, beforeId);
+            if (!page) throw new Error("加载消息失败");
+            // 等待期间切换了对话
+            if (conversationId !== currentConversationId || !btn.isConnected) return;
+            
+            const prevHeight = chatMessagesEl.scrollHeight;
+            const prevTop = chatMessagesEl.scrollTop;
+            
+            // appendMessage 总是添加到末尾，渲染后再整体移到按钮位置
+            const fragment = document.createDocumentFragment();
+            let firstUserMsgEl = null;
+            page.messages.forEach(msg => {
+                const msgEl = appendHistoryMessage(conversationId, msg);
+                if (!msgEl) return;
+                fragment.appendChild(msgEl.parentElement);
+                if (msg.role === "user" && !firstUserMsgEl) {
+                    firstUserMsgEl = msgEl;
+                }
+            });
+            chatMessagesEl.insertBefore(fragment, btn.nextSibling);
+            btn.remove();
+            if (page.hasMore && page.messages.length > 0) {
+                addLoadEarlierButton(conversationId, page.messages[0].id);
+            }
+            
+            // 保持当前阅读位置，并取消 appendMessage 触发的滚动到底部
+            if (_scrollThrottleTimer) {
+                clearTimeout(_scrollThrottleTimer);
+                _scrollThrottleTimer = null;
+            }
+            chatMessagesEl.scrollTop = prevTop + (chatMessagesEl.scrollHeight - prevHeight);
+            
+            if (firstUserMsgEl && !page.hasMore) {
+                loadAndShowFilesForMessage(conversationId, firstUserMsgEl);
+            }
+        } catch (e) {
+            console.error("加载更早的消息失败:", e);
+            btn.disabled = false;
+            btn.textContent = "加载失败，点击重试";
+        }
+    };
+    chatMessagesEl.insertBefore(btn, chatMessagesEl.firstChild);
+}
+
 async function loadMessages(conversationId) {
     try {
-        const res = await fetch(`${apiBase}/conversations/${conversationId}/messages`);
-        if (!res.ok) {
-            console.error("加载消息失败:", res.status);
-            return;
-        }
-        const raw = await res.json();
-        const msgs = normalizeApiResponse(raw) || [];
+        const page = await fetchMessagePage(conversationId);
+        if (!page) return;
+        const msgs = page.messages;
         
         if (chatMessagesEl) chatMessagesEl.innerHTML = "";
         
@@ -4814,54 +4979,23 @@ async function loadMessages(conversationId) {
         let firstUserMsgEl = null;
         
         msgs.forEach(msg => {
-
-            // 使用数据库中保存的token信息
-            let tokenInfo = null;
-            
-            if (msg.role === "assistant") {
-                // 检查是否有保存的token信息
-                if (msg.input_tokens !== null || msg.output_tokens !== null || msg.total_tokens !== null) {
-                    tokenInfo = {
-                        input_tokens: msg.input_tokens || 0,
-                        output_tokens: msg.output_tokens || 0,
-                        total_tokens: msg.total_tokens || 0,
-                        model: msg.model || "未知模型"
-                    };
-                } else {
-                    // 如果没有token信息，显示为历史消息
-                    tokenInfo = {
-                        input_tokens: 0,
-                        output_tokens: 0,
-                        total_tokens: 0,
-                        model: "历史消息"
-                    };
-                }
-            }
-
-            // 构建额外数据（工具调用、深度思考内容、视觉识别内容和消息事件流）
-            let extraData = null;
-            if (msg.role === "assistant" && (msg.tool_calls || msg.thinking_content || msg.vision_content || msg.message_events)) {
-                extraData = {
-                    tool_calls: msg.tool_calls,
-                    thinking_content: msg.thinking_content,
-                    vision_content: msg.vision_content,
-                    message_events: msg.message_events
-                };
-            }
-
-            const msgEl = appendMessage(msg.role, msg.content, tokenInfo, true, extraData);
+            const msgEl = appendHistoryMessage(conversationId, msg);
             
             // 记录第一条用户消息元素，稍后异步加载文件
             if (msg.role === "user" && !firstUserMsgEl) {
                 firstUserMsgEl = msgEl;
             }
         });
+        
+        if (page.hasMore && msgs.length > 0) {
+            addLoadEarlierButton(conversationId, msgs[0].id);
+        }
 
         scrollToBottom();
         
         // 异步加载文件并显示在用户消息中
-        // 由于文件是关联到对话而不是单条消息，所以显示在第一条用户消息上
-        if (firstUserMsgEl) {
+        // 由于文件是关联到对话而不是单条消息，所以显示在第一条用户消息上（还有更早的消息时，翻到开头再显示）
+        if (firstUserMsgEl && !page.hasMore) {
             loadAndShowFilesForMessage(conversationId, firstUserMsgEl);
         }
     } catch(e) { 
@@ -6031,6 +6165,36 @@ async function onKbSelectChange() {
     }
 }
 
+// 等待知识库导入任务完成（上传接口只返回 job_id，抽取/向量化在后台进行）
+const INGESTION_STAGE_LABELS = {
+    queued: "排队中",
+    extracting: "解析文档",
+    chunking: "切分段落",
+    embedding: "生成向量",
+    storing: "写入知识库",
+    done: "完成"
+};
+
+async function waitForIngestionJob(jobId, onProgress) {
+    while (true) {
+        const res = await fetch(`${apiBase}/knowledge/jobs/${jobId}`);
+        if (!res.ok) throw new Error(await res.text());
+        const job = await res.json();
+        if (onProgress) onProgress(job);
+        if (job.status === "succeeded") return job;
+        if (job.status === "failed") throw new Error(job.error || "导入失败");
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
+function formatIngestionProgress(job) {
+    const stage = INGESTION_STAGE_LABELS[job.stage] || job.stage;
+    if (job.stage === "embedding" && job.chunks_total) {
+        return `${stage} ${job.chunks_done}/${job.chunks_total}`;
+    }
+    return `${stage} ${job.progress || 0}%`;
+}
+
 // 初始化知识库表单事件
 function initKnowledgeBaseForms() {
     // 创建知识库表单
@@ -6191,10 +6355,11 @@ function initKnowledgeBaseForms() {
                 const file = files[i];
                 const formData = new FormData();
                 formData.append("kb_id", kbId);
-                formData.append("file", file);
                 formData.append("extract_images", extractImages ? "true" : "false");
                 if (embeddingModel) formData.append("embedding_model", embeddingModel);
                 if (visionModel) formData.append("vision_model", visionModel);
+                // 文件放在最后，服务端流式接收时可先拿到其他字段
+                formData.append("file", file);
                 
                 if (kbUploadStatusEl) {
                     const statusText = extractImages ? `上传并识别图片中... (${i + 1}/${totalFiles}) - ${file.name}` : `上传中... (${i + 1}/${totalFiles}) - ${file.name}`;
@@ -6210,10 +6375,15 @@ function initKnowledgeBaseForms() {
                     if (!res.ok) throw new Error(await res.text());
                     
                     const result = await res.json();
+                    const job = await waitForIngestionJob(result.job_id, (progressJob) => {
+                        if (kbUploadStatusEl) {
+                            kbUploadStatusEl.textContent = `处理中... (${i + 1}/${totalFiles}) - ${file.name}：${formatIngestionProgress(progressJob)}`;
+                        }
+                    });
                     successCount++;
                     
-                    if (result.chunks_count > 0) {
-                        totalChunks += result.chunks_count;
+                    if (job.chunks_count > 0) {
+                        totalChunks += job.chunks_count;
                     }
                 } catch (e) {
                     failCount++;
@@ -6550,6 +6720,7 @@ function openModelEditPopup(modelId, isDefault, caps = {}) {
     const titleEl = document.getElementById("model-edit-title");
     const idInput = document.getElementById("model-edit-id");
     const nameInput = document.getElementById("model-edit-name");
+    const contextWindowInput = document.getElementById("model-edit-context-window");
     const visionCap = document.getElementById("model-edit-cap-vision");
     const reasoningCap = document.getElementById("model-edit-cap-reasoning");
     const chatCap = document.getElementById("model-edit-cap-chat");
@@ -6560,6 +6731,7 @@ function openModelEditPopup(modelId, isDefault, caps = {}) {
     if (titleEl) titleEl.textContent = modelId ? "编辑模型" : "添加模型";
     if (idInput) idInput.value = modelId || "";
     if (nameInput) nameInput.value = caps.custom_name || "";
+    if (contextWindowInput) contextWindowInput.value = caps.context_window || "";
     if (visionCap) visionCap.checked = caps.vision || false;
     if (reasoningCap) reasoningCap.checked = caps.reasoning || false;
     if (chatCap) chatCap.checked = caps.chat !== false;
@@ -6585,6 +6757,7 @@ async function saveModelEdit() {
     const popup = document.getElementById("model-edit-popup");
     const idInput = document.getElementById("model-edit-id");
     const nameInput = document.getElementById("model-edit-name");
+    const contextWindowInput = document.getElementById("model-edit-context-window");
     const visionCap = document.getElementById("model-edit-cap-vision");
     const reasoningCap = document.getElementById("model-edit-cap-reasoning");
     const chatCap = document.getElementById("model-edit-cap-chat");
@@ -6622,14 +6795,23 @@ async function saveModelEdit() {
         modelsList = modelsList.filter(m => m !== originalModelId);
     }
     
-    // 添加/更新新配置
+    // 添加/更新新配置（保留弹窗中没有的字段，如 max_output_tokens）
+    const previousCaps = modelsConfig[originalModelId || newModelId] || {};
     modelsConfig[newModelId] = {
+        ...previousCaps,
         vision: visionCap?.checked || false,
         reasoning: reasoningCap?.checked || false,
         chat: chatCap?.checked || false,
         image_gen: imageGenCap?.checked || false,
         custom_name: nameInput?.value.trim() || ""
     };
+    // 上下文长度（token）：用于按预算选取历史对话，留空使用服务端默认值
+    const contextWindow = parseInt(contextWindowInput?.value, 10);
+    if (contextWindow > 0) {
+        modelsConfig[newModelId].context_window = contextWindow;
+    } else {
+        delete modelsConfig[newModelId].context_window;
+    }
     
     // 处理默认模型变更
     let newDefaultModel = provider.default_model;
@@ -9037,10 +9219,11 @@ function initInlinePanelEvents() {
                 const file = files[i];
                 const formData = new FormData();
                 formData.append("kb_id", selectedKbId);
-                formData.append("file", file);
                 formData.append("extract_images", extractImages ? "true" : "false");
                 if (embeddingModel) formData.append("embedding_model", embeddingModel);
                 if (visionModel) formData.append("vision_model", visionModel);
+                // 文件放在最后，服务端流式接收时可先拿到其他字段
+                formData.append("file", file);
                 
                 if (statusEl) {
                     statusEl.textContent = `上传中... (${i + 1}/${files.length}) - ${file.name}`;
@@ -9052,6 +9235,12 @@ function initInlinePanelEvents() {
                         body: formData
                     });
                     if (!res.ok) throw new Error();
+                    const result = await res.json();
+                    await waitForIngestionJob(result.job_id, (progressJob) => {
+                        if (statusEl) {
+                            statusEl.textContent = `处理中... (${i + 1}/${files.length}) - ${file.name}：${formatIngestionProgress(progressJob)}`;
+                        }
+                    });
                     successCount++;
                 } catch (e) {
                     failCount++;
@@ -0,0 +1,128 @@
+"""
+磁盘分段向量索引：删除最新文档后重新上传
+SQLite 会复用已删除的最大 chunk_id，重新上传的 chunk 必须仍能被检索到。
+"""
+import os
+
+# 不连接仓库自带的 app.db
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import Base
+from app.db.embedding_codec import encode_embedding
+from app.db.segment_index import SegmentVectorIndex
+
+MODEL = "test-embedding"
+DIM = 8
+
+
+@pytest.fixture(autouse=True)
+def no_compaction(monkeypatch):
+    # 后台压缩会清空墓碑，测试要检查的是墓碑本身是否误伤复用的 chunk_id
+    monkeypatch.setattr(settings, "VECTOR_SEGMENT_COMPACT_RATIO", 1.0)
+    monkeypatch.setattr(settings, "VECTOR_SEGMENT_MAX_COUNT", 1000)
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'kb.db'}")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def _vectors(seed: int, n: int) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+
+
+def _upload(db, index, kb_id: int, name: str, vectors: np.ndarray) -> list:
+    doc = models.KnowledgeDocument(kb_id=kb_id, file_name=name, file_path=name, embedding_model=MODEL)
+    db.add(doc)
+    db.flush()
+    chunks = [
+        models.KnowledgeChunk(
+            document_id=doc.id,
+            chunk_index=i,
+            content=f"{name}-{i}",
+            embedding=encode_embedding(vec.tolist(), "float32"),
+        )
+        for i, vec in enumerate(vectors)
+    ]
+    db.add_all(chunks)
+    db.commit()
+    ids = [c.id for c in chunks]
+    index.add(kb_id, MODEL, ids, vectors)
+    return ids
+
+
+def _delete(db, index, kb_id: int, ids: list) -> None:
+    doc_id = db.get(models.KnowledgeChunk, ids[0]).document_id
+    db.query(models.KnowledgeChunk).filter(models.KnowledgeChunk.id.in_(ids)).delete()
+    db.query(models.KnowledgeDocument).filter(models.KnowledgeDocument.id == doc_id).delete()
+    db.commit()
+    index.remove_chunks(ids, kb_id=kb_id, embedding_model=MODEL)
+
+
+def _top1(db, index, kb_id: int, vector: np.ndarray) -> int:
+    hits = index.search(db, query_embedding=vector, kb_id=kb_id, embedding_model=MODEL, top_k=1)
+    return hits[0][0]
+
+
+def test_reupload_after_deleting_newest_document(db, tmp_path):
+    kb = models.KnowledgeBase(name="kb")
+    db.add(kb)
+    db.commit()
+    index = SegmentVectorIndex(index_dir=str(tmp_path / "vector_index"))
+
+    old_vectors = _vectors(0, 5)
+    _upload(db, index, kb.id, "a.txt", old_vectors)
+    # 首次检索从数据库构建分区
+    assert _top1(db, index, kb.id, old_vectors[0]) is not None
+
+    newest = _upload(db, index, kb.id, "b.txt", _vectors(1, 5))
+    _delete(db, index, kb.id, newest)
+
+    new_vectors = _vectors(2, 5)
+    reused = _upload(db, index, kb.id, "b.txt", new_vectors)
+    assert set(reused) & set(newest), "SQLite 应复用已删除的 chunk_id"
+
+    for chunk_id, vec in zip(reused, new_vectors):
+        assert _top1(db, index, kb.id, vec) == chunk_id
+
+    # 其他 worker / 重启后从磁盘打开同一目录并与数据库对齐，结果一致
+    reopened = SegmentVectorIndex(index_dir=str(tmp_path / "vector_index"))
+    for chunk_id, vec in zip(reused, new_vectors):
+        assert _top1(db, reopened, kb.id, vec) == chunk_id
+
+
+def test_sync_picks_up_reused_ids_written_by_another_worker(db, tmp_path):
+    kb = models.KnowledgeBase(name="kb")
+    db.add(kb)
+    db.commit()
+    index_dir = str(tmp_path / "vector_index")
+    index = SegmentVectorIndex(index_dir=index_dir)
+
+    _upload(db, index, kb.id, "a.txt", _vectors(0, 5))
+    newest = _upload(db, index, kb.id, "b.txt", _vectors(1, 5))
+    assert _top1(db, index, kb.id, _vectors(1, 5)[0]) == newest[0]
+
+    # 删除和重新上传都由另一个 worker 完成：本进程已加载的索引没有收到任何通知，
+    # 只能从磁盘 manifest 感知墓碑和复用同一 chunk_id 的新段
+    other = SegmentVectorIndex(index_dir=index_dir)
+    _delete(db, other, kb.id, newest)
+    new_vectors = _vectors(2, 5)
+    reused = _upload(db, other, kb.id, "c.txt", new_vectors)
+    assert set(reused) & set(newest), "SQLite 应复用已删除的 chunk_id"
+
+    for chunk_id, vec in zip(reused, new_vectors):
+        assert _top1(db, index, kb.id, vec) == chunk_id